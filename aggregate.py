@@ -0,0 +1,242 @@
+"""
+Fleet aggregates - series of all hosts are summed (or averaged) into
+derived rrd tree which has collectd layout:
+
+    <output_root>/<name>/<plugin>/<rrd file>
+
+so it can be passed to any graph generator (`graphs.py cpu -d
+<output_root>/fleet/cpu`), to `batch` or to `server.py`. All instances
+of plugin (every core, interface, disk) are combined into one.
+
+Source files are read with native reader (`backend.rrdfile`) and
+combined with numpy. Derived files are updated incrementally - only
+steps after their last update are read. When derived file is created
+history is filled from the finest source archive which covers given
+part of time (so year long windows are complete immediately). Derived
+ds are GAUGEs (sources are already converted to rates by fetch) and
+have the same RRAs as source files - MIN and MAX archives consolidate
+aggregated averages.
+"""
+import argparse
+import logging
+import math
+import os
+import time
+import warnings
+
+import numpy
+
+import graphs
+from backend import localizable_external as external
+from backend.rrdfile import RRDFile
+
+log = logging.getLogger('aggregate')
+
+
+def _sum(stack):
+    return numpy.nansum(stack, axis=0)
+
+
+def _average(stack):
+    return numpy.nanmean(stack, axis=0)
+
+functions = {
+    'sum': _sum,
+    'average': _average,
+}
+
+# plugin -> function name (cpu graph has rigid 0 - 110% axis, so
+# cores are averaged)
+default_functions = {
+    'cpu': 'average',
+    'load': 'average',
+    'memory': 'sum',
+    'interface': 'sum',
+    'disk': 'sum',
+}
+
+
+def combine(function, arrays):
+    """
+    Combine (rows x ds) arrays - NaN only where all values are unknown
+
+    >>> nan = float('nan')
+    >>> combine('sum', [[[1.0, nan]], [[nan, nan]], [[2.0, nan]]])
+    array([[ 3., nan]])
+    >>> combine('average', [[[1.0, nan]], [[nan, nan]], [[2.0, nan]]])
+    array([[1.5, nan]])
+    """
+    stack = numpy.array(arrays, dtype=float)
+    unknown = numpy.isnan(stack).all(axis=0)
+    with warnings.catch_warnings():
+        # all-NaN slices are handled below
+        warnings.simplefilter('ignore', RuntimeWarning)
+        result = functions[function](stack)
+    result[unknown] = numpy.nan
+    return result
+
+
+def sources(rrd_root, exclude_hosts=(), exclude_instances=('interface-lo',)):
+    """`{(plugin, rrd file name): [source paths]}` for whole collectd tree"""
+    groups = {}
+    for host, instance, plugin, plugin_dir in graphs.discover(rrd_root):
+        if host in exclude_hosts or instance in exclude_instances:
+            continue
+        for filename in sorted(os.listdir(plugin_dir)):
+            if filename.endswith('.rrd'):
+                groups.setdefault((plugin, filename), []).append(os.path.join(plugin_dir, filename))
+    return groups
+
+
+def _archives(rrd):
+    """`(step, first row time)` of AVERAGE archives - finest first"""
+    last_update = rrd.last_update
+    return sorted((a.step, last_update - last_update % a.step - a.step * (a.rows - 1))
+                  for a in rrd.rra if a.cf == 'AVERAGE')
+
+
+def _structure(rrd):
+    """ds names and RRA layout - sources are combined only when they match"""
+    return rrd.step, rrd.ds_names, [(a.cf, a.pdp_per_row, a.rows) for a in rrd.rra]
+
+
+def _format(times, values):
+    return ['%i:%s' % (t, ':'.join('U' if math.isnan(v) else repr(v) for v in row))
+            for t, row in zip(times, values.tolist())]
+
+
+class Aggregate(object):
+    """One derived rrd file computed from `sources` files"""
+
+    def __init__(self, target, sources, function='sum', stale=600, backend=external):
+        self.target = target
+        self.sources = sources
+        self.function = function
+        self.stale = stale
+        self.backend = backend
+
+    def _create(self, template, start):
+        archives = _archives(template)
+        heartbeat = archives[-1][0] * 2
+        parameters = ['--start', str(start), '--step', str(template.step)]
+        parameters += ['DS:%s:GAUGE:%i:U:U' % (name, heartbeat) for name in template.ds_names]
+        parameters += ['RRA:%s:%s:%i:%i' % (a.cf, a.xff, a.pdp_per_row, a.rows) for a in template.rra]
+        directory = os.path.dirname(self.target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.backend.create(self.target, parameters)
+
+    def read(self, rrds, start, end, resolution):
+        """
+        Combined `(times, values)` of (start, end] from every source -
+        sources which differ from the first one (ds names or RRA layout)
+        or don't have `resolution` archive covering the window are
+        skipped.
+        """
+        structure = _structure(rrds[0])
+        arrays = []
+        times = None
+        for rrd in rrds:
+            if _structure(rrd) != structure:
+                log.warning('%s: structure differs from %s - skipped', rrd.filename, rrds[0].filename)
+                continue
+            (first, last, step), ds_names, rows = rrd.fetch('AVERAGE', start, end, resolution)
+            if step != resolution:
+                log.warning('%s: no %is archive covers %i - %i - skipped', rrd.filename, resolution,
+                            start, end)
+                continue
+            if times is None:
+                times = numpy.arange(first + step, last + step, step)
+            arrays.append(rows[:len(times)])
+        if times is None:
+            raise ValueError('No source has %is archive covering %i - %i.' % (resolution, start, end))
+        values = combine(self.function, arrays)
+        selected = (times > start) & (times <= end)
+        return times[selected], values[selected]
+
+    def update(self, batch=1000):
+        """Aggregate steps after last update of target - returns rows written"""
+        rrds = [RRDFile(filename) for filename in self.sources]
+        try:
+            template = rrds[0]
+            step = template.step
+            updates = [rrd.last_update for rrd in rrds]
+            # hosts which stopped reporting don't hold aggregate back
+            end = min(u for u in updates if u >= max(updates) - self.stale)
+            end -= end % step
+            archives = _archives(template)
+            if not os.path.exists(self.target):
+                since = min(first for resolution, first in archives) - step
+                self._create(template, since)
+            else:
+                with RRDFile(self.target) as target:
+                    since = target.last_update
+            written = 0
+            while since < end:
+                # finest archive which still covers `since`
+                covering = [r for r, first in archives if first <= since + r] or [archives[-1][0]]
+                resolution = covering[0]
+                finer = [first for r, first in archives if r < resolution and first > since]
+                # last coarse row may overlap beginning of finer archive
+                upto = min([end] + finer)
+                upto = min(end, upto + -upto % resolution)
+                times, values = self.read(rrds, since, upto, resolution)
+                if not len(times):
+                    break
+                rows = _format(times, values)
+                for i in xrange(0, len(rows), batch):
+                    self.backend.update(self.target, rows[i:i + batch])
+                written += len(rows)
+                since = int(times[-1])
+            return written
+        finally:
+            for rrd in rrds:
+                rrd.close()
+
+
+def aggregates(rrd_root, output_root, name='fleet', functions=default_functions, **kwargs):
+    """`Aggregate` for every (plugin, rrd file) of tree"""
+    exclude = kwargs.pop('exclude_hosts', ())
+    if os.path.abspath(output_root) == os.path.abspath(rrd_root):
+        exclude = tuple(exclude) + (name,)
+    for (plugin, filename), paths in sorted(sources(rrd_root, exclude_hosts=exclude).items()):
+        target = os.path.join(output_root, name, plugin, filename)
+        yield Aggregate(target, paths, function=functions[plugin], **kwargs)
+
+
+def update(rrd_root, output_root, name='fleet', functions=default_functions, **kwargs):
+    for aggregate in aggregates(rrd_root, output_root, name=name, functions=functions, **kwargs):
+        started = time.time()
+        try:
+            written = aggregate.update()
+        except Exception as e:
+            log.error('%s: %s: %s', aggregate.target, e.__class__.__name__, e)
+            continue
+        log.debug('%s: %i rows from %i files in %.3fs', aggregate.target, written,
+                  len(aggregate.sources), time.time() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    parser.add_argument('-o', '--output-root', required=True, help='directory for derived rrd tree')
+    parser.add_argument('-n', '--name', default='fleet', help='name of aggregate "host" directory')
+    parser.add_argument('-x', '--exclude-hosts', nargs='+', default=[])
+    parser.add_argument('-i', '--interval', type=int,
+                        help='update aggregates every INTERVAL seconds (default: update once)')
+    parser.add_argument('--stale', type=int, default=600,
+                        help='ignore hosts which were not updated for STALE seconds when finding last step')
+    for plugin, function in sorted(default_functions.items()):
+        parser.add_argument('--%s' % plugin, choices=sorted(functions), default=function)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    selected = dict((plugin, getattr(args, plugin)) for plugin in default_functions)
+    external.start_pool(1)
+    while True:
+        update(args.rrd_root, args.output_root, name=args.name, functions=selected,
+               exclude_hosts=args.exclude_hosts, stale=args.stale)
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
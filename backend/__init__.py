@@ -0,0 +1,9 @@
+import importlib
+
+
+def get_backend(name):
+    """
+    Backends are imported on demand - 'bindings' requires rrdtool
+    python module.
+    """
+    return importlib.import_module('.localizable_%s' % name, __name__)
@@ -0,0 +1,214 @@
+#-*- coding: utf-8 -*-
+import errno
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from . import instrumentation
+
+class RenderCache(object):
+    """
+    On disk cache of rendered images.
+
+    Key is built from serialized graph parameters (as `prepareObject`
+    returns them), `LC_ALL` value and modification times of all rrd
+    files used by graph. Windows which ended more than `settle` seconds
+    ago are not going to change, so for them modification times are
+    skipped and images are returned without touching rrd files at all.
+
+    When total size of cached images exceeds `max_size` least recently
+    used entries are removed.
+    """
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024, settle=600):
+        self.directory = directory
+        self.max_size = max_size
+        self.settle = settle
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._size = sum(size for path, mtime, size in self._entries())
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_mtime, stat.st_size
+
+    def is_final(self, end):
+        return end is not None and int(end) + self.settle < time.time()
+
+    def key(self, parameters, env=None, end=None, rrdfiles=()):
+        digest = hashlib.sha1()
+        digest.update((env or os.environ).get('LC_ALL', ''))
+        for parameter in parameters:
+            digest.update(parameter.encode('utf-8') if isinstance(parameter, unicode) else str(parameter))
+            digest.update('\0')
+        if not self.is_final(end):
+            for rrdfile in rrdfiles:
+                try:
+                    mtime = os.stat(rrdfile).st_mtime
+                except OSError:
+                    mtime = None
+                digest.update('%s:%r\0' % (rrdfile, mtime))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.png' % key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as image:
+                data = image.read()
+        except IOError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key, data):
+        with instrumentation.timer('write'):
+            handle, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as image:
+                    image.write(data)
+                os.rename(tmp, self.path(key))
+            except:
+                os.unlink(tmp)
+                raise
+        self._added(len(data))
+
+    def added(self, key):
+        """Account image which was rendered directly into `path(key)`"""
+        self._added(os.stat(self.path(key)).st_size)
+
+    def _added(self, size):
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for path, mtime, size in entries)
+        limit = self.max_size * 0.9
+        for path, mtime, size in entries:
+            if self._size <= limit:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def graph(self, backend, filename, parameters, env=None, end=None, rrdfiles=()):
+        """
+        Cached equivalent of `backend.graph(filename, parameters, env)`
+        - only graphs rendered to stdout (filename '-') are cached.
+        """
+        if filename != '-':
+            return backend.graph(filename, parameters, env=env)
+        key = self.key(parameters, env=env, end=end, rrdfiles=rrdfiles)
+        data = self.get(key)
+        if data is None:
+            data = backend.graph(filename, parameters, env=env)
+            self.set(key, data)
+        return data
+
+    def graph_file(self, backend, output, parameters, env=None, end=None, rrdfiles=()):
+        """
+        Cached equivalent of `backend.graph_file(output, parameters, env)`
+        - image is rendered into cache and linked (copied when link is
+        not possible, or into file descriptor) to `output`. Returns
+        `(width, height, prints)` - PRINT values are known only when
+        image was rendered (cached image gives `[]`).
+
+        >>> import tempfile
+        >>> class Backend(object):
+        ...     calls = 0
+        ...     def graph_file(self, target, parameters, env=None):
+        ...         Backend.calls += 1
+        ...         with open(target, 'wb') as image:
+        ...             image.write('image')
+        ...         return 820, 210, ['1.0']
+        >>> directory = tempfile.mkdtemp()
+        >>> cache = RenderCache(os.path.join(directory, 'cache'))
+        >>> parameters = ['--start', '920804400', '--end', '920808000']
+        >>> for name in ['first.png', 'second.png']:
+        ...     print cache.graph_file(Backend(), os.path.join(directory, name), parameters, end=920808000)
+        (820, 210, ['1.0'])
+        (None, None, [])
+        >>> Backend.calls, open(os.path.join(directory, 'second.png')).read()
+        (1, 'image')
+        >>> shutil.rmtree(directory)
+        """
+        key = self.key(parameters, env=env, end=end, rrdfiles=rrdfiles)
+        path = self.path(key)
+        if os.path.exists(path):
+            try:
+                os.utime(path, None)
+                _place(path, output)
+                return _png_size(path) + ([],)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # evicted meanwhile - rendered again
+        tmp = os.path.join(self.directory, '.%s.%s.tmp' % (key, os.urandom(6).encode('hex')))
+        try:
+            info = backend.graph_file(tmp, parameters, env=env)
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self.added(key)
+        _place(path, output)
+        return info
+
+
+def _png_size(path):
+    """`(width, height)` from PNG header - `(None, None)` for other files"""
+    with open(path, 'rb') as image:
+        header = image.read(24)
+    if len(header) < 24 or not header.startswith('\x89PNG'):
+        return None, None
+    return struct.unpack('>II', header[16:24])
+
+
+def _place(path, output):
+    """Link (or copy) `path` into `output` path atomically, copy it into descriptor"""
+    with instrumentation.timer('write'):
+        if isinstance(output, (int, long)):
+            with open(path, 'rb') as image:
+                for chunk in iter(lambda: image.read(64 * 1024), ''):
+                    while chunk:
+                        chunk = chunk[os.write(output, chunk):]
+            return
+        tmp = os.path.join(os.path.dirname(output) or '.', '.%s.%s.tmp' % (
+            os.path.basename(output), os.urandom(6).encode('hex')))
+        try:
+            try:
+                os.link(path, tmp)
+            except OSError:
+                # other file system (or no hard links)
+                shutil.copyfile(path, tmp)
+            os.rename(tmp, output)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
@@ -0,0 +1,138 @@
+#-*- coding: utf-8 -*-
+"""
+Complete `rrdtool graph` argument lists.
+
+`GraphCommand` is built once (from pyrrd graph object) for given
+template, locale and graph options - rendering it only fills plugin
+directory and start/end timestamps in, so pyrrd objects are not built
+(and pyrrd graph module is not even imported) for every graph.
+`CommandCache` keeps commands on disk, so they survive process
+restarts.
+
+>>> command = GraphCommand(['--start', '0', '--end', '0', 'DEF:a=\\0/load.rrd:value:AVERAGE',
+...                         'LINE1:a#ff0000:Load'], [('load.rrd', 'value', 'AVERAGE')], 1, 3)
+>>> command.render('/rrd/host/load', 920804400, 920808000)
+['--start', '920804400', '--end', '920808000', 'DEF:a=/rrd/host/load/load.rrd:value:AVERAGE', 'LINE1:a#ff0000:Load']
+>>> command.render('/rrd/host/load', 920804400, 920808000, step=300)[:6]
+['--start', '920804400', '--end', '920808000', '--step', '300']
+>>> command.rrdfiles_in('/rrd/host/load')
+['/rrd/host/load/load.rrd']
+"""
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+from . import instrumentation
+from .localizable_external import Arguments, split
+
+# plugin directory placeholder - can't appear in any real path
+plugin_dir = '\0'
+
+
+class GraphCommand(object):
+
+    def __init__(self, arguments, series, start_index, end_index):
+        self.arguments = arguments
+        # (rrd file, ds, consolidation function) triples
+        self.series = series
+        self.start_index = start_index
+        self.end_index = end_index
+
+    @property
+    def rrdfiles(self):
+        return sorted(set(s[0] for s in self.series))
+
+    @property
+    def width(self):
+        """Width of graph area in pixels (None when it isn't given)"""
+        if '--width' in self.arguments:
+            return int(self.arguments[self.arguments.index('--width') + 1])
+        return None
+
+    @classmethod
+    def from_graph(cls, graph, series):
+        """
+        Command of pyrrd graph which reads `series` (rrd files are
+        relative to `plugin_dir` placeholder).
+        """
+        backend, (filename, parameters) = graph.prepare()
+        arguments = split(parameters)
+        return cls(arguments, series, arguments.index('--start') + 1, arguments.index('--end') + 1)
+
+    def render(self, directory, start, end, step=None):
+        if isinstance(directory, unicode):
+            directory = directory.encode('utf-8')
+        prefix = os.path.join(directory, '')
+        arguments = Arguments(a.replace(plugin_dir + '/', prefix) for a in self.arguments)
+        arguments[self.start_index] = str(start)
+        arguments[self.end_index] = str(end)
+        if step is not None:
+            arguments[self.end_index + 1:self.end_index + 1] = ['--step', str(step)]
+        return arguments
+
+    def rrdfiles_in(self, directory):
+        return [os.path.join(directory, f) for f in self.rrdfiles]
+
+    def dumps(self):
+        return marshal.dumps((self.arguments, self.series, self.start_index, self.end_index))
+
+    @classmethod
+    def loads(cls, data):
+        return cls(*marshal.loads(data))
+
+
+def _signature(sources):
+    """Python version and modification times of modules which build commands"""
+    signature = [sys.version]
+    for source in sources:
+        source = os.path.splitext(source)[0] + '.py'
+        try:
+            stat = os.stat(source)
+        except OSError:
+            continue
+        signature.append((source, stat.st_mtime, stat.st_size))
+    return signature
+
+
+class CommandCache(object):
+    """
+    On disk cache of `GraphCommand`s - one file per key. Keys are
+    combined with signature of `sources` (modules which define graphs),
+    so commands are rebuilt when graph definitions change.
+    """
+
+    def __init__(self, directory, sources=()):
+        self.directory = directory
+        self.signature = _signature(list(sources) + [__file__])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        digest = hashlib.sha1(repr((key, self.signature))).hexdigest()
+        return os.path.join(self.directory, '%s.cmd' % digest)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as data:
+                command = GraphCommand.loads(data.read())
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        instrumentation.increment('command_cache_hits_total')
+        return command
+
+    def set(self, key, command):
+        handle, tmp = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                output.write(command.dumps())
+            os.rename(tmp, self.path(key))
+        except:
+            os.unlink(tmp)
+            raise
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,170 @@
+#-*- coding: utf-8 -*-
+"""
+Streaming `rrdtool dump` parser. `parse(chunks)` reads XML chunks as
+they come and generates events:
+
+* `('header', {'version':, 'step':, 'lastupdate':})`,
+* `('ds', {'name':, 'type':, 'minimal_heartbeat':, ...})` for every ds,
+* `('rra', {'cf':, 'pdp_per_row':, 'step':, 'params': {...},
+  'cdp_prep': [{...} for every ds]})` before rows of every archive,
+* `('rows', (times, values))` - int64 array of row timestamps and
+  float64 (rows x ds) array of values, at most `batch` rows at once.
+
+No element tree is built and rows are kept only until batch is full,
+so memory usage doesn't depend on size of rrd file.
+
+>>> xml = '''<?xml version="1.0" encoding="utf-8"?>
+... <rrd><version>0003</version><step>300</step> <!-- Seconds -->
+... <lastupdate>920805300</lastupdate>
+... <ds><name> speed </name><type> COUNTER </type><minimal_heartbeat>600</minimal_heartbeat>
+... <min>NaN</min><max>NaN</max><last_ds>12363</last_ds><value>0.0</value></ds>
+... <!-- Round Robin Archives --><rra><cf>AVERAGE</cf><pdp_per_row>1</pdp_per_row>
+... <params><xff>5.0000000000e-01</xff></params><cdp_prep><ds>
+... <value>NaN</value><unknown_datapoints>0</unknown_datapoints></ds></cdp_prep>
+... <database><!-- 1999-03-07 12:00:00 CET / 920804700 --> <row><v>NaN</v></row>
+... <!-- 1999-03-07 12:05:00 CET / 920805000 --> <row><v>4.0e-02</v></row>
+... <!-- 1999-03-07 12:10:00 CET / 920805300 --> <row><v>2.0e-02</v></row>
+... </database></rra></rrd>'''
+>>> events = parse([xml[:200], xml[200:500], xml[500:]], batch=2)
+>>> for event, value in events:
+...     if event == 'rows':
+...         print event, value[0], value[1][:, 0]
+...     else:
+...         print event, sorted((k, v) for k, v in value.items() if k not in ('min', 'max'))
+header [('lastupdate', 920805300), ('step', 300), ('version', '0003')]
+ds [('last_ds', '12363'), ('minimal_heartbeat', 600), ('name', 'speed'), ('type', 'COUNTER'), ('value', 0.0)]
+rra [('cdp_prep', [{'unknown_datapoints': 0, 'value': nan}]), ('cf', 'AVERAGE'), ('params', {'xff': 0.5}), ('pdp_per_row', 1), ('step', 300)]
+rows [920804700 920805000] [ nan 0.04]
+rows [920805300] [0.02]
+"""
+from xml.etree import cElementTree
+
+import numpy
+
+# header values which are kept as strings
+_strings = set(['version', 'name', 'type', 'cf', 'last_ds'])
+
+
+def _value(tag, text):
+    text = (text or '').strip()
+    if tag in _strings:
+        return text
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+class _Target(object):
+    """`XMLParser` target which turns dump elements into events"""
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.events = []
+        self.path = []
+        self.text = []
+        self.header = {}
+        self.section = None
+        self.step = None
+        self.time = None
+        self.times = []
+        self.rows = []
+        self.row = None
+
+    def start(self, tag, attrib):
+        self.text = []
+        # rows are the hot path - they are not tracked in `path`
+        if tag == 'v':
+            return
+        if tag == 'row':
+            if self.time is None:
+                raise ValueError('Row without timestamp comment in rrd dump')
+            self.row = []
+            return
+        self.path.append(tag)
+        depth = len(self.path)
+        if depth == 2 and tag in ('ds', 'rra'):
+            if self.header is not None:
+                self.events.append(('header', self.header))
+                self.header = None
+            self.section = {'cdp_prep': [], 'params': {}} if tag == 'rra' else {}
+        elif tag == 'ds' and self.path[-2] == 'cdp_prep':
+            self.section['cdp_prep'].append({})
+        elif tag == 'database':
+            self.section['step'] = self.step * self.section['pdp_per_row']
+            self.events.append(('rra', self.section))
+
+    def data(self, data):
+        self.text.append(data)
+
+    def comment(self, text):
+        # rows don't carry their timestamps - only comments before them do
+        if self.path and self.path[-1] == 'database':
+            self.time = int(text.rsplit('/', 1)[1])
+
+    def end(self, tag):
+        if tag == 'v':
+            self.row.append(float(''.join(self.text)))
+            return
+        if tag == 'row':
+            self.times.append(self.time)
+            self.rows.append(self.row)
+            self.time = None
+            if len(self.rows) >= self.batch:
+                self.flush()
+            return
+        path = list(self.path)
+        self.path.pop()
+        text = ''.join(self.text)
+        self.text = []
+        if len(path) == 2 and tag in ('version', 'step', 'lastupdate'):
+            self.header[tag] = _value(tag, text)
+            if tag == 'step':
+                self.step = self.header[tag]
+        elif len(path) == 2 and tag == 'ds':
+            self.events.append(('ds', self.section))
+        elif len(path) == 3 and path[1] in ('ds', 'rra') and tag not in ('params', 'cdp_prep', 'database'):
+            self.section[tag] = _value(tag, text)
+        elif len(path) == 4 and path[2] == 'params':
+            self.section['params'][tag] = _value(tag, text)
+        elif len(path) == 5 and path[2] == 'cdp_prep':
+            self.section['cdp_prep'][-1][tag] = _value(tag, text)
+        elif tag == 'database':
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.events.append(('rows', (numpy.array(self.times, dtype=numpy.int64),
+                                         numpy.array(self.rows, dtype=numpy.float64))))
+            self.times, self.rows = [], []
+
+    def close(self):
+        pass
+
+
+def parse(chunks, batch=1024):
+    """Parse dump XML (iterator of chunks) incrementally into events"""
+    target = _Target(batch)
+    parser = cElementTree.XMLParser(target=target)
+    for chunk in chunks:
+        parser.feed(chunk)
+        events, target.events = target.events, []
+        for event in events:
+            yield event
+    parser.close()
+    for event in target.events:
+        yield event
+
+
+def parse_file(path, batch=1024, chunk_size=64 * 1024):
+    """Events of dump saved in file (backup made with `dump(filename, outfile)`)"""
+    with open(path, 'rb') as xml:
+        for event in parse(iter(lambda: xml.read(chunk_size), ''), batch=batch):
+            yield event
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
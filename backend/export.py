@@ -0,0 +1,113 @@
+#-*- coding: utf-8 -*-
+"""
+`rrdtool xport` output handling. Backends' `export` returns `(meta,
+rows)` pair - `meta` is dict (`start`, `end`, `step`, `legends`) and
+`rows` is iterator of `(timestamp, values)`. Rows are never collected
+in memory, so formatters below generate output in constant memory.
+
+>>> xml = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+... <xport><meta><start>920804700</start><step>300</step><end>920805300</end>
+... <rows>2</rows><columns>1</columns><legend><entry>Speed</entry></legend></meta>
+... <data><row><t>920805000</t><v>4.0000000000e-02</v></row>
+... <row><t>920805300</t><v>NaN</v></row></data></xport>'''
+>>> meta, rows = parse([xml[:100], xml[100:]])
+>>> meta['step'], meta['legends']
+(300, ['Speed'])
+>>> print ''.join(to_json(meta, rows))
+{"start": 920804700, "end": 920805300, "step": 300, "legends": ["Speed"], "data": [
+[920805000, 0.04],
+[920805300, null]]}
+>>> meta, rows = parse([xml])
+>>> print ''.join(to_csv(meta, rows)),
+time,Speed
+920805000,0.04
+920805300,
+"""
+import csv
+import json
+import math
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+
+class _Reader(object):
+    """File-like object over iterator of chunks (for `iterparse`)"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self.chunks, '')
+
+
+def _rows(events, data):
+    for event, element in events:
+        if event == 'end' and element.tag == 'row':
+            values = [v.text for v in element.findall('v')]
+            yield (int(element.findtext('t')), tuple(float(v) for v in values))
+            # drop parsed rows - memory usage doesn't depend on rows count
+            data.clear()
+
+
+def parse(chunks):
+    """Parse xport XML (iterator of chunks) incrementally into `(meta, rows)`"""
+    events = cElementTree.iterparse(_Reader(chunks), events=('start', 'end'))
+    for event, element in events:
+        if event == 'end' and element.tag == 'meta':
+            meta = {
+                'start': int(element.findtext('start')),
+                'end': int(element.findtext('end')),
+                'step': int(element.findtext('step')),
+                'legends': [e.text or '' for e in element.find('legend').findall('entry')],
+            }
+        elif event == 'start' and element.tag == 'data':
+            return meta, _rows(events, element)
+    raise ValueError('Missing data in xport output')
+
+
+def _value(value):
+    return None if math.isnan(value) else value
+
+
+def to_json(meta, rows, chunk_rows=512):
+    """Generate JSON document (in chunks of `chunk_rows` rows)"""
+    header = [(k, meta[k]) for k in ['start', 'end', 'step', 'legends']]
+    yield '{%s, "data": [' % ', '.join('%s: %s' % (json.dumps(k), json.dumps(v)) for k, v in header)
+    chunk = []
+    separator = '\n'
+    for time, values in rows:
+        chunk.append(json.dumps([time] + [_value(v) for v in values]))
+        if len(chunk) == chunk_rows:
+            yield separator + ',\n'.join(chunk)
+            separator, chunk = ',\n', []
+    if chunk:
+        yield separator + ',\n'.join(chunk)
+    yield ']}'
+
+
+def to_csv(meta, rows, chunk_rows=512):
+    """Generate CSV (header with `time` and legends, one line per row)"""
+    output = StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(['time'] + [l.encode('utf-8') for l in meta['legends']])
+    count = 0
+    for time, values in rows:
+        writer.writerow([time] + ['' if math.isnan(v) else repr(v) for v in values])
+        count += 1
+        if count == chunk_rows:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+            count = 0
+    yield output.getvalue()
+
+
+formats = {
+    'json': to_json,
+    'csv': to_csv,
+}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
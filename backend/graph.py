@@ -1,7 +1,9 @@
 from pyrrd.graph import Graph, GraphPrint, Line as Line
 
+from . import get_backend, instrumentation
 from . import localizable_external as backend
 
+
 class GraphHrule(object):
     """HRULE:value#color[:legend][:dashes[=on_s[,off_s[,on_s,off_s]...]][:dash-offset=offset]]"""
 
@@ -69,6 +71,11 @@ class Graph(Graph):
         kwargs.setdefault('backend', backend)
         super(Graph, self).__init__(*args, **kwargs)
 
-    def write(self, env=None):
-        data = self.backend.prepareObject('graph', self)
-        return self.backend.graph(*data, env=self.env)
+    def prepare(self, backend=None):
+        backend = self.backend if backend is None else get_backend(backend)
+        with instrumentation.timer('prepare'):
+            return backend, backend.prepareObject('graph', self)
+
+    def write(self, env=None, backend=None):
+        backend, data = self.prepare(backend)
+        return backend.graph(*data, env=self.env)
@@ -0,0 +1,188 @@
+#-*- coding: utf-8 -*-
+"""
+Per process timers and counters for graph rendering stages:
+
+* `template` - compiling (first time) and rendering plugin template,
+* `build` - building pyrrd graph object (first `graphs.command` call),
+* `prepare` - serializing graph with `prepareObject`,
+* `spawn` - starting rrdtool process,
+* `rrdtool` - waiting for rrdtool (rendering, fetching...),
+* `write` - writing image to disk.
+
+Recording is disabled by default - `timer()` returns shared no-op
+context manager and `observe()`/`increment()` return immediately.
+Stats are kept per process (`graphs.batch` workers have their own).
+
+>>> enable()
+>>> events = []
+>>> add_hook(lambda name, value, labels: events.append((name, sorted(labels.values()))))
+>>> with timer('build'):
+...     observe('graph_defs', 9)
+>>> increment('rrdtool_calls_total', command='graph', exit='ok')
+>>> events
+[('graph_defs', []), ('stage_seconds', ['build']), ('rrdtool_calls_total', ['graph', 'ok'])]
+>>> print dump_prometheus(),  # doctest: +ELLIPSIS
+# TYPE rrdgraphs_graph_defs summary
+rrdgraphs_graph_defs_count 1
+rrdgraphs_graph_defs_sum 9
+# TYPE rrdgraphs_graph_defs_max gauge
+rrdgraphs_graph_defs_max 9
+# TYPE rrdgraphs_rrdtool_calls_total counter
+rrdgraphs_rrdtool_calls_total{command="graph",exit="ok"} 1
+# TYPE rrdgraphs_stage_seconds summary
+rrdgraphs_stage_seconds_count{stage="build"} 1
+rrdgraphs_stage_seconds_sum{stage="build"} ...
+# TYPE rrdgraphs_stage_seconds_max gauge
+rrdgraphs_stage_seconds_max{stage="build"} ...
+>>> disable(); reset(); del hooks[:]
+"""
+import threading
+import time
+
+enabled = False
+prefix = 'rrdgraphs_'
+# callbacks called with (name, value, labels) for every recorded value
+hooks = []
+
+# (name, sorted labels) -> [count, sum, max]
+_summaries = {}
+# (name, sorted labels) -> value
+_counters = {}
+_lock = threading.Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _summaries.clear()
+        _counters.clear()
+
+
+def add_hook(hook):
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def _notify(name, value, labels):
+    for hook in hooks:
+        hook(name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Record value (duration, size...) - count, sum and max are kept"""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            _summaries[key] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+    _notify(name, value, labels)
+
+
+def increment(name, value=1, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _notify(name, value, labels)
+
+
+class _Timer(object):
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe('stage_seconds', time.time() - self.started, stage=self.stage, **self.labels)
+        if exc_type is not None:
+            increment('errors_total', stage=self.stage, error=exc_type.__name__)
+
+
+class _NoopTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_noop = _NoopTimer()
+
+
+def timer(stage, **labels):
+    """Context manager which records duration of `stage` (and its errors)"""
+    if not enabled:
+        return _noop
+    return _Timer(stage, labels)
+
+
+def stats():
+    """`{name: [{'labels': {...}, 'count':, 'sum':, 'max':} or {'labels':, 'value':}]}`"""
+    with _lock:
+        summaries = dict((k, list(v)) for k, v in _summaries.items())
+        counters = dict(_counters)
+    result = {}
+    for (name, labels), (count, total, maximum) in sorted(summaries.items()):
+        result.setdefault(name, []).append({'labels': dict(labels), 'count': count,
+                                            'sum': total, 'max': maximum})
+    for (name, labels), value in sorted(counters.items()):
+        result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+    return result
+
+
+def dump_json():
+    import json
+    return json.dumps(stats(), indent=2, sort_keys=True)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in sorted(labels.items()))
+
+
+def dump_prometheus():
+    """Stats in Prometheus text exposition format"""
+    lines = []
+    for name, values in sorted(stats().items()):
+        metric = prefix + name
+        if 'value' in values[0]:
+            lines.append('# TYPE %s counter' % metric)
+            lines.extend('%s%s %r' % (metric, _labels(v['labels']), v['value']) for v in values)
+            continue
+        lines.append('# TYPE %s summary' % metric)
+        for suffix in ['count', 'sum']:
+            lines.extend('%s_%s%s %r' % (metric, suffix, _labels(v['labels']), v[suffix])
+                         for v in values)
+        lines.append('# TYPE %s_max gauge' % metric)
+        lines.extend('%s_max%s %r' % (metric, _labels(v['labels']), v['max']) for v in values)
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
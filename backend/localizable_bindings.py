@@ -0,0 +1,247 @@
+#-*- coding: utf-8 -*-
+"""
+Backend built on rrdtool python bindings (`rrdtool` module).
+
+rrdtool reads locale settings from environment when it renders graph
+(and `setlocale` is process global), so graphs are rendered by worker
+processes - every worker is pinned to one `LC_ALL` value. Daemonic
+processes (workers of `graphs.batch`, `graphs.thumbnails` and
+`prerender.py`) can't start them and render in place - locale is set
+for every call. All other calls are executed in current process.
+"""
+import locale
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+
+import rrdtool
+
+from pyrrd.exceptions import ExternalCommandError
+from pyrrd.util import XML
+
+from . import instrumentation
+from . import localizable_external as external
+from .series import FetchResult
+
+
+def _cmd(command, args):
+    args = [a.encode('utf-8') if isinstance(a, unicode) else str(a) for a in args]
+    if instrumentation.enabled:
+        instrumentation.observe('arguments', len(args), command=command)
+    try:
+        with instrumentation.timer('rrdtool', command=command):
+            result = getattr(rrdtool, command)(*args)
+    except rrdtool.error as e:
+        instrumentation.increment('rrdtool_calls_total', command=command, exit='error')
+        raise ExternalCommandError(str(e).strip())
+    instrumentation.increment('rrdtool_calls_total', command=command, exit='ok')
+    return result
+
+
+def _init_worker(lc_all):
+    if lc_all:
+        os.environ['LC_ALL'] = lc_all
+    else:
+        os.environ.pop('LC_ALL', None)
+    locale.setlocale(locale.LC_ALL, '')
+
+
+def _graph(filename, parameters):
+    if filename == '-':
+        return _cmd('graphv', ['-'] + parameters)['image']
+    return _cmd('graph', [filename] + parameters)
+
+
+def _graph_file(filename, parameters):
+    width, height, prints = _cmd('graph', [filename] + parameters)
+    return width, height, prints or []
+
+
+def _graph_buffered(parameters):
+    info = _cmd('graphv', ['-'] + parameters)
+    prints = []
+    while 'print[%i]' % len(prints) in info:
+        prints.append(info['print[%i]' % len(prints)])
+    return info['image_width'], info['image_height'], prints, info['image']
+
+
+def _write(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class LocalePool(object):
+    """
+    Set of `multiprocessing.Pool`s - one pool (with `size` processes)
+    per `LC_ALL` value. Pools are started on first use.
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, lc_all):
+        with self._lock:
+            if lc_all not in self._pools:
+                self._pools[lc_all] = multiprocessing.Pool(self.size, initializer=_init_worker,
+                                                           initargs=(lc_all,))
+            return self._pools[lc_all]
+
+    def apply(self, lc_all, func, args):
+        return self.get(lc_all).apply(func, args)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools.values(), {}
+        for pool in pools:
+            pool.terminate()
+            pool.join()
+
+
+pool = None
+
+
+def start_pool(size=2):
+    global pool
+    stop_pool()
+    pool = LocalePool(size)
+    return pool
+
+
+def stop_pool():
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
+
+
+def create(filename, parameters, env=None):
+    _cmd('create', [filename] + external.split(parameters))
+
+
+def update(filename, data, debug=False, env=None):
+    _cmd('updatev' if debug else 'update', [filename] + external.split(data))
+
+
+def fetch(filename, query):
+    """
+    Result has the same content (also in compat views) as result of
+    `localizable_external.fetch`:
+
+    >>> rrdfile = tempfile.NamedTemporaryFile()
+    >>> create(rrdfile.name, '--start 920804400 DS:speed:COUNTER:600:U:U RRA:AVERAGE:0.5:1:24')
+    >>> update(rrdfile.name, '920804700:12345 920805000:12357 920805300:12363')
+    >>> query = 'AVERAGE --start 920804400 --end 920805400'
+    >>> results = fetch(rrdfile.name, query)
+    >>> results["ds"]["speed"][0]
+    (920805000, 0.04)
+    >>> for other in [external.fetch(rrdfile.name, query),
+    ...               FetchResult.parse(external.fetchRaw(rrdfile.name, query))]:
+    ...     print other["ds"] == results["ds"], other["time"] == results["time"]
+    True True
+    True True
+    """
+    # rows are the same as rrdtool prints (old parser skipped the first one)
+    return FetchResult.from_rows(*_cmd('fetch', [filename] + external.split(query)), compat_offset=1)
+
+
+def dump(filename, outfile="", parameters="", env=None):
+    if outfile:
+        _cmd('dump', external.split(parameters) + [filename, outfile])
+        return
+    handle, outfile = tempfile.mkstemp(suffix='.xml')
+    os.close(handle)
+    try:
+        _cmd('dump', external.split(parameters) + [filename, outfile])
+        with open(outfile) as xml:
+            return xml.read().strip()
+    finally:
+        os.unlink(outfile)
+
+
+def load(filename):
+    return XML(dump(filename))
+
+
+def iterload(filename, parameters="", env=None, batch=1024):
+    """Events like `localizable_external.iterload` (dump is written to temporary file)"""
+    from . import dump as xmldump
+    handle, outfile = tempfile.mkstemp(suffix='.xml')
+    os.close(handle)
+    try:
+        dump(filename, outfile, parameters)
+        for event in xmldump.parse_file(outfile, batch=batch):
+            yield event
+    finally:
+        os.unlink(outfile)
+
+
+def info(filename, obj=None, **kwargs):
+    return _cmd('info', [filename])
+
+
+def _in_process(lc_all, func, args):
+    previous = os.environ.get('LC_ALL')
+    _init_worker(lc_all)
+    try:
+        return func(*args)
+    finally:
+        _init_worker(previous)
+
+
+def _apply(lc_all, func, args):
+    """`func(*args)` with `LC_ALL` locale"""
+    if multiprocessing.current_process().daemon:
+        # daemonic processes are not allowed to have children
+        return _in_process(lc_all, func, args)
+    if pool is None:
+        start_pool()
+    return pool.apply(lc_all, func, args)
+
+
+def graph(filename, parameters, env=None):
+    lc_all = (env if env is not None else os.environ).get('LC_ALL')
+    return _apply(lc_all, _graph, (filename, external.split(parameters)))
+
+
+def graph_file(target, parameters, env=None):
+    """
+    `(width, height, prints)` like `localizable_external.graph_file` -
+    image is written to `target` (path or file descriptor) by worker
+    process. Descriptors are reopened by workers through `/proc` - on
+    other platforms than Linux (and in daemonic processes) image is
+    passed back and written to descriptor by calling process.
+    """
+    lc_all = (env if env is not None else os.environ).get('LC_ALL')
+    parameters = external.split(parameters)
+    if isinstance(target, (int, long)):
+        if multiprocessing.current_process().daemon or not sys.platform.startswith('linux'):
+            # image is passed back (from worker) and written here
+            width, height, prints, image = _apply(lc_all, _graph_buffered, (parameters,))
+            _write(target, image)
+            return width, height, prints
+        # workers don't share descriptors opened after they were started
+        target = '/proc/%i/fd/%i' % (os.getpid(), target)
+    return _apply(lc_all, _graph_file, (target, parameters))
+
+
+def export(parameters, env=None):
+    """`(meta, rows)` pair like `localizable_external.export` (built in memory)"""
+    result = _cmd('xport', external.split(parameters))
+    meta = result['meta']
+    start, step = meta['start'], meta['step']
+    nan = float('nan')
+    rows = ((start + step * (i + 1), tuple(nan if v is None else v for v in values))
+            for i, values in enumerate(result['data']))
+    return dict(start=start, end=meta['end'], step=step, legends=meta['legend']), rows
+
+
+prepareObject = external.prepareObject
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,36 +1,312 @@
 #-*- coding: utf-8 -*-
+import atexit
+import os
+import shlex
 import sys
+import tempfile
+import threading
 from subprocess import Popen, PIPE
 
-from pyrrd.backend import common
 from pyrrd.exceptions import ExternalCommandError
-from pyrrd.util import XML
 
+from . import instrumentation
+from .series import FetchResult
 
-def _cmd(command, args, env):
-    if sys.platform == 'win32':
-        close_fds = False
-    else:
-        close_fds = True
-    command = "rrdtool %s %s" % (command, args)
-    process = Popen(command, shell=True, stdout=PIPE, stderr=PIPE,
-                    close_fds=close_fds, env=env)
-    (stdout, stderr) = process.communicate()
+
+def _close_fds():
+    return sys.platform != 'win32'
+
+
+# `started(process)` callback of current thread - called for every
+# rrdtool process call depends on (see `backend.nonblocking`)
+_local = threading.local()
+
+
+def _started(process):
+    started = getattr(_local, 'started', None)
+    if started is not None:
+        started(process)
+
+
+class Worker(object):
+    """
+    Long living `rrdtool -` (remote control mode) process.
+
+    Environment (and so `LC_ALL`) is fixed when process is started, so
+    every worker serves only one locale.
+    """
+
+    def __init__(self, env=None):
+        self.env = env
+        with open(os.devnull, 'w') as devnull:
+            self.process = Popen(['rrdtool', '-'], stdin=PIPE, stdout=PIPE,
+                                 stderr=devnull, close_fds=_close_fds(), env=env)
+        # set while command output isn't read to its status line - busy
+        # worker can't take next command
+        self.busy = False
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def execute(self, command, args):
+        line = _line(command, args)
+        if line is None:
+            raise ValueError("'%s' can't be sent to rrdtool remote control mode." % command)
+        self.busy = True
+        self.process.stdin.write(line + '\n')
+        self.process.stdin.flush()
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise ExternalCommandError("rrdtool worker exited while running '%s'." % command)
+            if line.startswith('OK '):
+                self.busy = False
+                return ''.join(output)
+            if line.startswith('ERROR:'):
+                self.busy = False
+                raise ExternalCommandError(line[len('ERROR:'):].strip())
+            output.append(line)
+
+    def close(self):
+        if self.alive:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def kill(self):
+        if self.alive:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.wait()
+
+
+class Pool(object):
+    """
+    Pool of `Worker` processes partitioned by `LC_ALL` value - at most
+    `size` workers are running for every locale. Workers which return
+    after `close()` (or with unread output) are closed.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.closed = False
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def execute(self, command, args, env=None):
+        if self.pid != os.getpid():
+            # forked - workers of parent process can't be shared
+            self._reset()
+        key = (env if env is not None else os.environ).get('LC_ALL')
+        with self._lock:
+            slots = self._slots.setdefault(key, threading.BoundedSemaphore(self.size))
+        slots.acquire()
+        try:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                worker = idle.pop() if idle else None
+            if worker is None or not worker.alive:
+                with instrumentation.timer('spawn'):
+                    worker = Worker(env)
+            _started(worker.process)
+            try:
+                return worker.execute(command, args)
+            finally:
+                with self._lock:
+                    idle = not self.closed and not worker.busy and worker.alive
+                    if idle:
+                        self._idle.setdefault(key, []).append(worker)
+                if not idle and worker.busy:
+                    # output of interrupted command would be read by next one
+                    worker.kill()
+                elif not idle:
+                    worker.close()
+        finally:
+            slots.release()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            workers = [w for idle in self._idle.values() for w in idle]
+            self._idle = {}
+        for worker in workers:
+            worker.close()
+
+
+pool = None
+
+
+def start_pool(size=4):
+    """
+    Switch backend into persistent mode - all calls are executed by
+    long living rrdtool processes instead of fresh process per call.
+    """
+    global pool
+    stop_pool()
+    pool = Pool(size)
+    return pool
+
+
+def stop_pool():
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
+
+atexit.register(stop_pool)
+
+
+def _quote(arg):
+    """
+    Quote argument for rrdtool remote control mode tokenizer - it
+    understands only single and double quotes (without any escaping).
+
+    >>> print _quote('DEF:a=/tmp/a.rrd:value:AVERAGE')
+    DEF:a=/tmp/a.rrd:value:AVERAGE
+    >>> print _quote('Used: ')
+    "Used: "
+    >>> print _quote('say "hi"')
+    "say "'"'"hi"'"'""
+    """
+    if '\n' in arg:
+        raise ValueError("Newline is not allowed in rrdtool argument: %r" % arg)
+    if arg and not any(c in arg for c in ' "\''):
+        return arg
+    return '"%s"' % arg.replace('"', '"\'"\'"')
+
+
+# rrdtool reads remote control lines with fgets into 10000 bytes buffer
+# and rejects lines which fill it (newline included)
+MAX_LINE = 10000 - 3
+
+
+def _encode(arg):
+    return arg.encode('utf-8') if isinstance(arg, unicode) else arg
+
+
+def _line(command, args):
+    """
+    Command line for rrdtool remote control mode (UTF-8 encoded) - None
+    when it can't be sent there (it is too long or contains newline).
+
+    >>> print _line('graph', ['-', u'COMMENT:\u0141\xf3d\u017a'])
+    graph - COMMENT:\xc5\x81\xc3\xb3d\xc5\xba
+    >>> _line('graph', ['-', 'COMMENT:' + 'x' * MAX_LINE]) is None
+    True
+    >>> _line('graph', ['-', 'COMMENT:a\\nb']) is None
+    True
+    """
+    try:
+        line = ' '.join(_quote(_encode(a)) for a in [command] + args)
+    except ValueError:
+        return None
+    return line if len(line) <= MAX_LINE else None
+
+
+def _cmd(command, args, env, stdin=None):
+    if instrumentation.enabled:
+        instrumentation.observe('arguments', len(args), command=command)
+    args = [_encode(a) for a in args]
+    # long lines are executed by one-off process
+    if pool is not None and stdin is None and _line(command, args) is not None:
+        try:
+            with instrumentation.timer('rrdtool', command=command):
+                stdout = pool.execute(command, args, env=env)
+        except ExternalCommandError:
+            instrumentation.increment('rrdtool_calls_total', command=command, exit='error')
+            raise
+        instrumentation.increment('rrdtool_calls_total', command=command, exit='ok')
+        instrumentation.observe('output_bytes', len(stdout), command=command)
+        return stdout
+    name, command = command, ['rrdtool', command] + args
+    with instrumentation.timer('spawn'):
+        process = Popen(command, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                        close_fds=_close_fds(), env=env)
+    _started(process)
+    with instrumentation.timer('rrdtool', command=name):
+        (stdout, stderr) = process.communicate()
     if stderr:
+        instrumentation.increment('rrdtool_calls_total', command=name, exit='stderr')
         raise ExternalCommandError(stderr.strip())
     if process.returncode != 0:
+        instrumentation.increment('rrdtool_calls_total', command=name, exit='returncode')
         errmsg = "Return code from '%s' was %s." % (
-            command, process.returncode)
+            ' '.join(command), process.returncode)
         raise ExternalCommandError(errmsg)
+    instrumentation.increment('rrdtool_calls_total', command=name, exit='ok')
+    instrumentation.observe('output_bytes', len(stdout), command=name)
     return stdout
 
 
+def _stream(command, args, env, chunk_size=64 * 1024):
+    """
+    Run rrdtool and generate its output in chunks as they are read.
+    Process is killed when generator is closed before output ends.
+    """
+    command = ['rrdtool', command] + args
+    stderr = tempfile.TemporaryFile()
+    process = Popen(command, stdout=PIPE, stderr=stderr,
+                    close_fds=_close_fds(), env=env)
+    _started(process)
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), ''):
+            yield chunk
+        process.wait()
+        stderr.seek(0)
+        errmsg = stderr.read().strip()
+        if errmsg:
+            raise ExternalCommandError(errmsg)
+        if process.returncode != 0:
+            raise ExternalCommandError("Return code from '%s' was %s." % (
+                ' '.join(command), process.returncode))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr.close()
+
+
+class Arguments(list):
+    """
+    Already split arguments - `split` passes them to rrdtool unchanged.
+
+    >>> split(Arguments(['--vertical-label', 'CPU usage']))
+    ['--vertical-label', 'CPU usage']
+    """
+
+
 def concat(args):
     if isinstance(args, list):
         args = " ".join([a.encode('utf-8') if isinstance(a, unicode) else a for a in args])
     return args
 
 
+def split(args):
+    """
+    Split parameters (string or list of strings) the same way as shell
+    does - parameters are still passed in pyrrd format (with quoted
+    legends etc.) but rrdtool is executed without shell.
+
+    >>> split(['--vertical-label', '"CPU usage"', 'LINE1:a#ff0000:"Used "'])
+    ['--vertical-label', 'CPU usage', 'LINE1:a#ff0000:Used ']
+    """
+    if isinstance(args, Arguments):
+        return list(args)
+    args = concat(args)
+    if isinstance(args, unicode):
+        args = args.encode('utf-8')
+    return shlex.split(args)
+
+
 def create(filename, parameters, env=None):
     """
     >>> import tempfile
@@ -44,8 +320,7 @@ def create(filename, parameters, env=None):
     >>> os.path.exists(rrdfile.name)
     True
     """
-    parameters = "%s %s" % (filename, concat(parameters))
-    _cmd('create', parameters, env=env)
+    _cmd('create', [filename] + split(parameters), env=env)
 
 
 def update(filename, data, debug=False, env=None):
@@ -74,7 +349,7 @@ def update(filename, data, debug=False, env=None):
     ...   '920808300:12420 920808600:12422 920808900:12423')
 
     """
-    parameters = "%s %s" % (filename, concat(data))
+    parameters = [filename] + split(data)
     if debug:
         _cmd('updatev', parameters, env=env)
     else:
@@ -82,12 +357,47 @@ def update(filename, data, debug=False, env=None):
 
 
 def fetchRaw(filename, query, env=None):
-    parameters = "%s %s" % (filename, concat(query))
-    return _cmd('fetch', parameters, env=env).strip()
+    return _cmd('fetch', [filename] + split(query), env=env).strip()
+
+
+_fetch_options = {'-s': 'start', '--start': 'start', '-e': 'end', '--end': 'end',
+                  '-r': 'resolution', '--resolution': 'resolution'}
+
+
+def _fetch_query(query):
+    """
+    `(cf, start, end, resolution)` of fetch query - None when native
+    reader can't answer it (AT-style times, other options).
+
+    >>> _fetch_query('AVERAGE --start 920804400 -e 920809200')
+    ('AVERAGE', 920804400, 920809200, 1)
+    >>> _fetch_query('AVERAGE --start now-1d') is None
+    True
+    """
+    args = split(query)
+    if not args or args[0] not in ['AVERAGE', 'MIN', 'MAX', 'LAST']:
+        return None
+    options = []
+    for arg in args[1:]:
+        options.extend(arg.split('=', 1) if arg.startswith('--') else [arg])
+    if len(options) % 2:
+        return None
+    values = {'resolution': '1'}
+    for name, value in zip(options[::2], options[1::2]):
+        if name not in _fetch_options or not value.isdigit():
+            return None
+        values[_fetch_options[name]] = value
+    start, end = values.get('start'), values.get('end')
+    if start is not None and end is not None and int(start) >= int(end):
+        return None
+    return (args[0], start and int(start), end and int(end), int(values['resolution']))
 
 
 def fetch(filename, query):
     """
+    Fetch with native reader (`backend.rrdfile`) - `rrdtool fetch` is
+    started only for queries and files which it can't read.
+
     >>> import tempfile
     >>> rrdfile = tempfile.NamedTemporaryFile()
     >>> parameters = ' --start 920804400'
@@ -115,7 +425,7 @@ def fetch(filename, query):
 
     # accessing a DS entry like this gives of a (time, data) tuple:
     >>> results["ds"]["speed"][0]
-    (920805000, 0.040000000000000001)
+    (920805000, 0.04)
 
     # The other way of accessing the results data is by data source time
     # entries:
@@ -125,26 +435,29 @@ def fetch(filename, query):
     >>> keys[0:6]
     [920805000, 920805300, 920805600, 920805900, 920806200, 920806500]
     >>> results["time"][920805000]
-    {'speed': 0.040000000000000001}
+    {'speed': 0.04}
 
     The benefits of using an approach like this become obvious when the RRD
     file has multiple DSs and RRAs.
+
+    Both of above views are built on demand from columnar arrays, which
+    also keep the first row rrdtool prints (views skip it, as old parser
+    did):
+
+    >>> results.time[0], results.columns["speed"][0], results.step
+    (920804700, nan, 300)
+    >>> results.time[1], results.columns["speed"][1]
+    (920805000, 0.04)
     """
-    output = fetchRaw(filename, concat(query))
-    lines = [line for line in output.split('\n') if line]
-    dsNames = lines[0].split()
-    results = {
-        "ds": {},
-        "time": {},
-        }
-    for line in lines[2:]:
-        time, data = line.split(":")
-        data = [common.coerce(datum) for datum in data.split()]
-        results["time"][int(time)] = dict(zip(dsNames, data))
-        for dsName, datum in zip(dsNames, data):
-            results["ds"].setdefault(dsName, [])
-            results["ds"][dsName].append((int(time), common.coerce(datum)))
-    return results
+    native = _fetch_query(query)
+    if native is not None:
+        from . import rrdfile
+        try:
+            # rows are the same as rrdtool prints (old parser skipped the first one)
+            return FetchResult.from_rows(*rrdfile.fetch(filename, *native), compat_offset=1)
+        except (IOError, ValueError):
+            pass
+    return FetchResult.parse(fetchRaw(filename, concat(query)))
 
 
 def dump(filename, outfile="", parameters="", env=None):
@@ -172,7 +485,7 @@ def dump(filename, outfile="", parameters="", env=None):
     >>> os.path.exists(xmlfile.name)
     True
     """
-    parameters = "%s %s %s" % (filename, outfile, concat(parameters))
+    parameters = [filename] + ([outfile] if outfile else []) + split(parameters)
     output = _cmd('dump', parameters, env=env)
     if not outfile:
         return output.strip()
@@ -193,9 +506,27 @@ def load(filename):
     >>> [x.tag for x in tree]
     ['version', 'step', 'lastupdate', 'ds', 'rra', 'rra']
     """
+    from pyrrd.util import XML
     return XML(dump(filename))
 
 
+def iterload(filename, parameters="", env=None, batch=1024):
+    """
+    Generate `rrdtool dump` events (see `backend.dump`) while dump is
+    read from rrdtool output - unlike `load`, memory usage doesn't
+    depend on size of rrd file. rrdtool is always spawned.
+
+    >>> import tempfile
+    >>> rrdfile = tempfile.NamedTemporaryFile()
+    >>> create(rrdfile.name, ' --start 920804400 DS:speed:COUNTER:600:U:U RRA:AVERAGE:0.5:1:24 RRA:AVERAGE:0.5:6:10')
+    >>> [(event, len(value[0]) if event == 'rows' else value.get('cf'))
+    ...  for event, value in iterload(rrdfile.name)]
+    [('header', None), ('ds', None), ('rra', 'AVERAGE'), ('rows', 24), ('rra', 'AVERAGE'), ('rows', 10)]
+    """
+    from . import dump as xmldump
+    return xmldump.parse(_stream('dump', [filename] + split(parameters), env), batch=batch)
+
+
 def info(filename, obj, **kwargs):
     """
     """
@@ -237,8 +568,58 @@ def graph(filename, parameters, env):
     >>> os.path.exists(graphfile.name)
     True
     """
-    parameters = "%s %s" % (filename, concat(parameters))
-    return _cmd('graph', parameters, env=env)
+    parameters = split(parameters)
+    if pool is not None and filename == '-':
+        # in remote control mode image written to stdout can't be safely
+        # separated from rrdtool status lines, so we pass it through file
+        handle, filename = tempfile.mkstemp(suffix='.png')
+        os.close(handle)
+        try:
+            _cmd('graph', [filename] + parameters, env=env)
+            with open(filename, 'rb') as image:
+                return image.read()
+        finally:
+            os.unlink(filename)
+    return _cmd('graph', [filename] + parameters, env=env)
+
+
+def _graph_info(output):
+    """
+    `(width, height, prints)` from `rrdtool graph` output
+
+    >>> _graph_info('497x179\\n0.50\\n')
+    (497, 179, ['0.50'])
+    """
+    lines = output.splitlines()
+    width, height = lines[0].split('x')
+    return int(width), int(height), lines[1:]
+
+
+def graph_file(target, parameters, env=None):
+    """
+    Let rrdtool write image directly into `target` - path or file
+    descriptor opened for writing (regular file, which is rewritten from
+    the beginning, or pipe), so image doesn't pass through python.
+    Returns `(width, height, prints)` - size of image and values of
+    PRINT elements.
+    """
+    parameters = split(parameters)
+    if isinstance(target, (int, long)):
+        # rrdtool doesn't print anything when image goes to stdout, so
+        # descriptor is passed as stdin and reopened by path
+        # (remote control workers can't get it - rrdtool is spawned)
+        return _graph_info(_cmd('graph', ['/dev/fd/0'] + parameters, env=env, stdin=target))
+    return _graph_info(_cmd('graph', [target] + parameters, env=env))
+
+
+def export(parameters, env=None):
+    """
+    Stream `rrdtool xport` output - returns `(meta, rows)` (see
+    `backend.export`). rrdtool is always spawned (remote control
+    workers can't stream), so output doesn't have to fit in memory.
+    """
+    from . import export as xport
+    return xport.parse(_stream('xport', split(parameters), env))
 
 
 def prepareObject(function, obj):
@@ -256,6 +637,7 @@ def prepareObject(function, obj):
     will call this function. In graph, Pretty much only the method
     pyrrd.graph.Graph.write() will call this function.
     """
+    from pyrrd.backend import common
     if function == 'create':
         validParams = ['start', 'step']
         params = common.buildParameters(obj, validParams)
@@ -0,0 +1,230 @@
+#-*- coding: utf-8 -*-
+"""
+Non blocking backend calls. Calls are queued and executed by at most
+`concurrency` threads, so number of concurrently running rrdtool
+processes is bounded. Every call returns `Call` (future like object) -
+event loops can wait for it with `add_done_callback`.
+
+`cancel()` (and per call `timeout`) kills rrdtool process started by
+the call (persistent worker when `localizable_external` pool is
+active). Calls executed by `localizable_bindings` run in this or pool
+process - they are not interrupted, only their results are dropped.
+
+>>> import time
+>>> runner = Runner(concurrency=1)
+>>> runner.submit(lambda a, b: a + b, 1, 2).result()
+3
+>>> slow = runner.submit(time.sleep, 1)
+>>> queued = runner.submit(time.sleep, 0, timeout=0.1)
+>>> queued.result()
+Traceback (most recent call last):
+...
+CallTimeout: Call timed out after 0.1s.
+>>> slow.cancel()
+True
+>>> slow.result()
+Traceback (most recent call last):
+...
+CallCancelled: Call was cancelled.
+"""
+import atexit
+import threading
+from Queue import Queue
+
+from pyrrd.exceptions import ExternalCommandError
+
+from . import localizable_external as external
+from . import get_backend
+
+
+class CallCancelled(ExternalCommandError):
+    pass
+
+
+class CallTimeout(CallCancelled):
+    pass
+
+
+class Call(object):
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._processes = []
+        self._result = self._error = None
+        self._timer = self._run_timer = None
+        # seconds counted from start of call (see `Runner.submit`)
+        self.run_timeout = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return isinstance(self._error, CallCancelled)
+
+    def result(self, timeout=None):
+        """Wait for result (raises call error) - `timeout` doesn't cancel call"""
+        if not self._done.wait(timeout):
+            raise CallTimeout('Result not ready after %ss.' % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        """`callback(call)` is called (in worker thread) when call is finished"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+            processes, self._processes = self._processes, []
+        for timer in [self._timer, self._run_timer]:
+            if timer is not None:
+                timer.cancel()
+        if error is not None:
+            for process in processes:
+                _kill(process)
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def _started(self, process):
+        with self._lock:
+            if not self._done.is_set():
+                self._processes.append(process)
+                return
+        _kill(process)
+
+    def cancel(self, error=None):
+        """Finish call with `CallCancelled` and kill its rrdtool processes"""
+        return self._finish(error=error or CallCancelled('Call was cancelled.'))
+
+    def run(self):
+        if self._done.is_set():
+            return
+        if self.run_timeout is not None:
+            self._run_timer = threading.Timer(self.run_timeout, self.cancel,
+                                              [CallTimeout('Call timed out after %ss.' % self.run_timeout)])
+            self._run_timer.daemon = True
+            self._run_timer.start()
+        external._local.started = self._started
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self._finish(error=e)
+        else:
+            self._finish(result=result)
+        finally:
+            external._local.started = None
+
+
+def _kill(process):
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+class Runner(object):
+
+    def __init__(self, concurrency=4):
+        self.concurrency = concurrency
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                return
+            call.run()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue `func(*args, **kwargs)` - `timeout` (in seconds, counted
+        from submission) cancels call with `CallTimeout`, `run_timeout`
+        is counted from start of call (time spent in queue is not
+        limited by it).
+        """
+        timeout = kwargs.pop('timeout', None)
+        run_timeout = kwargs.pop('run_timeout', None)
+        call = Call(func, args, kwargs)
+        call.run_timeout = run_timeout
+        if timeout is not None:
+            call._timer = threading.Timer(timeout, call.cancel,
+                                          [CallTimeout('Call timed out after %ss.' % timeout)])
+            call._timer.daemon = True
+            call._timer.start()
+        with self._lock:
+            if len(self._threads) < self.concurrency:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(call)
+        return call
+
+    def close(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+runner = Runner()
+
+
+def configure(concurrency=4):
+    """Replace default runner (running calls are finished)"""
+    global runner
+    previous, runner = runner, Runner(concurrency)
+    previous.close()
+    return runner
+
+
+def _close():
+    runner.close()
+
+atexit.register(_close)
+
+
+def submit(func, *args, **kwargs):
+    return runner.submit(func, *args, **kwargs)
+
+
+def graph(filename, parameters, env=None, backend='external', timeout=None):
+    return submit(get_backend(backend).graph, filename, parameters, env=env, timeout=timeout)
+
+
+def fetch(filename, query, backend='external', timeout=None):
+    return submit(get_backend(backend).fetch, filename, query, timeout=timeout)
+
+
+def update(filename, data, env=None, backend='external', timeout=None):
+    return submit(get_backend(backend).update, filename, data, env=env, timeout=timeout)
+
+
+def dump(filename, outfile='', parameters='', env=None, backend='external', timeout=None):
+    return submit(get_backend(backend).dump, filename, outfile, parameters, env=env,
+                  timeout=timeout)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,340 @@
+#-*- coding: utf-8 -*-
+"""
+Native (pure python) reader of rrd files.
+
+File is memory mapped and consolidated data rows are returned as numpy
+arrays which point straight into the rrd ring buffer (only rows which
+wrap around ring end or fall outside of archive are copied).
+
+rrd file is a dump of rrdtool C structures, so its layout depends on
+the platform which wrote it (size of `long`, alignment of `double` and
+byte order). Supported layouts: 64 bit (amd64 etc.), i386 and 32 bit
+platforms which align doubles to 8 bytes (arm etc.), in both byte
+orders, file format versions 0001 - 0004.
+"""
+import mmap
+import struct
+import time
+from collections import namedtuple
+
+import numpy
+
+FLOAT_COOKIE = 8.642135E130
+# sizes of rrdtool structure fields (rrd_format.h)
+DS_NAM_SIZE = 20
+DST_SIZE = 20
+CF_NAM_SIZE = 20
+LAST_DS_LEN = 30
+MAX_PAR = 10
+UNIVAL_SIZE = 8
+
+DataSource = namedtuple('DataSource', 'name type heartbeat min max')
+Archive = namedtuple('Archive', 'index cf rows pdp_per_row xff step offset')
+
+
+def _align(offset, alignment):
+    return offset + (-offset % alignment)
+
+
+class Layout(object):
+    """
+    Offsets and sizes of rrd structures for given platform properties.
+
+    >>> layout = Layout('<', long_size=8, double_align=8)
+    >>> layout.stat_head_size, layout.ds_def_size, layout.rra_def_size, layout.pdp_prep_size
+    (128, 120, 120, 112)
+    >>> layout = Layout('<', long_size=4, double_align=4)
+    >>> layout.stat_head_size, layout.ds_def_size, layout.rra_def_size, layout.pdp_prep_size
+    (112, 120, 108, 112)
+    """
+
+    def __init__(self, byteorder, long_size, double_align):
+        self.byteorder = byteorder
+        self.long_size = long_size
+        self.long_format = byteorder + ('Q' if long_size == 8 else 'I')
+        self.double_format = byteorder + 'd'
+        unival_align = max(long_size, double_align)
+
+        self.float_cookie_offset = _align(4 + 5, double_align)
+        self.ds_cnt_offset = self.float_cookie_offset + 8
+        self.rra_cnt_offset = self.ds_cnt_offset + long_size
+        self.pdp_step_offset = self.rra_cnt_offset + long_size
+        self.stat_head_size = _align(_align(self.pdp_step_offset + long_size, unival_align) +
+                                     MAX_PAR * UNIVAL_SIZE, unival_align)
+
+        self.ds_par_offset = _align(DS_NAM_SIZE + DST_SIZE, unival_align)
+        self.ds_def_size = _align(self.ds_par_offset + MAX_PAR * UNIVAL_SIZE, unival_align)
+
+        self.row_cnt_offset = _align(CF_NAM_SIZE, long_size)
+        self.pdp_cnt_offset = self.row_cnt_offset + long_size
+        self.rra_par_offset = _align(self.pdp_cnt_offset + long_size, unival_align)
+        self.rra_def_size = _align(self.rra_par_offset + MAX_PAR * UNIVAL_SIZE, unival_align)
+
+        self.pdp_prep_size = _align(LAST_DS_LEN, unival_align) + MAX_PAR * UNIVAL_SIZE
+        self.cdp_prep_size = MAX_PAR * UNIVAL_SIZE
+
+    def live_head_size(self, version):
+        # time_t last_up (+ long last_up_usec since version 0003)
+        return self.long_size * (2 if version >= 3 else 1)
+
+    def unpack_long(self, buffer, offset):
+        return struct.unpack_from(self.long_format, buffer, offset)[0]
+
+    def unpack_double(self, buffer, offset):
+        return struct.unpack_from(self.double_format, buffer, offset)[0]
+
+
+LAYOUTS = [Layout(byteorder, long_size, double_align)
+           for byteorder in ['<', '>']
+           for long_size, double_align in [(8, 8), (4, 4), (4, 8)]]
+
+
+def _string(buffer, offset, size):
+    return buffer[offset:offset + size].split('\0', 1)[0]
+
+
+class RRDFile(object):
+    """
+    Memory mapped rrd file.
+
+    Header is parsed once (when file is opened) - reopen file if its
+    structure could change. Values returned by `fetch` are views of the
+    mapped file so they reflect updates made afterwards by rrdtool.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as rrd:
+            self._map = mmap.mmap(rrd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except:
+            self._map.close()
+            raise
+
+    def _detect(self, size):
+        buffer = self._map
+        if buffer[:4] != 'RRD\0':
+            raise ValueError('%s is not rrd file' % self.filename)
+        for layout in LAYOUTS:
+            if size < layout.stat_head_size:
+                continue
+            if layout.unpack_double(buffer, layout.float_cookie_offset) != FLOAT_COOKIE:
+                continue
+            ds_cnt = layout.unpack_long(buffer, layout.ds_cnt_offset)
+            rra_cnt = layout.unpack_long(buffer, layout.rra_cnt_offset)
+            header_size = (layout.stat_head_size + ds_cnt * layout.ds_def_size +
+                           rra_cnt * layout.rra_def_size)
+            if header_size > size:
+                continue
+            offset = header_size
+            row_cnts = [layout.unpack_long(buffer, offset - (rra_cnt - i) * layout.rra_def_size +
+                                           layout.row_cnt_offset)
+                        for i in range(rra_cnt)]
+            offset += (layout.live_head_size(self.version) + ds_cnt * layout.pdp_prep_size +
+                       ds_cnt * rra_cnt * layout.cdp_prep_size + rra_cnt * layout.long_size)
+            if offset + sum(row_cnts) * ds_cnt * 8 == size:
+                return layout
+        raise ValueError('Unsupported rrd file layout: %s' % self.filename)
+
+    def _parse(self):
+        buffer = self._map
+        self.version = int(_string(buffer, 4, 5))
+        layout = self.layout = self._detect(len(buffer))
+        ds_cnt = layout.unpack_long(buffer, layout.ds_cnt_offset)
+        rra_cnt = layout.unpack_long(buffer, layout.rra_cnt_offset)
+        self.step = layout.unpack_long(buffer, layout.pdp_step_offset)
+
+        offset = layout.stat_head_size
+        self.ds = []
+        for i in range(ds_cnt):
+            par = offset + layout.ds_par_offset
+            self.ds.append(DataSource(name=_string(buffer, offset, DS_NAM_SIZE),
+                                      type=_string(buffer, offset + DS_NAM_SIZE, DST_SIZE),
+                                      heartbeat=layout.unpack_long(buffer, par),
+                                      min=layout.unpack_double(buffer, par + UNIVAL_SIZE),
+                                      max=layout.unpack_double(buffer, par + 2 * UNIVAL_SIZE)))
+            offset += layout.ds_def_size
+
+        rra_defs = []
+        for i in range(rra_cnt):
+            rra_defs.append((_string(buffer, offset, CF_NAM_SIZE),
+                             layout.unpack_long(buffer, offset + layout.row_cnt_offset),
+                             layout.unpack_long(buffer, offset + layout.pdp_cnt_offset),
+                             layout.unpack_double(buffer, offset + layout.rra_par_offset)))
+            offset += layout.rra_def_size
+
+        self._live_head_offset = offset
+        offset += (layout.live_head_size(self.version) + ds_cnt * layout.pdp_prep_size +
+                   ds_cnt * rra_cnt * layout.cdp_prep_size)
+        self._rra_ptr_offset = offset
+        offset += rra_cnt * layout.long_size
+
+        self.rra = []
+        self._dtype = numpy.dtype(layout.double_format)
+        for i, (cf, rows, pdp_per_row, xff) in enumerate(rra_defs):
+            self.rra.append(Archive(index=i, cf=cf, rows=rows, pdp_per_row=pdp_per_row, xff=xff,
+                                    step=pdp_per_row * self.step,
+                                    offset=offset))
+            offset += rows * ds_cnt * 8
+
+    @property
+    def ds_names(self):
+        return [ds.name for ds in self.ds]
+
+    @property
+    def last_update(self):
+        """Read on every access - it changes with every rrd update"""
+        return self.layout.unpack_long(self._map, self._live_head_offset)
+
+    def cur_row(self, rra):
+        return self.layout.unpack_long(self._map, self._rra_ptr_offset +
+                                       rra.index * self.layout.long_size)
+
+    def ring(self, rra):
+        """Whole archive as (rows x ds) array view - row order as on disk"""
+        return numpy.frombuffer(self._map, dtype=self._dtype, count=rra.rows * len(self.ds),
+                                offset=rra.offset).reshape(rra.rows, len(self.ds))
+
+    def select(self, cf, start, end, resolution=1, last_update=None):
+        """
+        Choose archive the same way as `rrdtool fetch` does: archive
+        which covers whole period and which step is closest to requested
+        resolution, or if there is no such archive - the one which
+        covers the biggest part of requested period.
+        """
+        last_update = self.last_update if last_update is None else last_update
+        best_full = best_partial = None
+        for rra in self.rra:
+            if rra.cf != cf:
+                continue
+            cal_end = last_update - last_update % rra.step
+            cal_start = cal_end - rra.step * rra.rows
+            step_diff = abs(resolution - rra.step)
+            if cal_start <= start:
+                if best_full is None or step_diff < best_full[0]:
+                    best_full = (step_diff, rra)
+            else:
+                # rrdtool's score - part of requested period archive covers
+                match = (end - start) - (cal_start - start)
+                if (best_partial is None or match > best_partial[0] or
+                        (match == best_partial[0] and step_diff < best_partial[1])):
+                    best_partial = (match, step_diff, rra)
+        if best_full is not None:
+            return best_full[-1]
+        if best_partial is not None:
+            return best_partial[-1]
+        raise ValueError('No %s archive in %s' % (cf, self.filename))
+
+    def coarsest(self, cf, start, end, resolution, last_update=None):
+        """
+        Coarsest `cf` archive which covers whole `start` - `end` period
+        (also when start is aligned to its step) with step not bigger
+        than `resolution` - for graphs the time covered by one pixel, so
+        there is at least one row per pixel. None when there is no such
+        archive.
+        """
+        last_update = self.last_update if last_update is None else last_update
+        best = None
+        for rra in self.rra:
+            if rra.cf != cf or rra.step > resolution:
+                continue
+            cal_end = last_update - last_update % rra.step
+            if cal_end - rra.step * rra.rows > start - start % rra.step:
+                continue
+            if best is None or rra.step > best.step:
+                best = rra
+        return best
+
+    def fetch(self, cf='AVERAGE', start=None, end=None, resolution=1):
+        """
+        Equivalent of `rrdtool fetch` - returns the same structure as
+        rrdtool python bindings: `((start, end, step), ds_names, rows)`
+        where rows is a (time x ds) numpy array (first row corresponds
+        to `start + step`). Unknown values are NaNs.
+        """
+        last_update = self.last_update
+        end = int(time.time()) if end is None else int(end)
+        start = end - 86400 if start is None else int(start)
+        rra = self.select(cf, start, end, resolution=resolution, last_update=last_update)
+        if rra is None:
+            raise ValueError('%s has no %s archive.' % (self.filename, cf))
+        step = rra.step
+        start -= start % step
+        # rrdtool rounds end up to the next step boundary even when it is aligned
+        end += step - end % step
+        rra_end = last_update - last_update % step
+        rra_start = rra_end - step * (rra.rows - 1)
+        # archive row offsets (0 is the oldest row) of requested rows
+        first = (start + step - rra_start) // step
+        count = (end - start) // step
+
+        ring = self.ring(rra)
+        head = (self.cur_row(rra) + 1) % rra.rows
+        if 0 <= first and first + count <= rra.rows:
+            begin = (head + first) % rra.rows
+            if begin + count <= rra.rows:
+                return (start, end, step), self.ds_names, ring[begin:begin + count]
+        rows = numpy.empty((count, len(self.ds)), dtype=float)
+        rows.fill(numpy.nan)
+        offsets = numpy.arange(first, first + count)
+        valid = (offsets >= 0) & (offsets < rra.rows)
+        rows[valid] = ring.take((head + offsets[valid]) % rra.rows, axis=0)
+        return (start, end, step), self.ds_names, rows
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def fetch(filename, cf='AVERAGE', start=None, end=None, resolution=1):
+    """
+    >>> import tempfile
+    >>> from backend import localizable_external as external
+    >>> rrdfile = tempfile.NamedTemporaryFile()
+    >>> parameters = ' --start 920804400'
+    >>> parameters += ' DS:speed:COUNTER:600:U:U'
+    >>> parameters += ' RRA:AVERAGE:0.5:1:24'
+    >>> parameters += ' RRA:AVERAGE:0.5:6:10'
+    >>> external.create(rrdfile.name, parameters)
+    >>> external.update(rrdfile.name, '920804700:12345 920805000:12357 920805300:12363')
+    >>> external.update(rrdfile.name, '920805600:12363 920805900:12363 920806200:12373')
+    >>> external.update(rrdfile.name, '920806500:12383 920806800:12393 920807100:12399')
+    >>> external.update(rrdfile.name, '920807400:12405 920807700:12411 920808000:12415')
+    >>> external.update(rrdfile.name, '920808300:12420 920808600:12422 920808900:12423')
+
+    Results are the same as `rrdtool fetch` returns:
+
+    >>> def rrdtool_fetch(query):
+    ...     lines = external.fetchRaw(rrdfile.name, query).split('\\n')[2:]
+    ...     rows = [line.split(':') for line in lines]
+    ...     return [int(t) for t, v in rows], [float(v) for t, v in rows]
+    >>> for query in [(300, 920804400, 920809200), (1800, 920700000, 920809200)]:
+    ...     resolution, start, end = query
+    ...     (start, end, step), names, rows = fetch(rrdfile.name, 'AVERAGE', start, end, resolution)
+    ...     times, values = rrdtool_fetch('AVERAGE -r %i -s %i -e %i' % query)
+    ...     print step, times == range(start + step, end + step, step), numpy.allclose(
+    ...         values, rows[:, 0], equal_nan=True)
+    300 True True
+    1800 True True
+
+    Graph of the last 5 hours 10 pixels wide reads 30 minutes archive,
+    20 pixels wide would need finer archive which doesn't reach so far:
+
+    >>> with RRDFile(rrdfile.name) as rrd:
+    ...     [rrd.coarsest('AVERAGE', 920790900, 920808900, 18000 // width) for width in (10, 20)]  # doctest: +ELLIPSIS
+    [Archive(index=1, cf='AVERAGE', rows=10, pdp_per_row=6, xff=0.5, step=1800, offset=...), None]
+    """
+    with RRDFile(filename) as rrd:
+        (start, end, step), names, rows = rrd.fetch(cf, start, end, resolution)
+        return (start, end, step), names, numpy.array(rows)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,177 @@
+#-*- coding: utf-8 -*-
+"""
+Render scheduler for servers - identical concurrent requests are
+rendered once and jobs are queued into priority lanes.
+
+* Single-flight - `submit(key, ...)` returns call which is already in
+  flight for the same `key` (every waiter gets the same bytes). Shared
+  call keeps timeout of its first submission and `cancel()` cancels it
+  for all waiters.
+* Lanes - every lane (by default `interactive` and `batch`) has its own
+  bounded pool of threads (`backend.nonblocking.Runner`), so batch work
+  never delays interactive requests for more than its own workers.
+* Backpressure - at most `max_queued` jobs wait in lane. When lane is
+  full `submit` raises `QueueFull` (lanes with `block=True` wait for
+  free slot instead).
+* Timeouts - `timeout` is counted from start of job and kills rrdtool
+  process started by it (`CallTimeout`). Timed out or cancelled job
+  keeps its lane slot until its thread really finishes (work without
+  rrdtool process can't be interrupted).
+
+Queue depth (at every submission) and time spent in queue are recorded
+with `backend.instrumentation` (`scheduler_queue_depth`,
+`scheduler_wait_seconds`, `scheduler_jobs_total{lane, result}`).
+
+>>> import time
+>>> scheduler = Scheduler(lanes={'interactive': Lane(workers=1, max_queued=1)})
+>>> slow = scheduler.submit('slow', time.sleep, 0.3)
+>>> time.sleep(0.1)  # slow job is running
+>>> first = scheduler.submit('sum', lambda a, b: a + b, 1, 2)
+>>> scheduler.submit('sum', lambda a, b: a + b, 1, 2) is first
+True
+>>> scheduler.submit('other', time.sleep, 0)
+Traceback (most recent call last):
+...
+QueueFull: Lane interactive is full (1 queued jobs).
+>>> scheduler.depths()
+{'interactive': (1, 1)}
+>>> first.result()
+3
+>>> scheduler.submit('hung', time.sleep, 1, timeout=0.1).result()
+Traceback (most recent call last):
+...
+CallTimeout: Call timed out after 0.1s.
+>>> scheduler.depths()
+{'interactive': (0, 1)}
+>>> scheduler.close()
+>>> scheduler.depths()
+{'interactive': (0, 0)}
+"""
+import threading
+import time
+
+from pyrrd.exceptions import ExternalCommandError
+
+from . import instrumentation
+from .nonblocking import Runner
+
+
+class QueueFull(ExternalCommandError):
+    pass
+
+
+class Lane(object):
+
+    def __init__(self, workers=4, max_queued=64, block=False):
+        self.workers = workers
+        self.max_queued = max_queued
+        # wait for free slot instead of raising `QueueFull`
+        self.block = block
+        self.queued = 0
+        self.running = 0
+        self.runner = Runner(concurrency=workers)
+        self._slots = threading.Semaphore(workers + max_queued)
+
+
+class _Job(object):
+
+    def __init__(self, scheduler, lane, key, func, args, kwargs):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.time()
+        # both are set under scheduler lock - job is either started or
+        # cancelled while it is queued, never both
+        self.started = self.cancelled = False
+
+    def run(self):
+        with self.scheduler._lock:
+            if self.cancelled:
+                return
+            self.started = True
+            self.lane.queued -= 1
+            self.lane.running += 1
+        instrumentation.observe('scheduler_wait_seconds', time.time() - self.submitted,
+                                lane=self.lane.name)
+        try:
+            return self.func(*self.args, **self.kwargs)
+        finally:
+            # slot is released when thread is really free (timed out
+            # call may still be running)
+            with self.scheduler._lock:
+                self.lane.running -= 1
+            self.lane._slots.release()
+
+    def done(self, call):
+        with self.scheduler._lock:
+            if self.scheduler._calls.get(self.key) is call:
+                del self.scheduler._calls[self.key]
+            if self.started:
+                return
+            # cancelled before it was started
+            self.cancelled = True
+            self.lane.queued -= 1
+        self.lane._slots.release()
+
+
+class Scheduler(object):
+
+    def __init__(self, lanes=None):
+        if lanes is None:
+            lanes = {'interactive': Lane(workers=4), 'batch': Lane(workers=2, block=True)}
+        self.lanes = lanes
+        for name, lane in lanes.items():
+            lane.name = name
+        # key -> call in flight
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queue `func(*args, **kwargs)` in `lane` (keyword, default
+        'interactive') unless call with the same `key` is in flight -
+        returns `backend.nonblocking.Call`.
+        """
+        lane = self.lanes[kwargs.pop('lane', 'interactive')]
+        timeout = kwargs.pop('timeout', None)
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                instrumentation.increment('scheduler_jobs_total', lane=lane.name, result='deduplicated')
+                return call
+        if not lane._slots.acquire(lane.block):
+            instrumentation.increment('scheduler_jobs_total', lane=lane.name, result='rejected')
+            raise QueueFull('Lane %s is full (%i queued jobs).' % (lane.name, lane.queued))
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                # the same job was submitted while we were waiting for slot
+                lane._slots.release()
+                instrumentation.increment('scheduler_jobs_total', lane=lane.name, result='deduplicated')
+                return call
+            job = _Job(self, lane, key, func, args, kwargs)
+            lane.queued += 1
+            instrumentation.observe('scheduler_queue_depth', lane.queued, lane=lane.name)
+            call = lane.runner.submit(job.run, run_timeout=timeout)
+            self._calls[key] = call
+        instrumentation.increment('scheduler_jobs_total', lane=lane.name, result='submitted')
+        call.add_done_callback(job.done)
+        return call
+
+    def depths(self):
+        """`{lane: (queued, running)}`"""
+        with self._lock:
+            return dict((name, (lane.queued, lane.running)) for name, lane in self.lanes.items())
+
+    def close(self):
+        """Wait for queued jobs and stop lane threads"""
+        for lane in self.lanes.values():
+            lane.runner.close()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
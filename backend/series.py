@@ -0,0 +1,125 @@
+#-*- coding: utf-8 -*-
+# numpy is imported on first use - it takes most of import time of
+# backends, which graph rendering doesn't need
+
+
+class FetchResult(object):
+    """
+    Columnar result of fetch: `time` is int64 array of timestamps and
+    `columns` maps ds name to float64 array of values (NaN for unknown).
+
+    Old pyrrd result format is still available (and built on first
+    access) through `result["ds"]` (ds name -> list of (time, value))
+    and `result["time"]` (time -> {ds name: value}) - with the same
+    content as before: unknown values are None and the first row is
+    skipped (as old parser of `rrdtool fetch` output did) - backends
+    pass `compat_offset=1`.
+
+    >>> result = FetchResult.parse('speed\\n\\n 920805000: 4.0000000000e-02\\n 920805300: -nan\\n')
+    >>> result.step, result.start, result.end
+    (300, 920804700, 920805300)
+    >>> result.time
+    array([920805000, 920805300])
+    >>> result.columns['speed']
+    array([0.04,  nan])
+    >>> result["ds"]["speed"]
+    [(920805300, None)]
+    """
+
+    def __init__(self, start, end, step, time, columns, ds_names=None, compat_offset=0):
+        self.start = start
+        self.end = end
+        self.step = step
+        self.time = time
+        self.columns = columns
+        self.ds_names = ds_names if ds_names is not None else sorted(columns)
+        # rows skipped by `ds` and `time` views
+        self.compat_offset = compat_offset
+        self._ds = self._by_time = None
+
+    @classmethod
+    def from_rows(cls, (start, end, step), ds_names, rows, compat_offset=0):
+        """Build result from (rrdtool bindings like) fetch output"""
+        import numpy
+        rows = numpy.asarray(rows, dtype=numpy.float64).reshape(-1, len(ds_names))
+        time = numpy.arange(start + step, start + step * (len(rows) + 1), step, dtype=numpy.int64)
+        columns = dict((name, rows[:, i]) for i, name in enumerate(ds_names))
+        return cls(start, end, step, time, columns, ds_names=list(ds_names),
+                   compat_offset=compat_offset)
+
+    @classmethod
+    def parse(cls, output):
+        """
+        Parse `rrdtool fetch` output in one pass - header line contains
+        ds names and every following line `time: value value...`.
+
+        Captured `rrdtool fetch speed.rrd AVERAGE --start 920804400
+        --end 920809200` output (see `localizable_external.fetch`):
+
+        >>> output = ('''                          speed
+        ...
+        ... 920804700: -nan
+        ... 920805000: 4.0000000000e-02
+        ... 920805300: 2.0000000000e-02
+        ... 920805600: 0.0000000000e+00
+        ... ''')
+        >>> result = FetchResult.parse(output)
+        >>> result.time[0], result.columns['speed'][0], result.step
+        (920804700, nan, 300)
+        >>> result["ds"]["speed"]
+        [(920805000, 0.04), (920805300, 0.02), (920805600, 0.0)]
+        >>> sorted(result["time"])[0], result["time"][920805000]
+        (920805000, {'speed': 0.04})
+        """
+        import numpy
+        header, _, body = output.strip('\n').partition('\n')
+        ds_names = header.split()
+        data = numpy.fromstring(body.replace(':', ' '), sep=' ').reshape(-1, len(ds_names) + 1)
+        time = data[:, 0].astype(numpy.int64)
+        values = data[:, 1:].T.copy()
+        step = int(time[1] - time[0]) if len(time) > 1 else 0
+        start = int(time[0]) - step if len(time) else None
+        end = int(time[-1]) if len(time) else None
+        columns = dict(zip(ds_names, values))
+        # old (pyrrd) parser dropped the first row - compat views keep doing it
+        return cls(start, end, step, time, columns, ds_names=ds_names, compat_offset=1)
+
+    def __len__(self):
+        return len(self.time)
+
+    def _compat_columns(self):
+        """Times and value lists of compat views (unknown values are None)"""
+        skip = self.compat_offset
+        columns = [[None if v != v else v for v in self.columns[name][skip:].tolist()]
+                   for name in self.ds_names]
+        return self.time[skip:].tolist(), columns
+
+    @property
+    def ds(self):
+        if self._ds is None:
+            time, columns = self._compat_columns()
+            self._ds = dict((name, zip(time, values)) for name, values in zip(self.ds_names, columns))
+        return self._ds
+
+    @property
+    def by_time(self):
+        if self._by_time is None:
+            time, columns = self._compat_columns()
+            self._by_time = dict((t, dict(zip(self.ds_names, values)))
+                                 for t, values in zip(time, zip(*columns)))
+        return self._by_time
+
+    def keys(self):
+        return ["ds", "time"]
+
+    def __getitem__(self, key):
+        if key == "ds":
+            return self.ds
+        if key == "time":
+            return self.by_time
+        raise KeyError(key)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,151 @@
+#-*- coding: utf-8 -*-
+"""
+In memory cache of fetched series for clients which poll `fetch`.
+
+Entries are keyed by (rrd file, consolidation function, archive step).
+rrd data only grows at the end, so repeated requests read only rows
+after the last complete cached row (row which contains last update is
+still being consolidated and is re-read every time). Entries are
+dropped when last update of file goes backwards or file structure
+changes, least recently used entries are evicted when number of
+entries or size of cached arrays exceeds limits.
+
+Archive step and last update are read from file header
+(`backend.rrdfile`), data is read with backend `fetch` (or native
+reader - `SeriesCache(reader=native_reader)`).
+
+>>> import tempfile
+>>> from backend import localizable_external as external
+>>> rrdfile = tempfile.NamedTemporaryFile()
+>>> external.create(rrdfile.name, '--start 920804400 DS:speed:COUNTER:600:U:U RRA:AVERAGE:0.5:1:24')
+>>> external.update(rrdfile.name, '920804700:12345 920805000:12357 920805300:12363')
+>>> cache = SeriesCache(debug=True)
+>>> result = cache.fetch(rrdfile.name, 'AVERAGE', 920804400, 920806200)
+>>> result.time[-1], result.columns['speed'][2]
+(920806200, 0.02)
+>>> external.update(rrdfile.name, '920805600:12363 920805900:12363 920806200:12373')
+>>> cache.fetch(rrdfile.name, 'AVERAGE', 920804400, 920806200).columns['speed'][-1]
+0.03333333333333333
+>>> cache.reads
+[(920804400, 920806200), (920805300, 920806200)]
+"""
+import collections
+import threading
+import time
+
+import numpy
+
+from . import get_backend, rrdfile
+from .series import FetchResult
+
+
+def backend_reader(backend='external'):
+    """Reader which calls `fetch` of given backend"""
+    module = get_backend(backend)
+
+    def read(filename, cf, start, end, resolution):
+        return module.fetch(filename, [cf, '--start', str(start), '--end', str(end),
+                                       '--resolution', str(resolution)])
+    return read
+
+
+def native_reader(filename, cf, start, end, resolution):
+    return FetchResult.from_rows(*rrdfile.fetch(filename, cf, start, end, resolution))
+
+
+class _Entry(object):
+
+    def __init__(self, signature, last_update, ds_names, time, values):
+        self.signature = signature
+        self.last_update = last_update
+        self.ds_names = ds_names
+        self.time = time
+        self.values = values
+        # cached arrays are shared by results
+        self.time.flags.writeable = self.values.flags.writeable = False
+
+    @property
+    def size(self):
+        return self.time.nbytes + self.values.nbytes
+
+
+class SeriesCache(object):
+
+    def __init__(self, reader=None, max_entries=256, max_size=64 * 1024 * 1024, debug=False):
+        self.reader = reader if reader is not None else backend_reader()
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # (start, end) of every read - for tests and debugging
+        self.reads = [] if debug else None
+
+    def _read(self, filename, cf, start, end, step):
+        if self.reads is not None:
+            self.reads.append((start, end))
+        result = self.reader(filename, cf, start, end, step)
+        values = numpy.column_stack([result.columns[name] for name in result.ds_names])
+        return list(result.ds_names), result.time, values.reshape(len(result.time), -1)
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self.size += entry.size
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_size):
+            self.size -= self._entries.popitem(last=False)[1].size
+
+    def invalidate(self, filename=None):
+        with self._lock:
+            for key in list(self._entries):
+                if filename is None or key[0] == filename:
+                    self.size -= self._entries.pop(key).size
+
+    def fetch(self, filename, cf='AVERAGE', start=None, end=None, resolution=1):
+        """The same as backend `fetch` with `cf`, `start`, `end` and `resolution`"""
+        end = int(time.time()) if end is None else int(end)
+        start = end - 86400 if start is None else int(start)
+        with rrdfile.RRDFile(filename) as rrd:
+            last_update = rrd.last_update
+            step = rrd.select(cf, start, end, resolution, last_update=last_update).step
+            signature = (rrd.step, tuple(rrd.ds_names),
+                         tuple((a.cf, a.rows, a.pdp_per_row) for a in rrd.rra))
+        start -= start % step
+        end += -end % step
+        # rows after this one are still consolidated (or unknown yet)
+        complete = last_update - last_update % step
+        key = (filename, cf, step)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+                if (entry.signature != signature or entry.last_update > last_update or
+                        not len(entry.time) or entry.time[0] > start + step):
+                    entry = None
+            if entry is None:
+                ds_names, times, values = self._read(filename, cf, start, end, step)
+            elif end > entry.time[-1]:
+                ds_names, tail_times, tail_values = self._read(filename, cf, int(entry.time[-1]),
+                                                               end, step)
+                if ds_names != entry.ds_names:
+                    ds_names, times, values = self._read(filename, cf, start, end, step)
+                else:
+                    times = numpy.concatenate([entry.time, tail_times[tail_times > entry.time[-1]]])
+                    values = numpy.concatenate([entry.values, tail_values[tail_times > entry.time[-1]]])
+            else:
+                ds_names, times, values = entry.ds_names, entry.time, entry.values
+            if entry is not None and times is entry.time:
+                self._store(key, entry)
+            else:
+                # keep complete rows of requested window
+                stored = (times > start) & (times <= complete)
+                self._store(key, _Entry(signature, last_update, ds_names, times[stored],
+                                        values[stored]))
+        selected = (times > start) & (times <= end)
+        times, values = times[selected], values[selected]
+        columns = dict((name, values[:, i]) for i, name in enumerate(ds_names))
+        return FetchResult(start, end, step, times, columns, ds_names=ds_names)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,352 @@
+#-*- coding: utf-8 -*-
+"""
+Declarative graph specifications.
+
+`GraphSpec` collects DEF/CDEF/VDEF and graph elements (rrd files are
+given relative to plugin directory) and compiles them into `Template`:
+definitions which are not used by any graph element are pruned,
+duplicated DEFs (same file, ds and consolidation function) are merged
+and all arguments are serialized once. Rendering template for given
+plugin directory only fills rrd paths in.
+
+>>> spec = GraphSpec(vertical_label='"Load"')
+>>> spec.series('load', 'load.rrd', 'shortterm')
+>>> spec.define('load2_avg', 'load.rrd', 'shortterm', 'AVERAGE')
+>>> spec.calculate('load_neg', 'load2_avg,-1,*')
+>>> spec.line('load_neg', '#ff0000', legend='Load')
+>>> spec.summary('load', 'load_min', 'load_avg', 'load_max',
+...              ['%4.1lf Min', '%4.1lf Avg', '%4.1lf Max', '%4.1lf Last'])
+>>> template = spec.compile()
+>>> for argument in template.render('/var/lib/collectd/rrd/host/load'):
+...     print argument
+DEF:load_min=/var/lib/collectd/rrd/host/load/load.rrd:shortterm:MIN
+DEF:load_avg=/var/lib/collectd/rrd/host/load/load.rrd:shortterm:AVERAGE
+DEF:load_max=/var/lib/collectd/rrd/host/load/load.rrd:shortterm:MAX
+CDEF:load_neg=load_avg,-1,*
+VDEF:load_min_var=load_min,MINIMUM
+VDEF:load_avg_var=load_avg,AVERAGE
+VDEF:load_max_var=load_max,MAXIMUM
+VDEF:load_last_var=load_avg,LAST
+LINE1:load_neg#ff0000:"Load"
+GPRINT:load_min_var:"%4.1lf Min"
+GPRINT:load_avg_var:"%4.1lf Avg"
+GPRINT:load_max_var:"%4.1lf Max"
+GPRINT:load_last_var:"%4.1lf Last"
+>>> template.options
+{'vertical_label': '"Load"'}
+>>> template.series
+[('load.rrd', u'shortterm', u'AVERAGE'), ('load.rrd', u'shortterm', u'MAX'), ('load.rrd', u'shortterm', u'MIN')]
+"""
+import copy
+import os
+
+# graph options which make no sense without axes and legend
+thumbnail_skipped_options = ['vertical_label', 'y_grid', 'units_exponent']
+
+
+def _escape_colons(value):
+    return value.replace(u':', u'\\:')
+
+
+class Argument(unicode):
+    """Serialized DEF which remembers rrd file it reads"""
+
+    def __new__(cls, value, rrdfile):
+        argument = super(Argument, cls).__new__(cls, value)
+        argument.rrdfile = rrdfile
+        return argument
+
+
+class Def(object):
+
+    def __init__(self, vname, rrdfile, ds, cf):
+        self.vname = vname
+        self.rrdfile = rrdfile
+        self.ds = ds
+        self.cf = cf
+        self.uses = []
+
+    @property
+    def key(self):
+        return (self.rrdfile, self.ds, self.cf)
+
+    def serialize(self, aliases):
+        # rrd file path is filled in by `Template.render`
+        return (u'DEF:%s=' % self.vname, self.rrdfile, u':%s:%s' % (self.ds, self.cf))
+
+
+class CDef(object):
+    abbr = u'CDEF'
+
+    def __init__(self, vname, rpn):
+        self.vname = vname
+        self.rpn = rpn
+        self.uses = rpn.split(',')
+
+    def serialize(self, aliases):
+        rpn = u','.join(aliases.get(token, token) for token in self.uses)
+        return u'%s:%s=%s' % (self.abbr, self.vname, rpn)
+
+
+class VDef(CDef):
+    abbr = u'VDEF'
+
+
+class Line(object):
+    abbr = u'LINE'
+
+    def __init__(self, vname, color, legend='', width=1, stack=False):
+        self.vname = vname
+        self.color = color
+        self.legend = legend
+        self.width = width
+        self.stack = stack
+        self.uses = [vname]
+
+    def serialize(self, aliases):
+        argument = u'%s%s:%s%s' % (self.abbr, self.width or u'', aliases.get(self.vname, self.vname),
+                                   self.color or u'')
+        if self.legend:
+            argument += u':"%s"' % self.legend
+        elif self.stack:
+            argument += u':'
+        if self.stack:
+            argument += u':STACK'
+        return argument
+
+
+class Area(Line):
+    abbr = u'AREA'
+
+    def __init__(self, vname, color, legend='', stack=False):
+        super(Area, self).__init__(vname, color, legend=legend, width=None, stack=stack)
+
+
+class GPrint(object):
+
+    def __init__(self, vname, format):
+        self.vname = vname
+        self.format = format
+        self.uses = [vname]
+
+    def serialize(self, aliases):
+        return u'GPRINT:%s:"%s"' % (aliases.get(self.vname, self.vname), _escape_colons(self.format))
+
+
+class HRule(object):
+
+    def __init__(self, value, color, legend=''):
+        self.value = value
+        self.color = color
+        self.legend = legend
+        self.uses = []
+
+    def serialize(self, aliases):
+        argument = u'HRULE:%s%s' % (self.value, self.color)
+        if self.legend:
+            argument += u':"%s"' % self.legend
+        return argument
+
+
+class XPort(object):
+
+    def __init__(self, vname, legend):
+        self.vname = vname
+        self.legend = legend
+        self.uses = [vname]
+
+    def serialize(self, aliases):
+        return u'XPORT:%s:"%s"' % (aliases.get(self.vname, self.vname), _escape_colons(self.legend))
+
+
+class Template(object):
+    """
+    Compiled spec - list of serialized arguments (DEFs are kept as
+    (prefix, relative rrd file, suffix) triples) and graph options.
+    """
+
+    def __init__(self, arguments, options):
+        self.arguments = arguments
+        self.options = options
+
+    @property
+    def rrdfiles(self):
+        """rrd files (relative to plugin directory) used by this graph"""
+        return sorted(set(a[1] for a in self.arguments if isinstance(a, tuple)))
+
+    @property
+    def series(self):
+        """`(rrd file, ds, consolidation function)` read by this graph"""
+        return sorted(set((a[1],) + tuple(a[2].split(':')[1:3])
+                          for a in self.arguments if isinstance(a, tuple)))
+
+    def render(self, plugin_dir):
+        rendered = []
+        for argument in self.arguments:
+            if isinstance(argument, tuple):
+                prefix, rrdfile, suffix = argument
+                rrdfile = os.path.join(plugin_dir, rrdfile)
+                argument = Argument(prefix + rrdfile + suffix, rrdfile)
+            rendered.append(argument)
+        return rendered
+
+
+class GraphSpec(object):
+
+    def __init__(self, **options):
+        self.options = options
+        self.definitions = []
+        self.elements = []
+        # (name, min vname, avg vname, max vname) of every summary
+        self.summaries = []
+
+    def define(self, vname, rrdfile, ds, cf='AVERAGE'):
+        self.definitions.append(Def(vname, rrdfile, ds, cf))
+
+    def series(self, name, rrdfile, ds):
+        """`<name>_min`, `<name>_avg` and `<name>_max` DEFs"""
+        for suffix, cf in [('min', 'MIN'), ('avg', 'AVERAGE'), ('max', 'MAX')]:
+            self.define('%s_%s' % (name, suffix), rrdfile, ds, cf)
+
+    def calculate(self, vname, rpn):
+        self.definitions.append(CDef(vname, rpn))
+
+    def variable(self, vname, rpn):
+        self.definitions.append(VDef(vname, rpn))
+
+    def line(self, vname, color, legend='', width=1, stack=False):
+        self.elements.append(Line(vname, color, legend=legend, width=width, stack=stack))
+
+    def area(self, vname, color, legend='', stack=False):
+        self.elements.append(Area(vname, color, legend=legend, stack=stack))
+
+    def gprint(self, vname, format):
+        self.elements.append(GPrint(vname, format))
+
+    def hrule(self, value, color, legend=''):
+        self.elements.append(HRule(value, color, legend=legend))
+
+    def summary(self, name, min_vname, avg_vname, max_vname, formats):
+        """Min, Avg, Max and Last VDEFs printed with given four formats"""
+        self.summaries.append((name, min_vname, avg_vname, max_vname))
+        variables = [('min', min_vname, 'MINIMUM'), ('avg', avg_vname, 'AVERAGE'),
+                     ('max', max_vname, 'MAXIMUM'), ('last', avg_vname, 'LAST')]
+        for (suffix, vname, function), format in zip(variables, formats):
+            variable = '%s_%s_var' % (name, suffix)
+            self.variable(variable, '%s,%s' % (vname, function))
+            self.gprint(variable, format)
+
+    def compile(self):
+        return self._compile(self.definitions, self.elements, self.options)
+
+    def export(self):
+        """
+        Template for `rrdtool xport` - every series drawn with legend is
+        exported (once) with that legend as label.
+
+        >>> spec = GraphSpec()
+        >>> spec.define('a', 'a.rrd', 'value')
+        >>> spec.define('b', 'a.rrd', 'value')
+        >>> spec.calculate('bits', 'b,8,*')
+        >>> spec.area('bits', '#b7efb7')
+        >>> spec.line('bits', '#00e000', legend='Incoming\\:  ')
+        >>> spec.export().render('/host/interface')
+        [u'DEF:a=/host/interface/a.rrd:value:AVERAGE', u'CDEF:bits=a,8,*', u'XPORT:bits:"Incoming"']
+        """
+        elements = []
+        exported = set()
+        for element in self.elements:
+            if isinstance(element, Line) and element.legend and element.vname not in exported:
+                exported.add(element.vname)
+                legend = element.legend.replace('\\:', '').strip()
+                elements.append(XPort(element.vname, legend))
+        return self._compile(self.definitions, elements, {})
+
+    def report(self):
+        """
+        Template for `rrdtool xport` of summarized series - every summary
+        is exported as `<name>_min`, `<name>_avg` and `<name>_max`
+        columns (series which its Min, Avg and Max VDEFs read).
+
+        >>> spec = GraphSpec()
+        >>> spec.series('rx', 'if_octets.rrd', 'rx')
+        >>> spec.calculate('rx_max_bits', 'rx_max,8,*')
+        >>> spec.line('rx_max_bits', '#00e000', legend='Incoming')
+        >>> spec.summary('rx_bits', 'rx_min', 'rx_avg', 'rx_max_bits', ['%4.1lf'] * 4)
+        >>> for argument in spec.report().render('/host/interface'):
+        ...     print argument
+        DEF:rx_min=/host/interface/if_octets.rrd:rx:MIN
+        DEF:rx_avg=/host/interface/if_octets.rrd:rx:AVERAGE
+        DEF:rx_max=/host/interface/if_octets.rrd:rx:MAX
+        CDEF:rx_max_bits=rx_max,8,*
+        XPORT:rx_min:"rx_bits_min"
+        XPORT:rx_avg:"rx_bits_avg"
+        XPORT:rx_max_bits:"rx_bits_max"
+        """
+        elements = []
+        for name, min_vname, avg_vname, max_vname in self.summaries:
+            for suffix, vname in [('min', min_vname), ('avg', avg_vname), ('max', max_vname)]:
+                elements.append(XPort(vname, '%s_%s' % (name, suffix)))
+        return self._compile(self.definitions, elements, {})
+
+    def thumbnail(self):
+        """
+        Template for tiny graph without legends (`--only-graph`) - GPRINTs
+        (and so VDEFs) are dropped and all DEFs read AVERAGE (DEFs which
+        differed only by consolidation function are merged).
+
+        >>> spec = GraphSpec(vertical_label='"Load"', upper_limit=5)
+        >>> spec.series('load', 'load.rrd', 'shortterm')
+        >>> spec.area('load_max', '#b7b7f7')
+        >>> spec.line('load_avg', '#0000ff', legend='Load')
+        >>> spec.summary('load', 'load_min', 'load_avg', 'load_max', ['%4.1lf'] * 4)
+        >>> template = spec.thumbnail()
+        >>> template.render('/host/load')
+        [u'DEF:load_min=/host/load/load.rrd:shortterm:AVERAGE', u'AREA:load_min#b7b7f7', u'LINE1:load_min#0000ff']
+        >>> sorted(template.options.items())
+        [('only_graph', True), ('upper_limit', 5)]
+        """
+        definitions = [Def(d.vname, d.rrdfile, d.ds, 'AVERAGE') if isinstance(d, Def) else d
+                       for d in self.definitions]
+        elements = []
+        for element in self.elements:
+            if isinstance(element, GPrint):
+                continue
+            element = copy.copy(element)
+            element.legend = ''
+            elements.append(element)
+        options = dict((k, v) for k, v in self.options.items() if k not in thumbnail_skipped_options)
+        options['only_graph'] = True
+        return self._compile(definitions, elements, options)
+
+    def _compile(self, definitions, elements, options):
+        # merge duplicated DEFs
+        aliases = {}
+        canonical = {}
+        merged = []
+        for definition in definitions:
+            if isinstance(definition, Def):
+                if definition.key in canonical:
+                    aliases[definition.vname] = canonical[definition.key]
+                    continue
+                canonical[definition.key] = definition.vname
+            merged.append(definition)
+        definitions = merged
+        # prune definitions which graph elements don't depend on
+        by_vname = dict((d.vname, d) for d in definitions)
+        used = set()
+        pending = [aliases.get(v, v) for e in elements for v in e.uses]
+        while pending:
+            vname = pending.pop()
+            if vname in used or vname not in by_vname:
+                continue
+            used.add(vname)
+            pending.extend(aliases.get(v, v) for v in by_vname[vname].uses)
+        arguments = [d.serialize(aliases) for d in definitions if d.vname in used]
+        arguments.extend(e.serialize(aliases) for e in elements)
+        return Template(arguments, dict(options))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
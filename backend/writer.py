@@ -0,0 +1,150 @@
+#-*- coding: utf-8 -*-
+"""
+Buffered rrd updates for replaying and backfilling data.
+
+`Writer` collects `(timestamp, values)` samples per rrd file and
+writes them with as few `update` calls as possible - every call gets
+chunk of at most `max_samples` samples and `max_length` bytes of
+arguments (older rrdtool remote control mode, used by persistent
+`localizable_external` pool, doesn't accept longer lines). Files are
+written in parallel by `workers` threads, chunks of one file are
+written in order. Failed chunk doesn't stop other chunks (rrdtool
+applies samples which precede invalid one) - `UpdateError` for every
+failed chunk is returned by `flush()`.
+
+>>> import tempfile
+>>> from backend import localizable_external as external
+>>> rrdfile = tempfile.NamedTemporaryFile()
+>>> external.create(rrdfile.name, '--start 920804400 DS:speed:COUNTER:600:U:U RRA:AVERAGE:0.5:1:24')
+>>> writer = Writer(max_samples=2)
+>>> writer.extend(rrdfile.name, [(920804700, 12345), (920805000, 12357), (920805300, None)])
+>>> writer.add(rrdfile.name, 920805000, [12363])
+>>> writer.pending
+4
+>>> for error in writer.flush():
+...     print error.filename == rrdfile.name, error.first, error.last, error.samples
+True 920805300 920805000 2
+>>> writer.pending
+0
+"""
+import math
+import threading
+
+from pyrrd.exceptions import ExternalCommandError
+
+from . import get_backend, instrumentation, nonblocking
+from .localizable_external import Arguments
+
+
+class UpdateError(ExternalCommandError):
+    """Failed chunk - `first` and `last` are timestamps of its samples"""
+
+    def __init__(self, filename, first, last, samples, error):
+        super(UpdateError, self).__init__('%s (%i - %i): %s' % (filename, first, last, error))
+        self.filename = filename
+        self.first = first
+        self.last = last
+        self.samples = samples
+        self.error = error
+
+
+def _value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'U'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_sample(timestamp, values):
+    """
+    >>> format_sample(920804700, [1, 0.5, None, float('nan'), 'U'])
+    '920804700:1:0.5:U:U:U'
+    """
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    return '%i:%s' % (timestamp, ':'.join(_value(v) for v in values))
+
+
+class Writer(object):
+
+    def __init__(self, backend='external', workers=4, max_samples=1000, max_length=8000,
+                 flush_size=100000, env=None):
+        self.backend = get_backend(backend)
+        # rrdtool library (getopt) isn't thread safe - bindings are called from one thread
+        self.workers = 1 if backend == 'bindings' else workers
+        self.max_samples = max_samples
+        self.max_length = max_length
+        # pending samples count which triggers `flush()` in `add`
+        self.flush_size = flush_size
+        self.env = env
+        self.errors = []
+        self.pending = 0
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, filename, timestamp, values):
+        with self._lock:
+            self._samples.setdefault(filename, []).append((int(timestamp), format_sample(timestamp, values)))
+            self.pending += 1
+        if self.flush_size is not None and self.pending >= self.flush_size:
+            self.flush()
+
+    def extend(self, filename, samples):
+        for timestamp, values in samples:
+            self.add(filename, timestamp, values)
+
+    def chunks(self, samples):
+        """Split `[(timestamp, formatted sample)]` into argument bounded chunks"""
+        chunk, length = [], 0
+        for sample in samples:
+            if chunk and (len(chunk) >= self.max_samples or
+                          length + len(sample[1]) + 1 > self.max_length):
+                yield chunk
+                chunk, length = [], 0
+            chunk.append(sample)
+            length += len(sample[1]) + 1
+        if chunk:
+            yield chunk
+
+    def _write(self, filename, samples):
+        errors = []
+        for chunk in self.chunks(samples):
+            try:
+                self.backend.update(filename, Arguments(s for t, s in chunk), env=self.env)
+            except ExternalCommandError as e:
+                instrumentation.increment('update_samples_total', len(chunk), result='error')
+                errors.append(UpdateError(filename, chunk[0][0], chunk[-1][0], len(chunk), e))
+            else:
+                instrumentation.increment('update_samples_total', len(chunk), result='ok')
+        return errors
+
+    def flush(self):
+        """Write all pending samples - returns `UpdateError`s of failed chunks"""
+        with self._lock:
+            pending, self._samples = self._samples, {}
+            self.pending = 0
+        if not pending:
+            return []
+        runner = nonblocking.Runner(concurrency=self.workers)
+        try:
+            calls = [runner.submit(self._write, filename, samples)
+                     for filename, samples in sorted(pending.items())]
+            errors = []
+            for call in calls:
+                errors.extend(call.result())
+        finally:
+            runner.close()
+        self.errors.extend(errors)
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
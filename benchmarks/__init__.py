@@ -0,0 +1,9 @@
+"""
+Benchmarks - `synthetic` generates collectd like rrd tree, `run`
+measures graph latency, rrdtool spawn overhead, fetch throughput and
+batch throughput and writes results as JSON:
+
+    $ python -m benchmarks.synthetic --root /tmp/bench --hosts 4 --days 90
+    $ python -m benchmarks.run --root /tmp/bench --output external.json
+    $ python -m benchmarks.run --root /tmp/bench --pool --output pool.json
+"""
@@ -0,0 +1,198 @@
+"""
+Run benchmarks against collectd rrd tree (see `benchmarks.synthetic`)
+and write results as JSON:
+
+* `graph_latency` - `graphs.graph()` duration per plugin and period,
+* `spawn_overhead` - `_cmd` duration with new rrdtool process per call
+  and with persistent process pool,
+* `fetch` - rows per second and peak memory of backend `fetch()` and
+  of native `RRDFile.fetch()` (measured in child processes),
+* `batch` - graphs per second of `graphs.batch()` for whole tree.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from subprocess import Popen, PIPE
+
+import graphs
+from backend import get_backend
+from backend import localizable_external as external
+from backend.rrdfile import RRDFile
+
+
+def timed(func, *args, **kwargs):
+    started = time.time()
+    func(*args, **kwargs)
+    return time.time() - started
+
+
+def stats(durations):
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'mean': sum(durations) / len(durations),
+        'max': durations[-1],
+    }
+
+
+def _instances(root):
+    """First host's plugin instances - one per plugin"""
+    instances = {}
+    for host, instance, plugin, plugin_dir in graphs.discover(root):
+        instances.setdefault(plugin, plugin_dir)
+    return instances
+
+
+def graph_latency(root, end, repeat=5, backend=None):
+    results = {}
+    for plugin, plugin_dir in sorted(_instances(root).items()):
+        for period, days in sorted(graphs.periods.items()):
+            start = end - datetime.timedelta(days=days)
+            durations = [timed(graphs.graph, plugin, plugin_dir, start, end, backend=backend)
+                         for i in range(repeat)]
+            results.setdefault(plugin, {})[period] = stats(durations)
+    return results
+
+
+def spawn_overhead(rrdfile, repeat=50):
+    pool = external.pool
+    external.pool = None
+    try:
+        spawn = [timed(external._cmd, 'info', [rrdfile], None) for i in range(repeat)]
+        persistent = external.Pool(1)
+        external.pool = persistent
+        external._cmd('info', [rrdfile], None)
+        pooled = [timed(external._cmd, 'info', [rrdfile], None) for i in range(repeat)]
+        persistent.close()
+    finally:
+        external.pool = pool
+    spawn, pooled = stats(spawn), stats(pooled)
+    return {'spawn': spawn, 'pool': pooled, 'overhead': spawn['median'] - pooled['median']}
+
+
+def _fetch(args):
+    reader, rrdfile, start, end, repeat, backend = args
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    durations = []
+    for i in range(repeat):
+        started = time.time()
+        if reader == 'native':
+            with RRDFile(rrdfile) as rrd:
+                rows = len(rrd.fetch('AVERAGE', start, end)[2])
+        else:
+            query = ['AVERAGE', '--start', str(start), '--end', str(end)]
+            rows = len(get_backend(backend).fetch(rrdfile, query))
+        durations.append(time.time() - started)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rows, durations, baseline, peak
+
+
+def fetch_throughput(rrdfile, end, repeat=20, backend='external'):
+    results = {}
+    end = graphs.utctimestamp(end)
+    for period, days in sorted(graphs.periods.items()):
+        for reader in ['backend', 'native']:
+            # fresh process per measurement - ru_maxrss is peak of process lifetime
+            pool = multiprocessing.Pool(1)
+            try:
+                rows, durations, baseline, peak = pool.apply(
+                    _fetch, [(reader, rrdfile, end - days * 86400, end, repeat, backend)])
+            finally:
+                pool.close()
+                pool.join()
+            results.setdefault(period, {})[reader] = {
+                'rows': rows,
+                'duration': stats(durations),
+                'rows_per_second': rows * len(durations) / sum(durations),
+                'baseline_rss_kb': baseline,
+                'peak_rss_kb': peak,
+            }
+    return results
+
+
+def batch_throughput(root, end, workers=None, backend=None):
+    output_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        started = time.time()
+        results = list(graphs.batch(root, output_dir, end, workers=workers, backend=backend))
+        duration = time.time() - started
+    finally:
+        shutil.rmtree(output_dir)
+    return {
+        'graphs': len(results),
+        'failed': len([r for r in results if r[2] is not None]),
+        'duration': duration,
+        'graphs_per_second': len(results) / duration,
+        'graph_duration': stats([r[1] for r in results]),
+    }
+
+
+def rrdtool_version():
+    try:
+        output = Popen(['rrdtool'], stdout=PIPE, stderr=PIPE).communicate()[0]
+    except OSError:
+        return None
+    return output.splitlines()[0] if output else None
+
+
+benchmarks = ['graph_latency', 'spawn_overhead', 'fetch', 'batch']
+
+
+def run(root, selected=benchmarks, repeat=5, workers=None, backend=None, pool=False):
+    end = datetime.datetime.utcfromtimestamp(time.time())
+    results = {
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'rrdtool': rrdtool_version(),
+            'backend': backend or 'external',
+            'pool': pool,
+            'workers': workers or multiprocessing.cpu_count(),
+        },
+        'started': time.time(),
+    }
+    rrdfile = os.path.join(_instances(root)['interface'], 'if_octets.rrd')
+    if 'graph_latency' in selected:
+        results['graph_latency'] = graph_latency(root, end, repeat=repeat, backend=backend)
+    if 'spawn_overhead' in selected:
+        results['spawn_overhead'] = spawn_overhead(rrdfile, repeat=repeat * 10)
+    if 'fetch' in selected:
+        results['fetch'] = fetch_throughput(rrdfile, end, repeat=repeat * 4,
+                                            backend=backend or 'external')
+    if 'batch' in selected:
+        results['batch'] = batch_throughput(root, end, workers=workers, backend=backend)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--root', required=True, help='collectd rrd tree (see benchmarks.synthetic)')
+    parser.add_argument('-o', '--output', help='JSON results file (default: stdout)')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('--pool', action='store_true', default=False,
+                        help='use persistent rrdtool processes (external backend)')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('-w', '--workers', type=int, help='batch worker processes (default: cpu count)')
+    parser.add_argument('--only', nargs='+', choices=benchmarks, default=benchmarks)
+    args = parser.parse_args()
+    if args.pool:
+        external.start_pool()
+    results = run(args.root, selected=args.only, repeat=args.repeat, workers=args.workers,
+                  backend=args.backend, pool=args.pool)
+    output = open(args.output, 'w') if args.output is not None else sys.stdout
+    try:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
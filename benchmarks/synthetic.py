@@ -0,0 +1,150 @@
+"""
+Synthetic collectd rrd tree:
+
+    <root>/host-000/{cpu-N,load,memory,interface-<if>,disk-<disk>}/*.rrd
+
+Files use collectd types (DERIVE counters for cpu, interface and disk,
+GAUGE for load and memory) and RRAs which collectd creates by default
+(`RRARows 1200`, default `RRATimespan`s, AVERAGE, MIN and MAX). Data
+follows daily cycle with noise and is filled for `days` up to `end`.
+"""
+import argparse
+import math
+import os
+import time
+
+import numpy
+
+from backend import localizable_external as external
+
+# collectd defaults (src/utils_rrdcreate.c)
+rra_timespans = [3600, 86400, 7 * 86400, 31 * 86400, 366 * 86400]
+rra_types = ['AVERAGE', 'MIN', 'MAX']
+
+counter = ('DERIVE', '0', 'U')
+gauge = ('GAUGE', '0', 'U')
+
+# plugin -> [(rrd file, [(ds, type), ...], scale)]
+plugins = {
+    'cpu': [('cpu-%s.rrd' % state, [('value', counter)], scale)
+            for state, scale in [('user', 30), ('system', 10), ('wait', 5), ('idle', 55)]],
+    'load': [('load.rrd', [('shortterm', gauge), ('midterm', gauge), ('longterm', gauge)], 2)],
+    'memory': [('memory-%s.rrd' % name, [('value', gauge)], scale)
+               for name, scale in [('used', 2e9), ('buffered', 2e8), ('cached', 4e9), ('free', 1e9)]],
+    'interface': [('if_octets.rrd', [('rx', counter), ('tx', counter)], 1e6),
+                  ('if_packets.rrd', [('rx', counter), ('tx', counter)], 1e3),
+                  ('if_errors.rrd', [('rx', counter), ('tx', counter)], 0.01)],
+    'disk': [('disk_octets.rrd', [('read', counter), ('write', counter)], 5e6),
+             ('disk_ops.rrd', [('read', counter), ('write', counter)], 100),
+             ('disk_time.rrd', [('read', counter), ('write', counter)], 2)],
+}
+
+
+def collectd_rras(step=10, rows=1200, timespans=rra_timespans, xff=0.1):
+    """
+    RRA definitions exactly as collectd computes them.
+
+    >>> collectd_rras()[::3]
+    ['RRA:AVERAGE:0.1:1:1200', 'RRA:AVERAGE:0.1:7:1235', 'RRA:AVERAGE:0.1:50:1210', 'RRA:AVERAGE:0.1:223:1202', 'RRA:AVERAGE:0.1:2635:1201']
+    """
+    rras = []
+    pdp_per_row = 0
+    for span in timespans:
+        if span / step < rows:
+            span = step * rows
+        if pdp_per_row == 0:
+            pdp_per_row = 1
+        else:
+            pdp_per_row = int(math.floor(float(span) / (rows * step)))
+        count = int(math.ceil(float(span) / (pdp_per_row * step)))
+        rras.extend('RRA:%s:%s:%i:%i' % (cf, xff, pdp_per_row, count) for cf in rra_types)
+    return rras
+
+
+def _values(random, times, scale, phase):
+    """Daily cycle (peak shifted by `phase`) with noise - rates for counters"""
+    day = 2 * math.pi * (times % 86400) / 86400.0
+    return scale * (1 + 0.5 * numpy.sin(day + phase)) * random.uniform(0.8, 1.2, len(times))
+
+
+def create(filename, ds, start, step=10, backend=external):
+    parameters = ['--start', str(start), '--step', str(step)]
+    parameters += ['DS:%s:%s:%i:%s:%s' % (name, t, 2 * step, minimum, maximum)
+                   for name, (t, minimum, maximum) in ds]
+    backend.create(filename, parameters + collectd_rras(step))
+
+
+def _chunks(rows, max_length):
+    """Update arguments of at most `max_length` bytes (one remote control line)"""
+    chunk, length = [], 0
+    for row in rows:
+        if chunk and length + len(row) + 1 > max_length:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(row)
+        length += len(row) + 1
+    if chunk:
+        yield chunk
+
+
+def fill(filename, ds, scale, start, end, step=10, seed=0, backend=external, batch=1000,
+         max_length=8000):
+    random = numpy.random.RandomState(seed)
+    phases = random.uniform(0, math.pi, len(ds))
+    totals = numpy.zeros(len(ds))
+    for first in xrange(start, end, step * batch):
+        times = numpy.arange(first, min(first + step * batch, end), step)
+        columns = []
+        for i, (name, (ds_type, _, _)) in enumerate(ds):
+            values = _values(random, times, scale, phases[i])
+            if ds_type == 'DERIVE':
+                values = totals[i] + numpy.cumsum(values * step)
+                totals[i] = values[-1]
+                columns.append(values.astype(numpy.int64).astype(str))
+            else:
+                columns.append(numpy.char.mod('%.3f', values))
+        rows = [':'.join(row) for row in zip(times.astype(str), *columns)]
+        # pool workers read lines of at most `external.MAX_LINE` bytes
+        for chunk in _chunks(rows, max_length - len(filename)):
+            backend.update(filename, chunk)
+
+
+def generate(root, hosts=1, cpus=4, interfaces=('eth0', 'eth1'), disks=('sda',), days=90,
+             step=10, end=None, backend=external):
+    """Create tree under `root` and return list of rrd files"""
+    end = int(end if end is not None else time.time()) // step * step
+    start = end - days * 86400
+    instances = (['cpu-%i' % i for i in range(cpus)] + ['load', 'memory'] +
+                 ['interface-%s' % i for i in interfaces] + ['disk-%s' % d for d in disks])
+    created = []
+    for host_index in range(hosts):
+        host = 'host-%03i' % host_index
+        for instance in instances:
+            plugin_dir = os.path.join(root, host, instance)
+            if not os.path.isdir(plugin_dir):
+                os.makedirs(plugin_dir)
+            for rrdfile, ds, scale in plugins[instance.split('-', 1)[0]]:
+                filename = os.path.join(plugin_dir, rrdfile)
+                seed = hash((host, instance, rrdfile)) & 0xffffffff
+                create(filename, ds, start - step, step=step, backend=backend)
+                fill(filename, ds, scale, start, end + step, step=step, seed=seed, backend=backend)
+                created.append(filename)
+    return created
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--root', required=True)
+    parser.add_argument('--hosts', type=int, default=1)
+    parser.add_argument('--cpus', type=int, default=4)
+    parser.add_argument('--interfaces', nargs='+', default=['eth0', 'eth1'])
+    parser.add_argument('--disks', nargs='+', default=['sda'])
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--step', type=int, default=10)
+    args = parser.parse_args()
+    # one persistent rrdtool process instead of process per update batch
+    external.start_pool(1)
+    started = time.time()
+    created = generate(args.root, hosts=args.hosts, cpus=args.cpus, interfaces=args.interfaces,
+                       disks=args.disks, days=args.days, step=args.step)
+    print '%i rrd files created in %.1fs' % (len(created), time.time() - started)
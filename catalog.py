@@ -0,0 +1,262 @@
+"""
+Catalog of collectd rrd tree kept in SQLite database - path, host,
+plugin instance, ds, archives, step and last update of every rrd file.
+
+Headers are read with native reader (`backend.rrdfile`, rrdtool is
+not started) by pool of processes. `refresh()` reads only files which
+modification time or size changed since previous refresh and drops
+files which were removed, so it can be run often (from cron or with
+`--interval`).
+
+Graph generators use catalog (`graphs.rrd_catalog`) to check that all
+series of graph exist before rrdtool is started, and `graphs.discover`
+lists hosts and plugin instances from it instead of walking tree:
+
+    $ python catalog.py -c rrd.db refresh -r /var/lib/collectd/rrd
+    $ python catalog.py -c rrd.db hosts
+    $ python catalog.py -c rrd.db check
+    $ python graphs.py --catalog rrd.db batch -r /var/lib/collectd/rrd -o ./graphs
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from backend.rrdfile import RRDFile
+
+log = logging.getLogger('catalog')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS rrd (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    host TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    plugin TEXT NOT NULL,
+    file TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    step INTEGER,
+    last_update INTEGER,
+    ds TEXT,
+    rra TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS rrd_host ON rrd (host, instance);
+'''
+
+
+class MissingSeries(ValueError):
+    """Graph reads series which are not in catalog"""
+
+    def __init__(self, directory, problems):
+        super(MissingSeries, self).__init__('%s: %s' % (directory, ', '.join(problems)))
+        self.directory = directory
+        self.problems = problems
+
+
+def walk(rrd_root):
+    """`(path, host, instance, file)` of every `<host>/<instance>/<file>.rrd`"""
+    for host in sorted(os.listdir(rrd_root)):
+        host_dir = os.path.join(rrd_root, host)
+        if not os.path.isdir(host_dir):
+            continue
+        for instance in sorted(os.listdir(host_dir)):
+            plugin_dir = os.path.join(host_dir, instance)
+            if not os.path.isdir(plugin_dir):
+                continue
+            for filename in sorted(os.listdir(plugin_dir)):
+                if filename.endswith('.rrd'):
+                    yield os.path.join(plugin_dir, filename), host, instance, filename
+
+
+def read_header(path):
+    """`(path, step, last_update, ds, rra, error)` from rrd file header"""
+    try:
+        with RRDFile(path) as rrd:
+            ds = [[d.name, d.type, d.heartbeat] for d in rrd.ds]
+            rra = [[a.cf, a.rows, a.pdp_per_row, a.xff] for a in rrd.rra]
+            return path, rrd.step, rrd.last_update, json.dumps(ds), json.dumps(rra), None
+    except (IOError, ValueError) as e:
+        return path, None, None, None, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+class Catalog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.db.executescript(schema)
+
+    @property
+    def db(self):
+        # sqlite connections can't be shared by threads nor forked processes
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.db = sqlite3.connect(self.path)
+            local.db.text_factory = str
+        return local.db
+
+    @property
+    def rrd_root(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'rrd_root'").fetchone()
+        return row[0] if row is not None else None
+
+    def refresh(self, rrd_root, workers=None, chunk_size=64):
+        """Read headers of new and modified files - returns `(read, removed)` counts"""
+        rrd_root = os.path.abspath(rrd_root)
+        db = self.db
+        if self.rrd_root not in (None, rrd_root):
+            # catalog of other tree
+            db.execute('DELETE FROM rrd')
+        known = dict(((path, (mtime, size)) for path, mtime, size
+                      in db.execute('SELECT path, mtime, size FROM rrd')))
+        found = {}
+        changed = []
+        for path, host, instance, filename in walk(rrd_root):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found[path] = (host, instance, filename, stat.st_mtime, stat.st_size)
+            if known.get(path) != (stat.st_mtime, stat.st_size):
+                changed.append(path)
+        removed = [path for path in known if path not in found]
+        if workers == 1 or len(changed) < chunk_size:
+            headers = itertools.imap(read_header, changed)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers)
+            headers = pool.imap_unordered(read_header, changed, chunk_size)
+        try:
+            rows = []
+            for path, step, last_update, ds, rra, error in headers:
+                host, instance, filename, mtime, size = found[path]
+                rows.append((path, os.path.dirname(path), host, instance, instance.split('-', 1)[0],
+                             filename, mtime, size, step, last_update, ds, rra, error))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO rrd VALUES (%s)' % ','.join('?' * 13), rows)
+            db.executemany('DELETE FROM rrd WHERE path = ?', [(path,) for path in removed])
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('rrd_root', ?)", (rrd_root,))
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed', ?)", (str(time.time()),))
+        return len(rows), len(removed)
+
+    def hosts(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT host FROM rrd ORDER BY host')]
+
+    def instances(self, host=None):
+        """`(host, instance, collectd plugin, directory)` of catalogued plugin instances"""
+        query = 'SELECT DISTINCT host, instance, plugin, directory FROM rrd'
+        parameters = ()
+        if host is not None:
+            query += ' WHERE host = ?'
+            parameters = (host,)
+        return self.db.execute(query + ' ORDER BY host, instance', parameters).fetchall()
+
+    def files(self, directory=None):
+        """`{path: {'step':, 'last_update':, 'ds':, 'rra':, 'error':}}`"""
+        query = 'SELECT path, step, last_update, ds, rra, error FROM rrd'
+        parameters = ()
+        if directory is not None:
+            query += ' WHERE directory = ?'
+            parameters = (os.path.abspath(directory),)
+        return dict((path, {'step': step, 'last_update': last_update,
+                            'ds': json.loads(ds) if ds else [], 'rra': json.loads(rra) if rra else [],
+                            'error': error})
+                    for path, step, last_update, ds, rra, error in self.db.execute(query, parameters))
+
+    def problems(self, directory, series):
+        """
+        Reasons why graph which reads `series` (`(rrd file relative to
+        directory, ds, consolidation function)`) can't be rendered.
+        Files which are not catalogued yet are only checked for
+        existence.
+        """
+        directory = os.path.abspath(directory)
+        paths = sorted(set(os.path.join(directory, rrdfile) for rrdfile, ds, cf in series))
+        rows = self.db.execute('SELECT path, ds, rra, error FROM rrd WHERE path IN (%s)' %
+                               ','.join('?' * len(paths)), paths).fetchall()
+        headers = dict((path, (ds, rra, error)) for path, ds, rra, error in rows)
+        problems = []
+        for rrdfile, ds, cf in series:
+            path = os.path.join(directory, rrdfile)
+            if path not in headers:
+                if not os.path.exists(path):
+                    problems.append('%s is missing' % rrdfile)
+                continue
+            ds_list, rra_list, error = headers[path]
+            if error is not None:
+                problems.append('%s: %s' % (rrdfile, error))
+                continue
+            if ds not in [d[0] for d in json.loads(ds_list)]:
+                problems.append('%s has no %s ds' % (rrdfile, ds))
+            if cf not in [a[0] for a in json.loads(rra_list)]:
+                problems.append('%s has no %s archive' % (rrdfile, cf))
+        # every problem once (files are read by many DEFs)
+        return sorted(set(problems))
+
+    def require(self, directory, series):
+        """Raise `MissingSeries` when graph can't be rendered"""
+        problems = self.problems(directory, series)
+        if problems:
+            raise MissingSeries(directory, problems)
+
+    def close(self):
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.db.close()
+            del self._local.pid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--catalog', required=True, help='SQLite database file')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    subparsers = parser.add_subparsers(dest='command')
+    refresh_parser = subparsers.add_parser('refresh', help='read headers of new and modified rrd files')
+    refresh_parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    refresh_parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: cpu count)')
+    refresh_parser.add_argument('-i', '--interval', type=int,
+                                help='refresh every INTERVAL seconds (default: refresh once)')
+    subparsers.add_parser('hosts', help='list hosts')
+    list_parser = subparsers.add_parser('list', help='list plugin instances')
+    list_parser.add_argument('host', nargs='?')
+    subparsers.add_parser('check', help='list graphs which can\'t be rendered')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    catalog = Catalog(args.catalog)
+    if args.command == 'refresh':
+        while True:
+            started = time.time()
+            read, removed = catalog.refresh(args.rrd_root, workers=args.workers)
+            log.info('%i files read, %i removed in %.2fs', read, removed, time.time() - started)
+            if args.interval is None:
+                break
+            time.sleep(args.interval)
+    elif args.command == 'hosts':
+        for host in catalog.hosts():
+            print host
+    elif args.command == 'list':
+        for host, instance, plugin, directory in catalog.instances(args.host):
+            print '%s/%s' % (host, instance)
+    elif args.command == 'check':
+        import graphs
+        graphs.rrd_catalog = catalog
+        for host, instance, plugin, plugin_dir in graphs.discover(catalog.rrd_root):
+            problems = catalog.problems(plugin_dir, graphs.command(plugin).series)
+            for problem in problems:
+                print '%s/%s: %s' % (host, instance, problem)
@@ -1,14 +1,15 @@
-import argparse
 import calendar
 import datetime
 import functools
 import os
-from pyrrd.graph import (CalculationDefinition, ColorAttributes, DataDefinition,
-                         VariableDefinition)
-import pytz
+import sys
+import tempfile
 import time
-from backend.graph import Area, Graph, GraphPrint, GraphHrule, Line
-from cdef import Average, Last, Maximum, Minimum, Expression
+from backend import get_backend, instrumentation, nonblocking
+from backend.cache import RenderCache
+from backend.command import CommandCache, GraphCommand, plugin_dir as plugin_dir_placeholder
+from backend.localizable_external import Arguments, split
+from backend.spec import GraphSpec
 
 canvas = '#ffffff'
 black = '#000000'
@@ -30,391 +31,413 @@ half_magenta = '#dfb7f7'
 half_gray = '#888'
 half_bluegreen = '#89b3c9'
 
+# set to `backend.cache.RenderCache` instance to cache rendered images
+render_cache = None
+# set to `backend.command.CommandCache` instance to keep rrdtool arguments on disk
+command_cache = None
+# set to `catalog.Catalog` instance to check graphs before rrdtool is started
+rrd_catalog = None
+# set to `backend.scheduler.Scheduler` instance to render identical concurrent requests once
+render_scheduler = None
+# pass `--step` of the coarsest archive which still gives one row per pixel (see `graph_step`)
+select_step = True
+# align start and end to selected step, so repeated requests render (and cache) the same window
+snap_to_step = False
+
 def utctimestamp(dt):
     return int(calendar.timegm(dt.utctimetuple()))
 
 def ugettext(s):
     return s
 
-def _graph(graph_vars, start, end, locale=None, units_length=8, **kwargs):
+def _env(locale):
     env = dict(os.environ)
     if locale:
         env['LC_ALL'] = locale.encode('utf-8')
+    return env
+
+def _graph_object(graph_vars, start, end, locale=None, units_length=8, **kwargs):
+    """pyrrd graph of `graph_vars` for `start` - `end` window (unix timestamps)"""
+    # pyrrd is imported only when graph (or command) is built
+    from pyrrd.graph import ColorAttributes
+    from backend.graph import Graph
     color = ColorAttributes(lefttop_border='#0000', rightbottom_border='#0000',
                             background='#0000')
     kwargs.setdefault('width', 820)
-    graph = Graph(env, '-', imgformat='PNG', height=210, start=utctimestamp(start),
-                  end=utctimestamp(end), color=color, units_length=units_length, **kwargs)
+    kwargs.setdefault('height', 210)
+    graph = Graph(_env(locale), '-', imgformat='PNG', start=start, end=end, color=color,
+                  units_length=units_length, **kwargs)
     graph.data.extend(graph_vars)
-    return graph.write(env=env)
-
-def graph_cpu(plugin_dir, start, end, locale=None):
-    user_rrdfile = os.path.join(plugin_dir, 'cpu-user.rrd')
-    system_rrdfile = os.path.join(plugin_dir, 'cpu-system.rrd')
-    wait_rrdfile = os.path.join(plugin_dir, 'cpu-wait.rrd')
-
-    user_min = DataDefinition(rrdfile=user_rrdfile, vname='user_min', dsName='value', cdef='MIN')
-    user_avg = DataDefinition(rrdfile=user_rrdfile, vname='user_avg', dsName='value', cdef='AVERAGE')
-    user_max = DataDefinition(rrdfile=user_rrdfile, vname='user_max', dsName='value', cdef='MAX')
-    user_min_var = VariableDefinition('user_min_var', rpn=unicode(Minimum(Expression(user_min.vname))))
-    user_avg_var = VariableDefinition('user_avg_var', rpn=unicode(Average(Expression(user_avg.vname))))
-    user_max_var = VariableDefinition('user_max_var', rpn=unicode(Maximum(Expression(user_max.vname))))
-    user_last_var = VariableDefinition('user_last_var', rpn=unicode(Last(Expression(user_avg.vname))))
-
-    sys_min = DataDefinition(rrdfile=system_rrdfile, vname='sys_min', dsName='value', cdef='MIN')
-    sys_avg = DataDefinition(rrdfile=system_rrdfile, vname='sys_avg', dsName='value', cdef='AVERAGE')
-    sys_max = DataDefinition(rrdfile=system_rrdfile, vname='sys_max', dsName='value', cdef='MAX')
-    sys_min_var = VariableDefinition('sys_min_var', rpn=unicode(Minimum(Expression(sys_min.vname))))
-    sys_avg_var = VariableDefinition('sys_avg_var', rpn=unicode(Average(Expression(sys_avg.vname))))
-    sys_max_var = VariableDefinition('sys_max_var', rpn=unicode(Maximum(Expression(sys_max.vname))))
-    sys_last_var = VariableDefinition('sys_last_var', rpn=unicode(Last(Expression(sys_avg.vname))))
-
-    wait_min = DataDefinition(rrdfile=wait_rrdfile, vname='wait_min', dsName='value', cdef='MIN')
-    wait_avg = DataDefinition(rrdfile=wait_rrdfile, vname='wait_avg', dsName='value', cdef='AVERAGE')
-    wait_max = DataDefinition(rrdfile=wait_rrdfile, vname='wait_max', dsName='value', cdef='MAX')
-    wait_min_var = VariableDefinition('wait_min_var', rpn=unicode(Minimum(Expression(wait_min.vname))))
-    wait_avg_var = VariableDefinition('wait_avg_var', rpn=unicode(Average(Expression(wait_avg.vname))))
-    wait_max_var = VariableDefinition('wait_max_var', rpn=unicode(Maximum(Expression(wait_max.vname))))
-    wait_last_var = VariableDefinition('wait_last_var', rpn=unicode(Last(Expression(wait_avg.vname))))
-
-    user_sys_avg = CalculationDefinition(vname='user_sys', rpn=unicode(Expression('sys_avg')+Expression('user_avg')))
-
-    graph_vars = [user_min, user_avg, user_max,
-                  user_min_var, user_avg_var, user_max_var, user_last_var,
-                  sys_min, sys_avg, sys_max, user_sys_avg,
-                  sys_min_var, sys_avg_var, sys_max_var, sys_last_var,
-                  wait_min, wait_avg, wait_max,
-                  wait_min_var, wait_avg_var, wait_max_var, wait_last_var]
-
-    user_label = ugettext('User\:')
-    system_label = ugettext('System\:')
-    wait_label = ugettext('Wait-IO\:')
-    max_ll = max(len(l) for l in [user_label, system_label, wait_label])
-
-    graph_vars.append(Area(defObj=user_sys_avg, color=half_blue))
-    graph_vars.append(Line(1, defObj=user_sys_avg, color=full_blue,
-                           legend=('%%-%is'% max_ll) % user_label))
-    graph_vars.append(GraphPrint(user_min_var, ugettext('%8.1lf Min,')))
-    graph_vars.append(GraphPrint(user_avg_var, ugettext('%8.1lf Avg,')))
-    graph_vars.append(GraphPrint(user_max_var, ugettext('%8.1lf Max,')))
-    graph_vars.append(GraphPrint(user_last_var, ugettext('%8.1lf Last\l')))
-    graph_vars.append(Area(defObj=sys_avg, color=half_red))
-    graph_vars.append(Line(1, defObj=sys_avg, color=full_red,
-                           legend=('%%-%is'% max_ll) % system_label))
-    graph_vars.append(GraphPrint(sys_min_var, ugettext('%8.1lf Min,')))
-    graph_vars.append(GraphPrint(sys_avg_var, ugettext('%8.1lf Avg,')))
-    graph_vars.append(GraphPrint(sys_max_var, ugettext('%8.1lf Max,')))
-    graph_vars.append(GraphPrint(sys_last_var, ugettext('%8.1lf Last\l')))
-    graph_vars.append(Area(defObj=wait_avg, color=half_yellow))
-    graph_vars.append(Line(1, defObj=wait_avg, color=full_yellow,
-                           legend=('%%-%is'% max_ll) % wait_label))
-    graph_vars.append(GraphPrint(wait_min_var, ugettext('%8.1lf Min,')))
-    graph_vars.append(GraphPrint(wait_avg_var, ugettext('%8.1lf Avg,')))
-    graph_vars.append(GraphPrint(wait_max_var, ugettext('%8.1lf Max,')))
-    graph_vars.append(GraphPrint(wait_last_var, ugettext('%8.1lf Last\l')))
-    return _graph(graph_vars, start, end, locale=locale, y_grid='10:5', upper_limit=110,
-                  rigid=True, vertical_label=ugettext('"CPU usage [jiffies]"'))
-
-def graph_load(plugin_dir, start, end, locale=None):
-    rrdfile = os.path.join(plugin_dir, 'load.rrd')
-    graph_vars = []
-    shortterm_min = DataDefinition(rrdfile=rrdfile, vname='shortterm_min',
-                                   dsName='shortterm', cdef='MIN')
-    shortterm_avg = DataDefinition(rrdfile=rrdfile, vname='shortterm_avg',
-                                   dsName='shortterm', cdef='AVERAGE')
-    shortterm_max = DataDefinition(rrdfile=rrdfile, vname='shortterm_max',
-                                   dsName='shortterm', cdef='MAX')
-    shortterm_min_var = VariableDefinition('shortterm_min_var', rpn=unicode(Minimum(Expression(shortterm_min.vname))))
-    shortterm_avg_var = VariableDefinition('shortterm_avg_var', rpn=unicode(Average(Expression(shortterm_avg.vname))))
-    shortterm_max_var = VariableDefinition('shortterm_max_var', rpn=unicode(Maximum(Expression(shortterm_max.vname))))
-    shortterm_last_var = VariableDefinition('shortterm_last_var', rpn=unicode(Last(Expression(shortterm_avg.vname))))
-
-    midterm_min = DataDefinition(rrdfile=rrdfile, vname='midterm_min',
-                                 dsName='midterm', cdef='MIN')
-    midterm_avg = DataDefinition(rrdfile=rrdfile, vname='midterm_avg',
-                                   dsName='midterm', cdef='AVERAGE')
-    midterm_max = DataDefinition(rrdfile=rrdfile, vname='midterm_max',
-                                   dsName='midterm', cdef='MAX')
-    midterm_min_var = VariableDefinition('midterm_min_var', rpn=unicode(Minimum(Expression(midterm_min.vname))))
-    midterm_avg_var = VariableDefinition('midterm_avg_var', rpn=unicode(Average(Expression(midterm_avg.vname))))
-    midterm_max_var = VariableDefinition('midterm_max_var', rpn=unicode(Maximum(Expression(midterm_max.vname))))
-    midterm_last_var = VariableDefinition('midterm_last_var', rpn=unicode(Last(Expression(midterm_avg.vname))))
-
-    longterm_min = DataDefinition(rrdfile=rrdfile, vname='longterm_min',
-                                 dsName='longterm', cdef='MIN')
-    longterm_avg = DataDefinition(rrdfile=rrdfile, vname='longterm_avg',
-                                   dsName='longterm', cdef='AVERAGE')
-    longterm_max = DataDefinition(rrdfile=rrdfile, vname='longterm_max',
-                                   dsName='longterm', cdef='MAX')
-    longterm_min_var = VariableDefinition('longterm_min_var', rpn=unicode(Minimum(Expression(longterm_min.vname))))
-    longterm_avg_var = VariableDefinition('longterm_avg_var', rpn=unicode(Average(Expression(longterm_avg.vname))))
-    longterm_max_var = VariableDefinition('longterm_max_var', rpn=unicode(Maximum(Expression(longterm_max.vname))))
-    longterm_last_var = VariableDefinition('longterm_last_var', rpn=unicode(Last(Expression(longterm_avg.vname))))
+    return graph
 
-    # fuck - we have to manually add spacing ;-)
-    longterm_label = ugettext('15 minutes average\:')
-    midterm_label = ugettext('5 minutes average\:')
-    shorterm_label = ugettext('1 minute average\:')
-    max_ll = max(len(l) for l in [longterm_label, midterm_label, shorterm_label])
-
-    graph_vars = [shortterm_min, shortterm_avg, shortterm_max,
-                  shortterm_min_var, shortterm_avg_var, shortterm_max_var, shortterm_last_var,
-                  midterm_min, midterm_avg, midterm_max,
-                  midterm_min_var, midterm_avg_var, midterm_max_var, midterm_last_var,
-                  longterm_min, longterm_avg, longterm_max,
-                  longterm_min_var, longterm_avg_var, longterm_max_var, longterm_last_var,
-                  Area(defObj=shortterm_max, color=half_blue),
-                  Area(defObj=shortterm_min, color=canvas),
-                  Line(1, defObj=longterm_avg, color=full_red,
-                       legend=('%%-%is'% max_ll)%longterm_label),
-                  GraphPrint(longterm_min_var, ugettext('%8.1lf Min,')),
-                  GraphPrint(longterm_avg_var, ugettext('%8.1lf Avg,')),
-                  GraphPrint(longterm_max_var, ugettext('%8.1lf Max,')),
-                  GraphPrint(longterm_last_var, ugettext('%8.1lf Last\l')),
-                  Line(1, defObj=midterm_avg, color=full_green,
-                       legend=('%%-%is'% max_ll)%midterm_label),
-                  GraphPrint(midterm_min_var, ugettext('%8.1lf Min,')),
-                  GraphPrint(midterm_avg_var, ugettext('%8.1lf Avg,')),
-                  GraphPrint(midterm_max_var, ugettext('%8.1lf Max,')),
-                  GraphPrint(midterm_last_var, ugettext('%8.1lf Last\l')),
-                  Line(1, defObj=shortterm_avg, color=full_blue,
-                       legend=('%%-%is'% max_ll)%shorterm_label),
-                  GraphPrint(shortterm_min_var, ugettext('%8.1lf Min,')),
-                  GraphPrint(shortterm_avg_var, ugettext('%8.1lf Avg,')),
-                  GraphPrint(shortterm_max_var, ugettext('%8.1lf Max,')),
-                  GraphPrint(shortterm_last_var, ugettext('%8.1lf Last\l')),
-                  ]
-    return _graph(graph_vars, start, end, vertical_label=ugettext('"System load"'), locale=locale)
-
-def graph_memory(plugin_dir, start, end, locale=None):
-    used_rrdfile = os.path.join(plugin_dir, 'memory-used.rrd')
-    buffered_rrdfile = os.path.join(plugin_dir, 'memory-buffered.rrd')
-    cached_rrdfile = os.path.join(plugin_dir, 'memory-cached.rrd')
-    free_rrdfile = os.path.join(plugin_dir, 'memory-free.rrd')
-
-    used_min = DataDefinition(rrdfile=used_rrdfile, vname='used_min', dsName='value', cdef='MIN')
-    used_avg = DataDefinition(rrdfile=used_rrdfile, vname='used_avg', dsName='value', cdef='AVERAGE')
-    used_max = DataDefinition(rrdfile=used_rrdfile, vname='used_max', dsName='value', cdef='MAX')
-    used_min_var = VariableDefinition('used_min_var', rpn=unicode(Minimum(Expression(used_min.vname))))
-    used_avg_var = VariableDefinition('used_avg_var', rpn=unicode(Average(Expression(used_avg.vname))))
-    used_max_var = VariableDefinition('used_max_var', rpn=unicode(Maximum(Expression(used_max.vname))))
-    used_last_var = VariableDefinition('used_last_var', rpn=unicode(Last(Expression(used_avg.vname))))
-
-    buffered_min = DataDefinition(rrdfile=buffered_rrdfile, vname='buffered_min', dsName='value', cdef='MIN')
-    buffered_avg = DataDefinition(rrdfile=buffered_rrdfile, vname='buffered_avg', dsName='value', cdef='AVERAGE')
-    buffered_max = DataDefinition(rrdfile=buffered_rrdfile, vname='buffered_max', dsName='value', cdef='MAX')
-    buffered_min_var = VariableDefinition('buffered_min_var', rpn=unicode(Minimum(Expression(buffered_min.vname))))
-    buffered_avg_var = VariableDefinition('buffered_avg_var', rpn=unicode(Average(Expression(buffered_avg.vname))))
-    buffered_max_var = VariableDefinition('buffered_max_var', rpn=unicode(Maximum(Expression(buffered_max.vname))))
-    buffered_last_var = VariableDefinition('buffered_last_var', rpn=unicode(Last(Expression(buffered_avg.vname))))
-
-    used_with_buffered_max = CalculationDefinition(vname='used_with_buffered_max',
-                                                  rpn=unicode(Expression(used_max.vname)+Expression(buffered_max.vname)))
-
-    cached_min = DataDefinition(rrdfile=cached_rrdfile, vname='cached_min', dsName='value', cdef='MIN')
-    cached_avg = DataDefinition(rrdfile=cached_rrdfile, vname='cached_avg', dsName='value', cdef='AVERAGE')
-    cached_max = DataDefinition(rrdfile=cached_rrdfile, vname='cached_max', dsName='value', cdef='MAX')
-    cached_min_var = VariableDefinition('cached_min_var', rpn=unicode(Minimum(Expression(cached_min.vname))))
-    cached_avg_var = VariableDefinition('cached_avg_var', rpn=unicode(Average(Expression(cached_avg.vname))))
-    cached_max_var = VariableDefinition('cached_max_var', rpn=unicode(Maximum(Expression(cached_max.vname))))
-    cached_last_var = VariableDefinition('cached_last_var', rpn=unicode(Last(Expression(cached_avg.vname))))
-
-    used_with_buffered_with_cached_max = CalculationDefinition(vname='used_with_buffered_with_cached_max',
-                                                               rpn=unicode(Expression(used_max.vname)+Expression(buffered_max.vname)+Expression(cached_max.vname)))
-
-    free_min = DataDefinition(rrdfile=free_rrdfile, vname='free_min', dsName='value', cdef='MIN')
-    free_avg = DataDefinition(rrdfile=free_rrdfile, vname='free_avg', dsName='value', cdef='AVERAGE')
-    free_max = DataDefinition(rrdfile=free_rrdfile, vname='free_max', dsName='value', cdef='MAX')
-    free_min_var = VariableDefinition('free_min_var', rpn=unicode(Minimum(Expression(free_min.vname))))
-    free_avg_var = VariableDefinition('free_avg_var', rpn=unicode(Average(Expression(free_avg.vname))))
-    free_max_var = VariableDefinition('free_max_var', rpn=unicode(Maximum(Expression(free_max.vname))))
-    free_last_var = VariableDefinition('free_last_var', rpn=unicode(Last(Expression(free_avg.vname))))
-
-    used_with_buffered_with_cached_with_free_max = CalculationDefinition(vname='used_with_buffered_with_cached_with_free_max',
-                                                                         rpn=unicode(Expression(used_max.vname) +
-                                                                                     Expression(buffered_max.vname) +
-                                                                                     Expression(cached_max.vname) +
-                                                                                     Expression(free_max.vname)))
-
-    graph_vars = [used_min, used_avg, used_max,
-                  used_min_var, used_avg_var, used_max_var, used_last_var,
-                  buffered_min, buffered_avg, buffered_max, used_with_buffered_max,
-                  buffered_min_var, buffered_avg_var, buffered_max_var, buffered_last_var,
-                  cached_min, cached_avg, cached_max, used_with_buffered_with_cached_max,
-                  cached_min_var, cached_avg_var, cached_max_var, cached_last_var,
-                  free_min, free_avg, free_max, used_with_buffered_with_cached_with_free_max,
-                  free_min_var, free_avg_var, free_max_var, free_last_var]
-
-    free_label = ugettext('Free\:')
-    page_cache_label = ugettext('Page cache\:')
-    buffer_cache_label = ugettext('Buffer cache\:')
-    used_label = ugettext('Used\:')
-    max_ll = max(len(l) for l in [free_label, page_cache_label, buffer_cache_label, used_label])
-
-    graph_vars.append(Area(defObj=used_with_buffered_with_cached_with_free_max, color=half_green))
-    graph_vars.append(Line(1, defObj=used_with_buffered_with_cached_with_free_max, color=full_green,
-                           legend=('%%-%is'% max_ll)%free_label))
-    graph_vars.append(GraphPrint(free_min_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(free_avg_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(free_max_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(free_last_var, ugettext('%8.1lf%S Last\l')))
-
-    graph_vars.append(Area(defObj=used_with_buffered_with_cached_max, color=half_blue))
-    graph_vars.append(Line(1, defObj=used_with_buffered_with_cached_max, color=full_blue,
-                           legend=('%%-%is'% max_ll)%page_cache_label))
-    graph_vars.append(GraphPrint(cached_min_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(cached_avg_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(cached_max_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(cached_last_var, ugettext('%8.1lf%S Last\l')))
-
-    graph_vars.append(Area(defObj=used_with_buffered_max, color=half_yellow))
-    graph_vars.append(Line(1, defObj=used_with_buffered_max, color=full_yellow,
-                           legend=('%%-%is'% max_ll)%buffer_cache_label))
-    graph_vars.append(GraphPrint(buffered_min_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(buffered_avg_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(buffered_max_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(buffered_last_var, ugettext('%8.1lf%S Last\l')))
-
-    graph_vars.append(Area(defObj=used_max, color=half_red))
-    graph_vars.append(Line(1, defObj=used_max, color=full_red,
-                           legend=('%%-%is'% max_ll)%used_label))
-    graph_vars.append(GraphPrint(used_min_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(used_avg_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(used_max_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(used_last_var, ugettext('%8.1lf%S Last\l')))
-
-    return _graph(graph_vars, start, end, units_exponent=9,
-                  vertical_label=ugettext('"Memory usage [Gigabytes]"'),
-                  locale=locale)
-
-def graph_interface(plugin_dir, start, end, locale=None, logarithmic=True):
-    octets_rrdfile = os.path.join(plugin_dir, 'if_octets.rrd')
-    #errors_rrdfile = os.path.join(plugin_dir, 'if_errors.rrd')
-
-    tx_min = DataDefinition(rrdfile=octets_rrdfile, vname='tx_min', dsName='tx', cdef='MIN')
-    tx_avg = DataDefinition(rrdfile=octets_rrdfile, vname='tx_avg', dsName='tx', cdef='AVERAGE')
-    tx_max = DataDefinition(rrdfile=octets_rrdfile, vname='tx_max', dsName='tx', cdef='MAX')
-
-    # expres traffic in megabits/sec (1e6 bits)
-    tx_min_bits = CalculationDefinition(vname='tx_min_bits', rpn=unicode(Expression(tx_min.vname)*8))
-    tx_avg_bits = CalculationDefinition(vname='tx_avg_bits', rpn=unicode(Expression(tx_avg.vname)*8))
-    tx_max_bits = CalculationDefinition(vname='tx_max_bits', rpn=unicode(Expression(tx_max.vname)*8))
-
-    tx_avg_bits_neg = CalculationDefinition('tx_avg_bits_neg', rpn=unicode(Expression(-1)*Expression(tx_avg_bits.vname)))
-    tx_max_bits_neg = CalculationDefinition('tx_max_bits_neg', rpn=unicode(Expression(-1)*Expression(tx_max_bits.vname)))
-
-    tx_min_bits_var = VariableDefinition('tx_min_bits_var', rpn=unicode(Minimum(Expression(tx_min_bits.vname))))
-    tx_avg_bits_var = VariableDefinition('tx_avg_bits_var', rpn=unicode(Average(Expression(tx_avg_bits.vname))))
-    tx_max_bits_var = VariableDefinition('tx_max_bits_var', rpn=unicode(Maximum(Expression(tx_max_bits.vname))))
-    tx_last_bits_var = VariableDefinition('tx_last_bits_var', rpn=unicode(Last(Expression(tx_avg_bits.vname))))
-
-    rx_min = DataDefinition(rrdfile=octets_rrdfile, vname='rx_min', dsName='rx', cdef='MIN')
-    rx_avg = DataDefinition(rrdfile=octets_rrdfile, vname='rx_avg', dsName='rx', cdef='AVERAGE')
-    rx_max = DataDefinition(rrdfile=octets_rrdfile, vname='rx_max', dsName='rx', cdef='MAX')
-
-    rx_min_bits = CalculationDefinition(vname='rx_min_bits', rpn=unicode(Expression(rx_min.vname)*8))
-    rx_avg_bits = CalculationDefinition(vname='rx_avg_bits', rpn=unicode(Expression(rx_avg.vname)*8))
-    rx_max_bits = CalculationDefinition(vname='rx_max_bits', rpn=unicode(Expression(rx_max.vname)*8))
-
-    rx_min_bits_var = VariableDefinition('rx_min_bits_var', rpn=unicode(Minimum(Expression(rx_min_bits.vname))))
-    rx_avg_bits_var = VariableDefinition('rx_avg_bits_var', rpn=unicode(Average(Expression(rx_avg_bits.vname))))
-    rx_max_bits_var = VariableDefinition('rx_max_bits_var', rpn=unicode(Maximum(Expression(rx_max_bits.vname))))
-    rx_last_bits_var = VariableDefinition('rx_last_bits_var', rpn=unicode(Last(Expression(rx_avg_bits.vname))))
-
-    graph_vars = [tx_min, tx_avg, tx_max, tx_min_bits, tx_avg_bits, tx_max_bits,
-                  tx_avg_bits_neg, tx_max_bits_neg,
-                  tx_min_bits_var, tx_avg_bits_var, tx_max_bits_var, tx_last_bits_var,
-                  rx_min, rx_avg, rx_max, rx_min_bits, rx_avg_bits, rx_max_bits,
-                  rx_min_bits_var, rx_avg_bits_var, rx_max_bits_var, rx_last_bits_var]
-    outgoing_label=ugettext('Outgoing\:')
-    incoming_label=ugettext('Incoming\:')
-    max_ll = max(len(l) for l in [outgoing_label, incoming_label])
+def _summary_formats():
+    return [ugettext('%8.1lf Min,'), ugettext('%8.1lf Avg,'),
+            ugettext('%8.1lf Max,'), ugettext('%8.1lf Last\l')]
 
+def _si_summary_formats():
+    return [ugettext('%8.1lf%S Min,'), ugettext('%8.1lf%S Avg,'),
+            ugettext('%8.1lf%S Max,'), ugettext('%8.1lf%S Last\l')]
+
+def _legends(*labels):
+    # fuck - we have to manually add spacing ;-)
+    max_ll = max(len(l) for l in labels)
+    return [('%%-%is' % max_ll) % l for l in labels]
+
+def cpu_spec():
+    spec = GraphSpec(y_grid='10:5', upper_limit=110, rigid=True,
+                     vertical_label=ugettext('"CPU usage [jiffies]"'))
+    spec.series('user', 'cpu-user.rrd', 'value')
+    spec.series('sys', 'cpu-system.rrd', 'value')
+    spec.series('wait', 'cpu-wait.rrd', 'value')
+    spec.calculate('user_sys', 'sys_avg,user_avg,+')
+
+    user_legend, system_legend, wait_legend = _legends(ugettext('User\:'), ugettext('System\:'),
+                                                       ugettext('Wait-IO\:'))
+    spec.area('user_sys', half_blue)
+    spec.line('user_sys', full_blue, legend=user_legend)
+    spec.summary('user', 'user_min', 'user_avg', 'user_max', _summary_formats())
+    spec.area('sys_avg', half_red)
+    spec.line('sys_avg', full_red, legend=system_legend)
+    spec.summary('sys', 'sys_min', 'sys_avg', 'sys_max', _summary_formats())
+    spec.area('wait_avg', half_yellow)
+    spec.line('wait_avg', full_yellow, legend=wait_legend)
+    spec.summary('wait', 'wait_min', 'wait_avg', 'wait_max', _summary_formats())
+    return spec
+
+def cpu_cores(host_dir):
+    """Numbers of `cpu-N` plugin directories of host"""
+    return sorted(int(name.split('-', 1)[1]) for name in os.listdir(host_dir)
+                  if name.startswith('cpu-') and name.split('-', 1)[1].isdigit())
+
+def _cores(host_dir):
+    cores = tuple(cpu_cores(host_dir))
+    if not cores:
+        raise ValueError('No cpu-N directories in %s.' % host_dir)
+    return cores
+
+# heatmap colors - (lower bound of core usage, color)
+cpu_levels = [(0, half_green), (20, full_green), (40, half_yellow), (60, full_yellow), (80, full_red)]
+
+def _cpu_heatmap_spec(cores):
+    # pyrrd skips false options - limit is passed as string
+    spec = GraphSpec(upper_limit=len(cores), lower_limit='0', rigid=True,
+                     vertical_label=ugettext('"CPU cores"'))
+    for core in cores:
+        busy = 'busy_%i' % core
+        spec.calculate(busy, 'user_%i,sys_%i,+,wait_%i,+' % (core, core, core))
+        # every core is band of height 1 - only band of its usage level is non zero
+        for i, (low, color) in enumerate(cpu_levels):
+            rpn = '%s,UN,0,%s,%i,GE' % (busy, busy, low)
+            if i + 1 < len(cpu_levels):
+                high = cpu_levels[i + 1][0]
+                rpn += ',%s,%i,LT,*' % (busy, high)
+                legend = '%i-%i%%' % (low, high)
+            else:
+                legend = '%i%%+' % low
+            vname = '%s_%i' % (busy, low)
+            spec.calculate(vname, rpn + ',IF')
+            spec.area(vname, color, legend=legend if core == cores[0] else '',
+                      stack=(core, i) != (cores[0], 0))
+        spec.calculate('%s_unknown' % busy, '%s,UN' % busy)
+        spec.area('%s_unknown' % busy, half_gray, stack=True,
+                  legend=ugettext('Unknown') if core == cores[0] else '')
+    return spec
+
+cpu_all_modes = ['sum', 'average', 'heatmap']
+
+def cpu_all_spec(cores, mode='sum'):
+    """
+    All cores of host (rrd files relative to host directory) - `sum`,
+    `average` or per core `heatmap`. Only AVERAGE is read - min and max
+    are computed from aggregated series.
+    """
+    if mode == 'heatmap':
+        spec = _cpu_heatmap_spec(cores)
+    elif mode == 'sum':
+        spec = GraphSpec(upper_limit=110 * len(cores), rigid=True,
+                         vertical_label=ugettext('"CPU usage [jiffies]"'))
+    else:
+        spec = GraphSpec(y_grid='10:5', upper_limit=110, rigid=True,
+                         vertical_label=ugettext('"CPU usage [jiffies]"'))
+    for core in cores:
+        for name, state in [('user', 'user'), ('sys', 'system'), ('wait', 'wait')]:
+            spec.define('%s_%i' % (name, core), 'cpu-%i/cpu-%s.rrd' % (core, state), 'value')
+    if mode == 'heatmap':
+        return spec
+    for name in ['user', 'sys', 'wait']:
+        rpn = ','.join(['%s_%i' % (name, cores[0])] + ['%s_%i,+' % (name, core) for core in cores[1:]])
+        if mode == 'average':
+            rpn += ',%i,/' % len(cores)
+        spec.calculate(name, rpn)
+    spec.calculate('user_sys', 'sys,user,+')
+
+    user_legend, system_legend, wait_legend = _legends(ugettext('User\:'), ugettext('System\:'),
+                                                       ugettext('Wait-IO\:'))
+    spec.area('user_sys', half_blue)
+    spec.line('user_sys', full_blue, legend=user_legend)
+    spec.summary('user', 'user', 'user', 'user', _summary_formats())
+    spec.area('sys', half_red)
+    spec.line('sys', full_red, legend=system_legend)
+    spec.summary('sys', 'sys', 'sys', 'sys', _summary_formats())
+    spec.area('wait', half_yellow)
+    spec.line('wait', full_yellow, legend=wait_legend)
+    spec.summary('wait', 'wait', 'wait', 'wait', _summary_formats())
+    return spec
+
+def load_spec():
+    spec = GraphSpec(vertical_label=ugettext('"System load"'))
+    for name in ['shortterm', 'midterm', 'longterm']:
+        spec.series(name, 'load.rrd', name)
+
+    longterm_legend, midterm_legend, shortterm_legend = _legends(ugettext('15 minutes average\:'),
+                                                                 ugettext('5 minutes average\:'),
+                                                                 ugettext('1 minute average\:'))
+    spec.area('shortterm_max', half_blue)
+    spec.area('shortterm_min', canvas)
+    spec.line('longterm_avg', full_red, legend=longterm_legend)
+    spec.summary('longterm', 'longterm_min', 'longterm_avg', 'longterm_max', _summary_formats())
+    spec.line('midterm_avg', full_green, legend=midterm_legend)
+    spec.summary('midterm', 'midterm_min', 'midterm_avg', 'midterm_max', _summary_formats())
+    spec.line('shortterm_avg', full_blue, legend=shortterm_legend)
+    spec.summary('shortterm', 'shortterm_min', 'shortterm_avg', 'shortterm_max', _summary_formats())
+    return spec
+
+def memory_spec():
+    spec = GraphSpec(units_exponent=9, vertical_label=ugettext('"Memory usage [Gigabytes]"'))
+    for name in ['used', 'buffered', 'cached', 'free']:
+        spec.series(name, 'memory-%s.rrd' % name, 'value')
+    spec.calculate('used_with_buffered_max', 'used_max,buffered_max,+')
+    spec.calculate('used_with_buffered_with_cached_max', 'used_with_buffered_max,cached_max,+')
+    spec.calculate('used_with_buffered_with_cached_with_free_max',
+                   'used_with_buffered_with_cached_max,free_max,+')
+
+    free_legend, page_cache_legend, buffer_cache_legend, used_legend = _legends(
+        ugettext('Free\:'), ugettext('Page cache\:'), ugettext('Buffer cache\:'), ugettext('Used\:'))
+    spec.area('used_with_buffered_with_cached_with_free_max', half_green)
+    spec.line('used_with_buffered_with_cached_with_free_max', full_green, legend=free_legend)
+    spec.summary('free', 'free_min', 'free_avg', 'free_max', _si_summary_formats())
+    spec.area('used_with_buffered_with_cached_max', half_blue)
+    spec.line('used_with_buffered_with_cached_max', full_blue, legend=page_cache_legend)
+    spec.summary('cached', 'cached_min', 'cached_avg', 'cached_max', _si_summary_formats())
+    spec.area('used_with_buffered_max', half_yellow)
+    spec.line('used_with_buffered_max', full_yellow, legend=buffer_cache_legend)
+    spec.summary('buffered', 'buffered_min', 'buffered_avg', 'buffered_max', _si_summary_formats())
+    spec.area('used_max', half_red)
+    spec.line('used_max', full_red, legend=used_legend)
+    spec.summary('used', 'used_min', 'used_avg', 'used_max', _si_summary_formats())
+    return spec
+
+def interface_spec(logarithmic=True):
+    spec = GraphSpec(vertical_label=ugettext('"Network traffic [bits/sec]"'),
+                     logarithmic=logarithmic, units='si')
+    #errors_rrdfile = 'if_errors.rrd'
+    for direction in ['tx', 'rx']:
+        spec.series(direction, 'if_octets.rrd', direction)
+        # expres traffic in megabits/sec (1e6 bits)
+        for cf in ['min', 'avg', 'max']:
+            spec.calculate('%s_%s_bits' % (direction, cf), '%s_%s,8,*' % (direction, cf))
+    spec.calculate('tx_max_bits_neg', '-1,tx_max_bits,*')
+
+    outgoing_legend, incoming_legend = _legends(ugettext('Outgoing\:'), ugettext('Incoming\:'))
     if logarithmic:
-        graph_vars.append(Line(1, defObj=rx_max_bits, color=full_green,
-                               legend=('%%-%is'% max_ll)%incoming_label))
+        spec.line('rx_max_bits', full_green, legend=incoming_legend)
     else:
-        graph_vars.append(Area(defObj=rx_max_bits, color=full_green,
-                               legend=('%%-%is'% max_ll)%incoming_label))
-    graph_vars.append(GraphPrint(rx_min_bits_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(rx_avg_bits_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(rx_max_bits_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(rx_last_bits_var, ugettext('%8.1lf%S Last\l')))
+        spec.area('rx_max_bits', full_green, legend=incoming_legend)
+    spec.summary('rx_bits', 'rx_min_bits', 'rx_avg_bits', 'rx_max_bits', _si_summary_formats())
     if logarithmic:
-        graph_vars.append(Line(1, defObj=tx_max_bits, color=full_blue,
-                               legend=('%%-%is'% max_ll)%outgoing_label))
+        spec.line('tx_max_bits', full_blue, legend=outgoing_legend)
     else:
-        graph_vars.append(Area(defObj=tx_max_bits_neg, color=full_blue,
-                               legend=('%%-%is'% max_ll)%outgoing_label))
-    graph_vars.append(GraphPrint(tx_min_bits_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(tx_avg_bits_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(tx_max_bits_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(tx_last_bits_var, ugettext('%8.1lf%S Last\l')))
-    graph_vars.append(GraphHrule(0, half_red))
-    return _graph(graph_vars, start, end, locale=locale,
-                  vertical_label=ugettext('"Network traffic [bits/sec]"'),
-                  logarithmic=logarithmic, units='si')
-
-def graph_disk(plugin_dir, start, end, locale=None, logarithmic=True):
-    octets_rrdfile = os.path.join(plugin_dir, 'disk_octets.rrd')
-    #operations_rrdfile = os.path.join(plugin_dir, 'disk_ops.rrd')
-
-    read_min = DataDefinition(rrdfile=octets_rrdfile, vname='read_min', dsName='read', cdef='MIN')
-    read_avg = DataDefinition(rrdfile=octets_rrdfile, vname='read_avg', dsName='read', cdef='AVERAGE')
-    read_max = DataDefinition(rrdfile=octets_rrdfile, vname='read_max', dsName='read', cdef='MAX')
-
-    read_min_var = VariableDefinition('read_min_var', rpn=unicode(Minimum(Expression(read_min.vname))))
-    read_avg_var = VariableDefinition('read_avg_var', rpn=unicode(Average(Expression(read_avg.vname))))
-    read_max_var = VariableDefinition('read_max_var', rpn=unicode(Maximum(Expression(read_max.vname))))
-    read_last_var = VariableDefinition('read_last_var', rpn=unicode(Last(Expression(read_avg.vname))))
-
-    write_min = DataDefinition(rrdfile=octets_rrdfile, vname='write_min', dsName='write', cdef='MIN')
-    write_avg = DataDefinition(rrdfile=octets_rrdfile, vname='write_avg', dsName='write', cdef='AVERAGE')
-    write_max = DataDefinition(rrdfile=octets_rrdfile, vname='write_max', dsName='write', cdef='MAX')
-
-    write_min_var = VariableDefinition('write_min_var', rpn=unicode(Minimum(Expression(write_min.vname))))
-    write_avg_var = VariableDefinition('write_avg_var', rpn=unicode(Average(Expression(write_avg.vname))))
-    write_max_var = VariableDefinition('write_max_var', rpn=unicode(Maximum(Expression(write_max.vname))))
-    write_last_var = VariableDefinition('write_last_var', rpn=unicode(Last(Expression(write_avg.vname))))
-
-    read_max_neg = CalculationDefinition('write_max_neg', rpn=unicode(Expression(-1)*Expression(read_max.vname)))
-
-    graph_vars = [read_min, read_avg, read_max, read_max_neg,
-                  write_min, write_avg, write_max,
-                  write_min_var, write_avg_var, write_max_var, write_last_var,
-                  read_min_var, read_avg_var, read_max_var, read_last_var,
-                  ]
-    written_label = ugettext('Written\:')
-    read_label = ugettext('Read\:')
-    max_ll = max(len(l) for l in [read_label, written_label])
-
+        spec.area('tx_max_bits_neg', full_blue, legend=outgoing_legend)
+    spec.summary('tx_bits', 'tx_min_bits', 'tx_avg_bits', 'tx_max_bits', _si_summary_formats())
+    spec.hrule(0, half_red)
+    return spec
+
+def disk_spec(logarithmic=True):
+    spec = GraphSpec(vertical_label=ugettext('"Disk traffic [bytes/sec]"'),
+                     logarithmic=logarithmic, units='si')
+    #operations_rrdfile = 'disk_ops.rrd'
+    spec.series('read', 'disk_octets.rrd', 'read')
+    spec.series('write', 'disk_octets.rrd', 'write')
+    spec.calculate('read_max_neg', '-1,read_max,*')
+
+    written_legend, read_legend = _legends(ugettext('Written\:'), ugettext('Read\:'))
     if not logarithmic:
-        graph_vars.append(Area(defObj=write_max, color=full_magenta,
-                               legend=('%%-%is'% max_ll)%written_label))
+        spec.area('write_max', full_magenta, legend=written_legend)
     else:
-        graph_vars.append(Line(1, defObj=write_max, color=full_magenta,
-                               legend=('%%-%is'% max_ll)%written_label))
-    graph_vars.append(GraphPrint(write_max_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(write_avg_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(write_min_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(write_last_var, ugettext('%8.1lf%S Last\l')))
+        spec.line('write_max', full_magenta, legend=written_legend)
+    spec.summary('write', 'write_min', 'write_avg', 'write_max', _si_summary_formats())
     if not logarithmic:
-        graph_vars.append(Area(defObj=read_max_neg, color=full_cyan,
-                               legend=('%%-%is'% max_ll)%read_label))
+        spec.area('read_max_neg', full_cyan, legend=read_legend)
     else:
-        graph_vars.append(Line(1, defObj=read_max, color=full_cyan,
-                               legend=('%%-%is'% max_ll)%read_label))
-    graph_vars.append(GraphPrint(read_max_var, ugettext('%8.1lf%S Min,')))
-    graph_vars.append(GraphPrint(read_avg_var, ugettext('%8.1lf%S Avg,')))
-    graph_vars.append(GraphPrint(read_min_var, ugettext('%8.1lf%S Max,')))
-    graph_vars.append(GraphPrint(read_last_var, ugettext('%8.1lf%S Last\l')))
-    graph_vars.append(GraphHrule(0, half_red))
-    return _graph(graph_vars, start, end, logarithmic=logarithmic, units='si',
-                  vertical_label=ugettext('"Disk traffic [bytes/sec]"'),
-                  locale=locale)
+        spec.line('read_max', full_cyan, legend=read_legend)
+    spec.summary('read', 'read_min', 'read_avg', 'read_max', _si_summary_formats())
+    spec.hrule(0, half_red)
+    return spec
+
+p2s = {
+    'cpu': cpu_spec,
+    'cpu_all': cpu_all_spec,
+    'load': load_spec,
+    'interface': interface_spec,
+    'memory': memory_spec,
+    'disk': disk_spec,
+}
+
+# compiled templates cache: (plugin, kind, options...) -> backend.spec.Template
+_templates = {}
+
+# template kind -> GraphSpec method which compiles it
+template_kinds = {
+    'graph': 'compile',
+    'export': 'export',
+    'thumbnail': 'thumbnail',
+    'report': 'report',
+}
+
+def template(plugin, kind='graph', **options):
+    key = (plugin, kind) + tuple(sorted(options.items()))
+    if key not in _templates:
+        spec = p2s[plugin](**options)
+        _templates[key] = getattr(spec, template_kinds[kind])()
+    return _templates[key]
+
+def _host_options(plugin, rrd_dir, options):
+    """Fill options of host level graphs which depend on directory contents"""
+    if plugin == 'cpu_all' and 'cores' not in options:
+        options = dict(options, cores=_cores(rrd_dir))
+    return options
+
+# rrdtool arguments: (plugin, kind, locale, options, graph options) -> backend.command.GraphCommand
+_commands = {}
+
+def command(plugin, kind='graph', locale=None, graph_options=None, **options):
+    """
+    `rrdtool graph` arguments of plugin template - built from template
+    once per process (or loaded from `command_cache`).
+    """
+    graph_options = graph_options or {}
+    key = (plugin, kind, locale, tuple(sorted(options.items())),
+           tuple(sorted(graph_options.items())))
+    result = _commands.get(key)
+    if result is None and command_cache is not None:
+        result = command_cache.get(key)
+    if result is None:
+        t = template(plugin, kind, **options)
+        with instrumentation.timer('build'):
+            graph = _graph_object(t.render(plugin_dir_placeholder), 1, 1, locale=locale,
+                                  **dict(t.options, **graph_options))
+            result = GraphCommand.from_graph(graph, t.series)
+        if command_cache is not None:
+            command_cache.set(key, result)
+    _commands[key] = result
+    return result
+
+def graph_step(plugin_dir, series, start, end, width):
+    """
+    Step of the coarsest archive which covers whole window and still
+    gives at least one row per pixel (for all rrd files and consolidation
+    functions which graph reads - headers are read with
+    `backend.rrdfile`). Without `--step` rrdtool reads archive closest
+    to pixel width, often finer one, and consolidates more rows. None
+    (rrdtool chooses itself) when there is no such archive or any file
+    can't be read or parsed - selection never fails rendering.
+    """
+    from backend.rrdfile import RRDFile
+    resolution = (end - start) // width
+    steps = []
+    for rrdfile, cf in sorted(set((rrdfile, cf) for rrdfile, ds, cf in series)):
+        try:
+            with RRDFile(os.path.join(plugin_dir, rrdfile)) as rrd:
+                rra = rrd.coarsest(cf, start, end, resolution)
+        except Exception:
+            return None
+        if rra is None:
+            return None
+        steps.append(rra.step)
+    return min(steps) if steps else None
+
+def render_file(backend, output, arguments, env=None):
+    """
+    Let rrdtool write image directly into `output` - path (image is
+    rendered into temporary file and renamed into place, so readers
+    always get complete file) or file descriptor. Returns `(width,
+    height, prints)`.
+    """
+    if isinstance(output, (int, long)):
+        return backend.graph_file(output, arguments, env=env)
+    # rrdtool creates temporary file itself (so umask is respected)
+    tmp = os.path.join(os.path.dirname(output), '.%s.%s.tmp' % (os.path.basename(output),
+                                                              os.urandom(6).encode('hex')))
+    try:
+        info = backend.graph_file(tmp, arguments, env=env)
+        os.rename(tmp, output)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return info
+
+def _render(plugin, plugin_dir, start, end, locale=None, backend=None, kind='graph',
+            graph_options=None, output=None, **options):
+    """
+    Image (or `(width, height, prints)` when it is rendered into
+    `output` - see `render_file`)
+    """
+    with instrumentation.timer('template'):
+        c = command(plugin, kind, locale=locale, graph_options=graph_options, **options)
+        if rrd_catalog is not None:
+            rrd_catalog.require(plugin_dir, c.series)
+        start, end = utctimestamp(start), utctimestamp(end)
+        step = None
+        if select_step and c.width and end > start:
+            step = graph_step(plugin_dir, c.series, start, end, c.width)
+            if step is not None and snap_to_step:
+                start, end = start - start % step, end - end % step
+        arguments = c.render(plugin_dir, start, end, step=step)
+    if instrumentation.enabled:
+        instrumentation.observe('graph_defs', sum(1 for a in arguments if a.startswith('DEF:')))
+    backend = get_backend(backend or 'external')
+    if output is not None and render_cache is not None:
+        return render_cache.graph_file(backend, output, arguments, env=_env(locale), end=end,
+                                       rrdfiles=c.rrdfiles_in(plugin_dir))
+    if output is not None:
+        return render_file(backend, output, arguments, env=_env(locale))
+    if render_cache is not None:
+        image = render_cache.graph(backend, '-', arguments, env=_env(locale), end=end,
+                                   rrdfiles=c.rrdfiles_in(plugin_dir))
+    else:
+        image = backend.graph('-', arguments, env=_env(locale))
+    instrumentation.observe('png_bytes', len(image))
+    return image
+
+def graph_cpu(plugin_dir, start, end, locale=None, backend=None, output=None):
+    return _render('cpu', plugin_dir, start, end, locale=locale, backend=backend,
+                   output=output)
+
+def graph_cpu_all(host_dir, start, end, locale=None, mode='sum', backend=None, output=None):
+    """All `cpu-N` directories of host on one graph (one rrdtool call)"""
+    return _render('cpu_all', host_dir, start, end, locale=locale, backend=backend, output=output,
+                   cores=_cores(host_dir), mode=mode)
+
+def graph_load(plugin_dir, start, end, locale=None, backend=None, output=None):
+    return _render('load', plugin_dir, start, end, locale=locale, backend=backend,
+                   output=output)
+
+def graph_memory(plugin_dir, start, end, locale=None, backend=None, output=None):
+    return _render('memory', plugin_dir, start, end, locale=locale, backend=backend,
+                   output=output)
+
+def graph_interface(plugin_dir, start, end, locale=None, logarithmic=True, backend=None, output=None):
+    return _render('interface', plugin_dir, start, end, locale=locale, backend=backend, output=output,
+                   logarithmic=logarithmic)
+
+def graph_disk(plugin_dir, start, end, locale=None, logarithmic=True, backend=None, output=None):
+    return _render('disk', plugin_dir, start, end, locale=locale, backend=backend, output=output,
+                   logarithmic=logarithmic)
 
 p2g = {
     'cpu': graph_cpu,
+    'cpu_all': graph_cpu_all,
     'load': graph_load,
     'interface': graph_interface,
     'memory': graph_memory,
@@ -422,32 +445,442 @@ p2g = {
 }
 
 def graph(plugin, rrd_dir, start, end, **kwargs):
+    """
+    PNG image - or `(width, height, prints)` when `output` (path or file
+    descriptor) is given and rrdtool writes image there
+    """
+    if render_scheduler is not None:
+        return graph_async(plugin, rrd_dir, start, end, **kwargs).result()
     return p2g[plugin](rrd_dir, start, end, **kwargs)
 
+def graph_async(plugin, rrd_dir, start, end, timeout=None, lane='interactive', **kwargs):
+    """
+    Non blocking `graph` - returns `backend.nonblocking.Call`. With
+    `render_scheduler` set, graph is queued in its `lane` and shares
+    call with identical graph which is already in flight.
+    """
+    if render_scheduler is None:
+        return nonblocking.submit(graph, plugin, rrd_dir, start, end, timeout=timeout, **kwargs)
+    key = (plugin, os.path.abspath(rrd_dir), utctimestamp(start), utctimestamp(end),
+           tuple(sorted(kwargs.items())))
+    return render_scheduler.submit(key, p2g[plugin], rrd_dir, start, end, lane=lane,
+                                   timeout=timeout, **kwargs)
+
+def export_series(plugin, rrd_dir, start, end, kind='export', maxrows=None, step=None,
+                  backend=None, **options):
+    """
+    `(meta, rows)` (see `backend.export`) of series which `kind`
+    ('export' or 'report') template of plugin exports.
+    """
+    parameters = ['--start', str(utctimestamp(start)), '--end', str(utctimestamp(end))]
+    if maxrows is not None:
+        parameters += ['--maxrows', str(maxrows)]
+    if step is not None:
+        parameters += ['--step', str(step)]
+    options = _host_options(plugin, rrd_dir, options)
+    # template is split with directory placeholder (like graph commands),
+    # so rrd_dir is passed to rrdtool unchanged
+    if isinstance(rrd_dir, unicode):
+        rrd_dir = rrd_dir.encode('utf-8')
+    prefix = os.path.join(rrd_dir, '')
+    arguments = split(template(plugin, kind, **options).render(plugin_dir_placeholder))
+    parameters = Arguments(parameters + [a.replace(plugin_dir_placeholder + '/', prefix)
+                                         for a in arguments])
+    backend = get_backend(backend or 'external')
+    # numbers are parsed, so they have to be formatted in C locale
+    return backend.export(parameters, env=dict(os.environ, LC_ALL='C'))
+
+def export(plugin, rrd_dir, start, end, format='json', maxrows=None, backend=None, **options):
+    """
+    Series drawn on plugin graph (same DEFs and CDEFs) as generator of
+    JSON or CSV chunks. `maxrows` limits number of rows - rrdtool
+    consolidates data to fit.
+    """
+    from backend.export import formats
+    meta, rows = export_series(plugin, rrd_dir, start, end, maxrows=maxrows, backend=backend,
+                               **options)
+    return formats[format](meta, rows)
+
+def thumbnail(plugin, rrd_dir, start, end, width=120, height=40, locale=None, backend=None,
+              **options):
+    """Tiny graph (AVERAGE only, without axes, legends and summaries)"""
+    options = _host_options(plugin, rrd_dir, options)
+    return _render(plugin, rrd_dir, start, end, locale=locale, backend=backend, kind='thumbnail',
+                   graph_options={'width': width, 'height': height}, **options)
+
+# period name -> window length in days
+periods = {
+    'day': 1,
+    'week': 7,
+    'month': 31,
+    'year': 365,
+}
+
+# graphs which read whole host directory
+host_graphs = ['cpu_all']
+
+def plugin_for(instance):
+    """Map collectd plugin instance directory (`cpu-0`, `interface-eth0`...) to p2g key"""
+    plugin = instance.split('-', 1)[0]
+    return plugin if plugin in p2g and plugin not in host_graphs else None
+
+def discover(rrd_root):
+    """
+    Walk collectd `<rrd_root>/<host>/<plugin-instance>` tree (or list
+    it from `rrd_catalog` when it catalogs this tree)
+    """
+    if rrd_catalog is not None and rrd_catalog.rrd_root == os.path.abspath(rrd_root):
+        for host, instance, name, plugin_dir in rrd_catalog.instances():
+            plugin = plugin_for(instance)
+            if plugin is not None:
+                yield host, instance, plugin, plugin_dir
+        return
+    for host in sorted(os.listdir(rrd_root)):
+        host_dir = os.path.join(rrd_root, host)
+        if not os.path.isdir(host_dir):
+            continue
+        for instance in sorted(os.listdir(host_dir)):
+            plugin = plugin_for(instance)
+            plugin_dir = os.path.join(host_dir, instance)
+            if plugin is not None and os.path.isdir(plugin_dir):
+                yield host, instance, plugin, plugin_dir
+
+def plugin_options(plugin, kwargs):
+    """Drop options which generator of given plugin doesn't accept"""
+    kwargs = dict(kwargs)
+    if plugin not in ['disk', 'interface']:
+        kwargs.pop('logarithmic', None)
+    return kwargs
+
+def output_name(instance, period, locale=None):
+    return '%s.png' % '-'.join(filter(None, [instance, period, locale]))
+
+def write_atomic(path, data):
+    directory = os.path.dirname(path) or '.'
+    with instrumentation.timer('write'):
+        handle, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                output.write(data)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+class Skipped(str):
+    """Error of job which was skipped, not failed - graph reads series missing from `rrd_catalog`"""
+
+def _job_error(e):
+    from catalog import MissingSeries
+    error = '%s: %s' % (e.__class__.__name__, e)
+    return Skipped(error) if isinstance(e, MissingSeries) else error
+
+def _render_job(job):
+    """
+    Render job of `batch` - returns `(job, duration, error)`. Windows
+    which were already rendered into `render_cache` are linked from it
+    without starting rrdtool:
+
+    >>> import shutil
+    >>> import graphs
+    >>> from backend import localizable_external as external
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(root, 'load'))
+    >>> external.create(os.path.join(root, 'load', 'load.rrd'), '--start 920804400 --step 10 ' +
+    ...                 ' '.join('DS:%s:GAUGE:20:0:U' % n for n in ['shortterm', 'midterm', 'longterm']) +
+    ...                 ' RRA:AVERAGE:0.5:1:100 RRA:MIN:0.5:1:100 RRA:MAX:0.5:1:100')
+    >>> graphs.render_cache = RenderCache(os.path.join(root, 'cache'))
+    >>> calls = []
+    >>> def hook(name, value, labels):
+    ...     if name == 'rrdtool_calls_total':
+    ...         calls.append(labels['command'])
+    >>> instrumentation.enable()
+    >>> instrumentation.add_hook(hook)
+    >>> start, end = datetime.datetime(1999, 3, 7, 10), datetime.datetime(1999, 3, 7, 11)
+    >>> for name in ['first.png', 'second.png']:
+    ...     job = ('load', os.path.join(root, 'load'), start, end, os.path.join(root, name), {})
+    ...     print graphs._render_job(job)[2]
+    None
+    None
+    >>> calls
+    ['graph']
+    >>> instrumentation.remove_hook(hook)
+    >>> instrumentation.disable()
+    >>> graphs.render_cache = None
+    >>> shutil.rmtree(root)
+    """
+    plugin, plugin_dir, start, end, output, kwargs = job
+    started = time.time()
+    try:
+        graph(plugin, plugin_dir, start, end, output=output, **kwargs)
+    except Exception as e:
+        return job, time.time() - started, _job_error(e)
+    return job, time.time() - started, None
+
+def batch(rrd_root, output_dir, end, periods=periods, locales=(None,), workers=None,
+          cpu_all=None, **kwargs):
+    """
+    Render all graph x period x locale combinations for given collectd
+    tree with pool of `workers` processes. Generates
+    `(job, duration, error)` triples (error of skipped job is `Skipped`).
+    When `cpu_all` mode is given all cores of host are rendered on one
+    `cpu` graph.
+    """
+    jobs = []
+    cpu_hosts = set()
+    for host, instance, plugin, plugin_dir in discover(rrd_root):
+        host_dir = os.path.join(output_dir, host)
+        if not os.path.isdir(host_dir):
+            os.makedirs(host_dir)
+        plugin_kwargs = plugin_options(plugin, kwargs)
+        if cpu_all is not None and plugin == 'cpu':
+            if host in cpu_hosts:
+                continue
+            cpu_hosts.add(host)
+            plugin, instance, plugin_dir = 'cpu_all', 'cpu', os.path.dirname(plugin_dir)
+            plugin_kwargs['mode'] = cpu_all
+        for period, days in sorted(periods.items()):
+            start = end - datetime.timedelta(days=days)
+            for locale in locales:
+                output = os.path.join(host_dir, output_name(instance, period, locale))
+                jobs.append((plugin, plugin_dir, start, end, output,
+                             dict(plugin_kwargs, locale=locale)))
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(_render_job, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def _thumbnail_job(job):
+    host, instance, plugin, plugin_dir, start, end, kwargs = job
+    try:
+        return host, instance, thumbnail(plugin, plugin_dir, start, end, **kwargs), None
+    except Exception as e:
+        return host, instance, None, _job_error(e)
+
+def thumbnails(rrd_root, end, days=1, workers=None, cpu_all=None, **kwargs):
+    """
+    Render thumbnail of every graph of collectd tree with pool of
+    `workers` processes. Generates `(host, instance, png, error)`.
+    """
+    start = end - datetime.timedelta(days=days)
+    jobs = []
+    cpu_hosts = set()
+    for host, instance, plugin, plugin_dir in discover(rrd_root):
+        plugin_kwargs = plugin_options(plugin, kwargs)
+        if cpu_all is not None and plugin == 'cpu':
+            if host in cpu_hosts:
+                continue
+            cpu_hosts.add(host)
+            plugin, instance, plugin_dir = 'cpu_all', 'cpu', os.path.dirname(plugin_dir)
+            plugin_kwargs['mode'] = cpu_all
+        jobs.append((host, instance, plugin, plugin_dir, start, end, plugin_kwargs))
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(_thumbnail_job, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def sprite_sheet(images, columns=10):
+    """
+    Paste `[(name, png)]` into one PNG - returns `(png, layout)` where
+    layout maps name to `[x, y, width, height]`. Requires PIL.
+    """
+    from PIL import Image
+    from cStringIO import StringIO
+    tiles = [(name, Image.open(StringIO(png))) for name, png in images]
+    if not tiles:
+        raise ValueError('No images to paste.')
+    width = max(tile.size[0] for name, tile in tiles)
+    height = max(tile.size[1] for name, tile in tiles)
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = Image.new('RGBA', (width * min(columns, len(tiles)), height * rows), (0, 0, 0, 0))
+    layout = {}
+    for i, (name, tile) in enumerate(tiles):
+        x, y = i % columns * width, i // columns * height
+        sheet.paste(tile, (x, y))
+        layout[name] = [x, y] + list(tile.size)
+    output = StringIO()
+    sheet.save(output, 'PNG')
+    return output.getvalue(), layout
+
+def multipart(images, boundary='thumbnail'):
+    """`multipart/mixed` body chunks with one part per `(name, png)`"""
+    for name, png in images:
+        yield ('--%s\r\nContent-Type: image/png\r\nContent-Location: %s\r\n'
+               'Content-Length: %i\r\n\r\n' % (boundary, name, len(png)))
+        yield png
+        yield '\r\n'
+    yield '--%s--\r\n' % boundary
+
 if __name__ == '__main__':
+    # only command line needs these
+    import argparse
+    import json
+
     main_parser = argparse.ArgumentParser()
+    main_parser.add_argument('--cache-dir', help='directory for rendered images cache')
+    main_parser.add_argument('--command-cache', help='directory for rrdtool arguments cache')
+    main_parser.add_argument('--catalog', help='rrd catalog (see catalog.py) used to skip graphs which can\'t be rendered')
+    main_parser.add_argument('--snap-to-step', action='store_true', default=False,
+                             help='align start and end of graphs to step of read archives')
+    main_parser.add_argument('--cache-size', type=int, default=256,
+                             help='maximum size of images cache in megabytes')
+    main_parser.add_argument('--stats', choices=['json', 'prometheus'],
+                             help='print timings and counters of this process to stderr')
     subparsers = main_parser.add_subparsers()
     name2parser = {}
     datefield_help = 'format Y-m-d - for example: 2013-08-29'
     coerce_date_value = lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date()
 
-    def do_graph(plugin, args):
+    def get_tzinfo(args):
         timezone = args.timezone if args.timezone is not None else time.tzname[0]
-        tzinfo = pytz.timezone(timezone)
+        import pytz
+        return pytz.timezone(timezone)
+
+    def do_graph(plugin, args):
+        tzinfo = get_tzinfo(args)
         end = datetime.date.today() if args.end is None else args.end
         start = end - datetime.timedelta(days=7) if args.start is None else args.start
         print start
         print end
         start = datetime.datetime.combine(start, datetime.time()).replace(tzinfo=tzinfo)
         end = datetime.datetime.combine(end, datetime.time()).replace(tzinfo=tzinfo)
+        # rrdtool writes image directly into output file
+        output = args.output if args.output is not None else '%s.png' % plugin
         if hasattr(args, 'logarithmic'):
-            p = graph(plugin, args.rrd_dir, start=start, end=end,
-                      locale=args.locale, logarithmic=args.logarithmic)
+            graph(plugin, args.rrd_dir, start=start, end=end, locale=args.locale,
+                  logarithmic=args.logarithmic, backend=args.backend, output=output)
+        elif hasattr(args, 'mode'):
+            graph(plugin, args.rrd_dir, start=start, end=end, locale=args.locale,
+                  mode=args.mode, backend=args.backend, output=output)
         else:
-            p = graph(plugin, args.rrd_dir, start=start, end=end, locale=args.locale)
-        output = args.output if args.output is not None else '%s.png' % plugin
-        with open(output, 'w+') as graph_file:
-            graph_file.write(p)
+            graph(plugin, args.rrd_dir, start=start, end=end, locale=args.locale,
+                  backend=args.backend, output=output)
+
+    def do_export(args):
+        tzinfo = get_tzinfo(args)
+        end = datetime.date.today() if args.end is None else args.end
+        start = end - datetime.timedelta(days=7) if args.start is None else args.start
+        start = datetime.datetime.combine(start, datetime.time()).replace(tzinfo=tzinfo)
+        end = datetime.datetime.combine(end, datetime.time()).replace(tzinfo=tzinfo)
+        options = {'logarithmic': args.logarithmic} if args.plugin in ['disk', 'interface'] else {}
+        chunks = export(args.plugin, args.rrd_dir, start, end, format=args.format,
+                        maxrows=args.maxrows, backend=args.backend, **options)
+        output = open(args.output, 'w') if args.output is not None else sys.stdout
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    def do_batch(args):
+        tzinfo = get_tzinfo(args)
+        end = datetime.date.today() if args.end is None else args.end
+        end = datetime.datetime.combine(end, datetime.time()).replace(tzinfo=tzinfo)
+        selected = dict((p, periods[p]) for p in args.periods)
+        started = time.time()
+        durations = {}
+        failures = []
+        skipped = []
+        for job, duration, error in batch(args.rrd_root, args.output_dir, end, periods=selected,
+                                          locales=args.locales or [None], workers=args.workers,
+                                          cpu_all=args.cpu_all, logarithmic=args.logarithmic,
+                                          backend=args.backend):
+            if isinstance(error, Skipped):
+                skipped.append((job[4], error))
+                continue
+            durations.setdefault(job[0], []).append(duration)
+            if error is not None:
+                failures.append((job[4], error))
+        for plugin, values in sorted(durations.items()):
+            print '%-10s %5i graphs, %7.3fs avg, %7.3fs max' % (
+                plugin, len(values), sum(values) / len(values), max(values))
+        print '%i graphs rendered in %.1fs, %i failed, %i skipped' % (
+            sum(len(v) for v in durations.values()), time.time() - started, len(failures),
+            len(skipped))
+        for output, error in skipped:
+            print 'SKIPPED %s: %s' % (output, error)
+        for output, error in failures:
+            print 'FAILED %s: %s' % (output, error)
+
+    def do_thumbnails(args):
+        tzinfo = get_tzinfo(args)
+        end = datetime.date.today() if args.end is None else args.end
+        end = datetime.datetime.combine(end, datetime.time()).replace(tzinfo=tzinfo)
+        images = []
+        for host, instance, png, error in thumbnails(args.rrd_root, end, days=periods[args.period],
+                                                     workers=args.workers, cpu_all=args.cpu_all,
+                                                     width=args.width, height=args.height,
+                                                     locale=args.locale, backend=args.backend):
+            name = '%s/%s.png' % (host, instance)
+            if error is not None:
+                sys.stderr.write('%s %s: %s\n' % ('SKIPPED' if isinstance(error, Skipped) else 'FAILED',
+                                                  name, error))
+            else:
+                images.append((name, png))
+        if args.multipart:
+            with open(args.output, 'wb') as output:
+                for chunk in multipart(images):
+                    output.write(chunk)
+            return
+        png, layout = sprite_sheet(images, columns=args.columns)
+        write_atomic(args.output, png)
+        write_atomic(os.path.splitext(args.output)[0] + '.json', json.dumps(layout, indent=2,
+                                                                           sort_keys=True))
+
+    parser = subparsers.add_parser('thumbnails', help='render thumbnails of whole collectd rrd tree into one file')
+    parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='sprite sheet (layout is written next to it as .json) or multipart file')
+    parser.add_argument('-p', '--period', choices=sorted(periods), default='day')
+    parser.add_argument('-l', '--locale')
+    parser.add_argument('-t', '--timezone')
+    parser.add_argument('-e', '--end', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: cpu count)')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('--width', type=int, default=120)
+    parser.add_argument('--height', type=int, default=40)
+    parser.add_argument('--columns', type=int, default=10, help='thumbnails per sprite sheet row')
+    parser.add_argument('--multipart', action='store_true', default=False,
+                        help='write multipart/mixed stream instead of sprite sheet (PIL is not needed)')
+    parser.add_argument('--cpu-all', choices=cpu_all_modes,
+                        help='render all cores of host on one cpu thumbnail')
+    parser.set_defaults(func=do_thumbnails)
+
+    parser = subparsers.add_parser('batch', help='render graphs for whole collectd rrd tree')
+    parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('-p', '--periods', nargs='+', choices=sorted(periods), default=sorted(periods))
+    parser.add_argument('-l', '--locales', nargs='+')
+    parser.add_argument('-t', '--timezone')
+    parser.add_argument('-e', '--end', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: cpu count)')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('--logarithmic', action='store_true', default=False)
+    parser.add_argument('--cpu-all', choices=cpu_all_modes,
+                        help='render all cores of host on one cpu graph')
+    parser.set_defaults(func=do_batch)
+
+    parser = subparsers.add_parser('export', help='export graph series as JSON or CSV')
+    parser.add_argument('plugin', choices=sorted(p2s))
+    parser.add_argument('-t', '--timezone')
+    parser.add_argument('-s', '--start', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-e', '--end', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-d', '--rrd-dir', required=True)
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-f', '--format', choices=['csv', 'json'], default='json')
+    parser.add_argument('-m', '--maxrows', type=int, help='maximum number of rows (data is consolidated to fit)')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('--logarithmic', action='store_true', default=False)
+    parser.set_defaults(func=do_export)
 
     for plugin in ['cpu', 'load', 'interface', 'memory', 'disk']:
         parser = subparsers.add_parser(plugin)
@@ -457,11 +890,37 @@ if __name__ == '__main__':
         parser.add_argument('-e', '--end', help=datefield_help, type=coerce_date_value)
         parser.add_argument('-d', '--rrd-dir', required=True)
         parser.add_argument('-o', '--output')
+        parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
         parser.set_defaults(func=functools.partial(do_graph, plugin=plugin))
         name2parser[plugin] = parser
 
     for name in ['disk', 'interface']:
         name2parser[name].add_argument('--logarithmic', action='store_true', default=False)
 
+    parser = subparsers.add_parser('cpu_all', help='all cores of host on one graph')
+    parser.add_argument('-l', '--locale')
+    parser.add_argument('-t', '--timezone')
+    parser.add_argument('-s', '--start', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-e', '--end', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-d', '--rrd-dir', required=True, help='host directory (with cpu-N subdirectories)')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('-m', '--mode', choices=cpu_all_modes, default='sum')
+    parser.set_defaults(func=functools.partial(do_graph, plugin='cpu_all'))
+
     args = main_parser.parse_args()
+    if args.cache_dir:
+        render_cache = RenderCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    if args.command_cache:
+        command_cache = CommandCache(args.command_cache, sources=[__file__])
+    snap_to_step = args.snap_to_step
+    if args.catalog:
+        from catalog import Catalog
+        rrd_catalog = Catalog(args.catalog)
+    if args.stats:
+        instrumentation.enable()
     args.func(args=args)
+    if args.stats == 'json':
+        sys.stderr.write(instrumentation.dump_json() + '\n')
+    elif args.stats == 'prometheus':
+        sys.stderr.write(instrumentation.dump_prometheus())
@@ -0,0 +1,232 @@
+"""
+Pre-render daemon - keeps "last day / week / month / year" graphs of
+every discovered host and plugin rendered in output directory
+(`<output_dir>/<host>/<instance>-<period>[-<locale>].png`, same layout
+as `graphs.py batch`).
+
+rrd files are watched with inotify (when `pyinotify` is installed) or
+their modification times are polled. Window is re-rendered only when
+its rrd files were modified after last render and not more often than
+once per step of archive which its graph reads (`graphs.graph_step` -
+new row of yearly graph appears once per day; one pixel of width is
+used when archive is unknown). Images are replaced with atomic rename, so readers
+always get complete file.
+"""
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import graphs
+
+log = logging.getLogger('prerender')
+
+
+class PollingWatcher(object):
+    """Sleeps for `interval` seconds - all graphs are checked by mtime"""
+
+    def __init__(self, rrd_root, interval):
+        self.interval = interval
+
+    def wait(self):
+        time.sleep(self.interval)
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Collects (for `interval` seconds) directories with modified files"""
+
+    def __init__(self, rrd_root, interval):
+        self.interval = interval
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self._event)
+        mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        self.manager.add_watch(rrd_root, mask, rec=True, auto_add=True)
+
+    def _event(self, event):
+        self.changed.add(os.path.dirname(event.pathname))
+
+    def wait(self):
+        deadline = time.time() + self.interval
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self.notifier.check_events(int(remaining * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+def _template_options(kwargs):
+    # backend is option of rendering, not of template
+    return dict((k, v) for k, v in kwargs.items() if k != 'backend')
+
+
+def inputs_mtime(plugin, plugin_dir, kwargs):
+    rrdfiles = graphs.template(plugin, **_template_options(kwargs)).rrdfiles
+    return max(os.stat(os.path.join(plugin_dir, f)).st_mtime for f in rrdfiles)
+
+
+def archive_step(plugin, plugin_dir, start, end, kwargs):
+    """Step of archive which graph of window reads - None when it is unknown"""
+    c = graphs.command(plugin, **_template_options(kwargs))
+    if not c.width:
+        return None
+    return graphs.graph_step(plugin_dir, c.series, graphs.utctimestamp(start),
+                             graphs.utctimestamp(end), c.width)
+
+
+class Prerenderer(object):
+
+    def __init__(self, rrd_root, output_dir, periods=graphs.periods, locales=(None,),
+                 interval=10, width=820, workers=None, watcher=None, **kwargs):
+        # paths are keys of `rendered` and `dirty` (and are compared
+        # with directories reported by watcher)
+        self.rrd_root = os.path.abspath(rrd_root)
+        self.output_dir = os.path.abspath(output_dir)
+        self.periods = periods
+        self.locales = locales
+        self.interval = interval
+        self.width = width
+        self.kwargs = kwargs
+        if watcher is None:
+            watcher = InotifyWatcher if pyinotify is not None else PollingWatcher
+        self.watcher = watcher(self.rrd_root, interval)
+        self.pool = multiprocessing.Pool(workers)
+        # output -> (inputs mtime, render time)
+        self.rendered = {}
+        # plugin directories with modified files which weren't rendered yet
+        self.dirty = set()
+
+    def min_interval(self, days, step=None):
+        """
+        Re-render period - step of archive graph reads (seconds covered
+        by one pixel of graph when it is unknown)
+        """
+        if step is None:
+            step = days * 86400 // self.width
+        return max(self.interval, step)
+
+    def due(self, output, mtime, days, now, step=None):
+        state = self.rendered.get(output)
+        if state is None:
+            try:
+                rendered = os.stat(output).st_mtime
+            except OSError:
+                return True
+            state = self.rendered[output] = (rendered, rendered)
+        if mtime <= state[0]:
+            return False
+        return now - state[1] >= self.min_interval(days, step)
+
+    def jobs(self, changed=None):
+        """
+        Render jobs (in `graphs._render_job` format) for windows which
+        are due. `changed` is set of modified directories or None when
+        every graph should be checked.
+        """
+        now = time.time()
+        end = datetime.datetime.utcfromtimestamp(now)
+        if changed is not None:
+            self.dirty.update(os.path.abspath(d) for d in changed)
+        jobs = []
+        for host, instance, plugin, plugin_dir in graphs.discover(self.rrd_root):
+            plugin_dir = os.path.abspath(plugin_dir)
+            if changed is not None and plugin_dir not in self.dirty:
+                continue
+            kwargs = graphs.plugin_options(plugin, self.kwargs)
+            try:
+                mtime = inputs_mtime(plugin, plugin_dir, kwargs)
+            except OSError:
+                continue
+            host_dir = os.path.join(self.output_dir, host)
+            if not os.path.isdir(host_dir):
+                os.makedirs(host_dir)
+            pending = False
+            for period, days in sorted(self.periods.items()):
+                start = end - datetime.timedelta(days=days)
+                step = archive_step(plugin, plugin_dir, start, end, kwargs)
+                for locale in self.locales:
+                    output = os.path.join(host_dir, graphs.output_name(instance, period, locale))
+                    if self.due(output, mtime, days, now, step):
+                        jobs.append((mtime, (plugin, plugin_dir, start, end, output,
+                                             dict(kwargs, locale=locale))))
+                    elif mtime > self.rendered[output][0]:
+                        pending = True
+            if pending:
+                self.dirty.add(plugin_dir)
+            else:
+                self.dirty.discard(plugin_dir)
+        return jobs
+
+    def render(self, jobs):
+        mtimes = dict((job[4], mtime) for mtime, job in jobs)
+        for job, duration, error in self.pool.imap_unordered(graphs._render_job,
+                                                             [job for mtime, job in jobs]):
+            output = job[4]
+            # failed windows are retried when rrd files are modified again
+            self.rendered[output] = (mtimes[output], time.time())
+            if error is not None:
+                log.error('%s: %s', output, error)
+            else:
+                log.debug('%s rendered in %.3fs', output, duration)
+
+    def run(self):
+        self.render(self.jobs())
+        try:
+            while True:
+                jobs = self.jobs(self.watcher.wait())
+                if jobs:
+                    started = time.time()
+                    self.render(jobs)
+                    log.info('%i graphs rendered in %.1fs', len(jobs), time.time() - started)
+        finally:
+            self.close()
+
+    def close(self):
+        self.watcher.close()
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('-p', '--periods', nargs='+', choices=sorted(graphs.periods),
+                        default=sorted(graphs.periods))
+    parser.add_argument('-l', '--locales', nargs='+')
+    parser.add_argument('-i', '--interval', type=int, default=10,
+                        help='seconds between checks for modified rrd files')
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: cpu count)')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('--logarithmic', action='store_true', default=False)
+    parser.add_argument('--polling', action='store_true', default=False,
+                        help='poll modification times even if pyinotify is available')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    prerenderer = Prerenderer(args.rrd_root, args.output_dir,
+                              periods=dict((p, graphs.periods[p]) for p in args.periods),
+                              locales=args.locales or [None], interval=args.interval,
+                              workers=args.workers, logarithmic=args.logarithmic,
+                              backend=args.backend,
+                              watcher=PollingWatcher if args.polling else None)
+    prerenderer.run()
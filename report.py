@@ -0,0 +1,233 @@
+"""
+Fleet report - min, avg, max, last, percentiles and total of every
+summarized series (the ones printed in graph legends) of every plugin
+instance of collectd tree, without rendering.
+
+Series are exported with `rrdtool xport` of plugin 'report' template
+(the same DEFs and CDEFs which graph legends read) and summarized with
+NumPy. Plugin instances are read by pool of processes:
+
+    $ python report.py -r /var/lib/collectd/rrd -s 2013-08-01 -e 2013-09-01 -f csv -o august.csv
+
+Series are exported in step of the finest archives which cover the
+window (`--step` overrides it), so statistics are not computed from
+rows consolidated by `rrdtool xport`.
+
+Statistics follow graph legends - `min` is minimum of MIN series, `max`
+is maximum of MAX series, other values are computed from AVERAGE
+series. `total` is integral of average over time (sum of values times
+step - bytes for byte rates).
+"""
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+import warnings
+from cStringIO import StringIO
+
+import numpy
+
+import graphs
+
+columns = ['host', 'instance', 'plugin', 'series', 'min', 'avg', 'max', 'last']
+
+
+def summarize(minimum, average, maximum, step, percentiles=(95, 99)):
+    """
+    Statistics of every column of (rows x series) arrays - list of
+    dicts. Unknown (NaN) values are skipped.
+
+    >>> nan = float('nan')
+    >>> average = numpy.array([[1.0, nan], [3.0, nan], [2.0, 4.0], [nan, nan]])
+    >>> for s in summarize(average - 1, average, average + 1, 60, percentiles=(50,)):
+    ...     print sorted(s.items())
+    [('avg', 2.0), ('last', 2.0), ('max', 4.0), ('min', 0.0), ('p50', 2.0), ('samples', 3), ('total', 360.0)]
+    [('avg', 4.0), ('last', 4.0), ('max', 5.0), ('min', 3.0), ('p50', 4.0), ('samples', 1), ('total', 240.0)]
+    >>> empty = numpy.empty((0, 1))
+    >>> print sorted(summarize(empty, empty, empty, 60, percentiles=(50,))[0].items())
+    [('avg', nan), ('last', nan), ('max', nan), ('min', nan), ('p50', nan), ('samples', 0), ('total', 0.0)]
+    """
+    known = ~numpy.isnan(average)
+    rows, count = average.shape
+    if not rows:
+        unknown = numpy.full((1, count), numpy.nan)
+        stats = summarize(unknown, unknown, unknown, step, percentiles=percentiles)
+        for s in stats:
+            s['samples'] = 0
+        return stats
+    # index of last known row of every column (rows without any give NaN)
+    last = average[rows - 1 - numpy.argmax(known[::-1], axis=0), numpy.arange(count)]
+    with warnings.catch_warnings():
+        # columns without known values give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        stats = {
+            'min': numpy.nanmin(minimum, axis=0),
+            'avg': numpy.nanmean(average, axis=0),
+            'max': numpy.nanmax(maximum, axis=0),
+            'last': last,
+            'total': numpy.nansum(average, axis=0) * step,
+        }
+        for p in percentiles:
+            stats['p%s' % p] = numpy.nanpercentile(average, p, axis=0, interpolation='nearest')
+    samples = known.sum(axis=0)
+    return [dict([(k, float(v[i])) for k, v in stats.items()] + [('samples', int(samples[i]))])
+            for i in range(count)]
+
+
+def finest_step(plugin, plugin_dir, start, end, **options):
+    """
+    Step of the finest archives which cover `start` - `end` (unix
+    timestamps) for all series of report template (headers are read
+    with `backend.rrdfile`) - None when files can't be read.
+    """
+    from backend.rrdfile import RRDFile
+    series = graphs.template(plugin, 'report', **options).series
+    steps = []
+    for rrdfile, cf in sorted(set((rrdfile, cf) for rrdfile, ds, cf in series)):
+        try:
+            with RRDFile(os.path.join(plugin_dir, rrdfile)) as rrd:
+                rra = rrd.select(cf, start, end)
+        except Exception:
+            return None
+        if rra is not None:
+            steps.append(rra.step)
+    return max(steps) if steps else None
+
+
+def series_report(plugin, plugin_dir, start, end, percentiles=(95, 99), step=None,
+                  backend=None, **options):
+    """
+    `[(series name, statistics)]` of plugin instance. Without `step`
+    series are exported in step of the finest archives which cover the
+    window - rrdtool would consolidate them to 400 rows (and percentiles
+    of averaged rows are lower).
+    """
+    start_time, end_time = graphs.utctimestamp(start), graphs.utctimestamp(end)
+    if step is None:
+        step = finest_step(plugin, plugin_dir, start_time, end_time, **options)
+    maxrows = None if step is None else (end_time - start_time) // step + 1
+    meta, rows = graphs.export_series(plugin, plugin_dir, start, end, kind='report', step=step,
+                                      maxrows=maxrows, backend=backend, **options)
+    values = numpy.array([v for t, v in rows], dtype=numpy.float64)
+    values = values.reshape(-1, len(meta['legends']))
+    # legends are `<name>_min`, `<name>_avg`, `<name>_max` triples
+    names = [legend.rsplit('_', 1)[0] for legend in meta['legends'][::3]]
+    stats = summarize(values[:, 0::3], values[:, 1::3], values[:, 2::3], meta['step'],
+                      percentiles=percentiles)
+    return zip(names, stats)
+
+
+def _report_job(job):
+    host, instance, plugin, plugin_dir, start, end, kwargs = job
+    try:
+        return host, instance, plugin, series_report(plugin, plugin_dir, start, end, **kwargs), None
+    except Exception as e:
+        return host, instance, plugin, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def report(rrd_root, start, end, plugins=None, workers=None, **kwargs):
+    """
+    Summarize every plugin instance of collectd tree with pool of
+    `workers` processes. Generates `(host, instance, plugin,
+    [(series, statistics)], error)` in tree order.
+    """
+    jobs = [(host, instance, plugin, plugin_dir, start, end, graphs.plugin_options(plugin, kwargs))
+            for host, instance, plugin, plugin_dir in graphs.discover(rrd_root)
+            if plugins is None or plugin in plugins]
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(_report_job, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def records(results):
+    """Flatten `report` results into one dict per series"""
+    for host, instance, plugin, series, error in results:
+        for name, stats in series or []:
+            yield dict(stats, host=host, instance=instance, plugin=plugin, series=name)
+
+
+def _value(value):
+    return None if isinstance(value, float) and numpy.isnan(value) else value
+
+
+def to_json(records):
+    separator = '\n'
+    yield '['
+    for record in records:
+        yield separator + json.dumps(dict((k, _value(v)) for k, v in sorted(record.items())),
+                                     sort_keys=True)
+        separator = ',\n'
+    yield ']\n'
+
+
+def to_csv(records, percentiles=(95, 99)):
+    fields = columns + ['p%s' % p for p in percentiles] + ['total', 'samples']
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow(['' if _value(record[f]) is None else record[f] for f in fields])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    datefield_help = 'format Y-m-d - for example: 2013-08-29'
+    coerce_date_value = lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date()
+    parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-f', '--format', choices=['csv', 'json'], default='json')
+    parser.add_argument('-t', '--timezone')
+    parser.add_argument('-s', '--start', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-e', '--end', help=datefield_help, type=coerce_date_value)
+    parser.add_argument('-p', '--plugins', nargs='+', choices=sorted(set(graphs.p2s) - set(graphs.host_graphs)))
+    parser.add_argument('--percentiles', nargs='+', type=float, default=[95, 99])
+    parser.add_argument('--step', type=int, help='step of exported series in seconds (default: chosen by rrdtool)')
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: cpu count)')
+    parser.add_argument('-b', '--backend', choices=['external', 'bindings'])
+    parser.add_argument('--catalog', help='rrd catalog (see catalog.py) used to list plugin instances')
+    args = parser.parse_args()
+    if args.catalog is not None:
+        from catalog import Catalog
+        graphs.rrd_catalog = Catalog(args.catalog)
+    import pytz
+    tzinfo = pytz.timezone(args.timezone if args.timezone is not None else time.tzname[0])
+    end = datetime.date.today() if args.end is None else args.end
+    start = end - datetime.timedelta(days=7) if args.start is None else args.start
+    start = datetime.datetime.combine(start, datetime.time()).replace(tzinfo=tzinfo)
+    end = datetime.datetime.combine(end, datetime.time()).replace(tzinfo=tzinfo)
+    percentiles = [int(p) if p == int(p) else p for p in args.percentiles]
+    failures = []
+
+    def results():
+        for result in report(args.rrd_root, start, end, plugins=args.plugins, workers=args.workers,
+                             percentiles=percentiles, step=args.step, backend=args.backend,
+                             logarithmic=True):
+            if result[-1] is not None:
+                failures.append(result)
+            yield result
+
+    if args.format == 'csv':
+        chunks = to_csv(records(results()), percentiles=percentiles)
+    else:
+        chunks = to_json(records(results()))
+    output = open(args.output, 'w') if args.output is not None else sys.stdout
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    for host, instance, plugin, series, error in failures:
+        sys.stderr.write('FAILED %s/%s: %s\n' % (host, instance, error))
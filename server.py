@@ -0,0 +1,236 @@
+"""
+WSGI graph server:
+
+    GET /<host>/<plugin-instance>.png?start=&end=&locale=&logarithmic=
+
+`start` and `end` are unix timestamps (defaults: last 24 hours). ETag
+and Last-Modified headers are computed from last update timestamps of
+rrd files which graph reads, so conditional requests are answered
+(304 Not Modified) without starting rrdtool. Rendered images are kept
+on disk and served with `wsgi.file_wrapper` (which uses sendfile under
+servers like gunicorn or uwsgi).
+
+Graphs are rendered by `backend.scheduler.Scheduler` - concurrent
+requests for the same graph share one rrdtool call, at most `--workers`
+graphs are rendered at once and requests which don't fit into queue
+are answered with 503.
+
+When `backend.instrumentation` is enabled, stats are served under
+`/metrics` in Prometheus text format.
+"""
+import argparse
+import datetime
+import email.utils
+import hashlib
+import os
+import re
+import time
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer
+
+import graphs
+from backend import instrumentation
+from backend.cache import RenderCache
+from backend.command import CommandCache
+from catalog import Catalog, MissingSeries
+from backend.nonblocking import CallTimeout
+from backend.rrdfile import RRDFile
+from backend.scheduler import Lane, QueueFull, Scheduler
+
+_name = re.compile(r'^[\w.-]+$')
+
+
+def last_update(rrdfile):
+    try:
+        with RRDFile(rrdfile) as rrd:
+            return rrd.last_update
+    except (IOError, ValueError):
+        return int(os.stat(rrdfile).st_mtime)
+
+
+def _read(image, chunk_size=64 * 1024):
+    """Generate chunks of `image` - file is closed even when response is not read to end"""
+    try:
+        for chunk in iter(lambda: image.read(chunk_size), ''):
+            yield chunk
+    finally:
+        image.close()
+
+
+class GraphServer(object):
+    """
+    WSGI application - graphs of collectd tree in `rrd_root` are rendered
+    into `cache_dir`:
+
+    >>> import shutil, tempfile
+    >>> from wsgiref.util import FileWrapper
+    >>> from backend import localizable_external as external
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(root, 'host1', 'load'))
+    >>> rrdfile = os.path.join(root, 'host1', 'load', 'load.rrd')
+    >>> external.create(rrdfile, '--start 920804400 --step 10 ' +
+    ...                 ' '.join('DS:%s:GAUGE:20:0:U' % n for n in ['shortterm', 'midterm', 'longterm']) +
+    ...                 ' RRA:AVERAGE:0.5:1:100 RRA:MIN:0.5:1:100 RRA:MAX:0.5:1:100')
+    >>> external.update(rrdfile, '920804410:1:2:3 920804420:2:2:3')
+    >>> server = GraphServer(root, os.path.join(root, 'cache'))
+    >>> def get(path='/host1/load.png', **environ):
+    ...     environ.update(PATH_INFO=path, QUERY_STRING='start=920804000&end=920804500')
+    ...     response = []
+    ...     body = server(environ, lambda status, headers: response.extend([status, dict(headers)]))
+    ...     return response[0], response[1], body
+    >>> status, headers, body = get()
+    >>> status, headers['Content-Type']
+    ('200 OK', 'image/png')
+    >>> ''.join(body)[1:4]
+    'PNG'
+
+    Conditional requests are answered without rendering, cached image is
+    passed to `wsgi.file_wrapper` when server provides it:
+
+    >>> get(HTTP_IF_NONE_MATCH=headers['ETag'])[0]
+    '304 Not Modified'
+    >>> status, headers, body = get(**{'wsgi.file_wrapper': FileWrapper})
+    >>> status, body.filelike.read(4)[1:]
+    ('200 OK', 'PNG')
+    >>> body.close()
+    >>> get('/host1/cpu-0.png')[:2]
+    ('404 Not Found', {'Content-Type': 'text/plain'})
+    >>> shutil.rmtree(root)
+    """
+
+    def __init__(self, rrd_root, cache_dir, max_size=256 * 1024 * 1024, default_period=86400,
+                 timeout=None):
+        self.rrd_root = rrd_root
+        self.timeout = timeout
+        self.cache = RenderCache(cache_dir, max_size=max_size)
+        self.default_period = default_period
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.handle(environ, start_response)
+        except HTTPError as e:
+            start_response(e.status, [('Content-Type', 'text/plain')])
+            return [str(e)]
+
+    def parse(self, environ):
+        parts = environ.get('PATH_INFO', '').strip('/').split('/')
+        if len(parts) != 2 or not parts[1].endswith('.png'):
+            raise HTTPError('404 Not Found', 'Expected /<host>/<plugin>.png')
+        host, instance = parts[0], parts[1][:-len('.png')]
+        plugin = graphs.plugin_for(instance)
+        plugin_dir = os.path.join(self.rrd_root, host, instance)
+        if (plugin is None or not _name.match(host) or not _name.match(instance) or
+                host.startswith('.') or not os.path.isdir(plugin_dir)):
+            raise HTTPError('404 Not Found', 'Unknown graph')
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        get = lambda name: query.get(name, [None])[0]
+        try:
+            end = int(get('end') or time.time())
+            start = int(get('start') or end - self.default_period)
+        except ValueError:
+            raise HTTPError('400 Bad Request', 'start and end should be unix timestamps')
+        options = {}
+        if plugin in ['disk', 'interface']:
+            options['logarithmic'] = get('logarithmic') not in [None, '', '0', 'false']
+        return plugin, plugin_dir, start, end, get('locale'), options
+
+    def handle(self, environ, start_response):
+        if environ.get('PATH_INFO') == '/metrics' and instrumentation.enabled:
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+            return [instrumentation.dump_prometheus()]
+        plugin, plugin_dir, start, end, locale, options = self.parse(environ)
+        rrdfiles = [os.path.join(plugin_dir, f) for f in graphs.template(plugin, **options).rrdfiles]
+        try:
+            updates = [last_update(f) for f in rrdfiles]
+        except OSError:
+            raise HTTPError('404 Not Found', 'Missing rrd files')
+        key = hashlib.sha1(repr((plugin_dir, start, end, locale, sorted(options.items()),
+                                 updates))).hexdigest()
+        etag = '"%s"' % key
+        last_modified = email.utils.formatdate(max(updates), usegmt=True)
+        headers = [('ETag', etag), ('Last-Modified', last_modified),
+                   ('Cache-Control', 'no-cache')]
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_none_match is not None:
+            not_modified = etag in [t.strip() for t in if_none_match.split(',')] or if_none_match == '*'
+        elif if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            not_modified = since is not None and email.utils.mktime_tz(since) >= max(updates)
+        else:
+            not_modified = False
+        if not_modified:
+            start_response('304 Not Modified', headers)
+            return []
+
+        path = self.cache.path(key)
+        try:
+            image = open(path, 'rb')
+            os.utime(path, None)
+        except (IOError, OSError):
+            try:
+                # rrdtool writes image into cache directly, identical concurrent
+                # requests share one rendering (`graphs.render_scheduler`)
+                graphs.graph_async(plugin, plugin_dir, datetime.datetime.utcfromtimestamp(start),
+                                   datetime.datetime.utcfromtimestamp(end), locale=locale,
+                                   timeout=self.timeout, output=path, **options).result()
+            except MissingSeries as e:
+                raise HTTPError('404 Not Found', str(e))
+            except QueueFull as e:
+                raise HTTPError('503 Service Unavailable', str(e))
+            except CallTimeout as e:
+                raise HTTPError('504 Gateway Timeout', str(e))
+            self.cache.added(key)
+            image = open(path, 'rb')
+        headers += [('Content-Type', 'image/png'),
+                    ('Content-Length', str(os.fstat(image.fileno()).st_size))]
+        start_response('200 OK', headers)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(image, 64 * 1024)
+        return _read(image)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rrd-root', required=True, help='collectd rrd directory (with host subdirectories)')
+    parser.add_argument('-c', '--cache-dir', required=True, help='directory for rendered images')
+    parser.add_argument('--cache-size', type=int, default=256, help='maximum size of images cache in megabytes')
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('--command-cache', help='directory for rrdtool arguments cache')
+    parser.add_argument('--catalog', help='rrd catalog (see catalog.py) used to answer 404 for graphs which can\'t be rendered')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of concurrently rendered graphs')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='maximum number of graphs waiting for rendering (503 is answered when queue is full)')
+    parser.add_argument('--timeout', type=float, help='rendering timeout in seconds (504 is answered after it)')
+    parser.add_argument('--snap-to-step', action='store_true', default=False,
+                        help='align start and end of graphs to step of read archives')
+    parser.add_argument('--metrics', action='store_true', default=False,
+                        help='collect timings and serve them (Prometheus format) under /metrics')
+    args = parser.parse_args()
+    if args.metrics:
+        instrumentation.enable()
+    if args.command_cache:
+        graphs.command_cache = CommandCache(args.command_cache, sources=[graphs.__file__])
+    if args.catalog:
+        graphs.rrd_catalog = Catalog(args.catalog)
+    graphs.snap_to_step = args.snap_to_step
+    graphs.render_scheduler = Scheduler({'interactive': Lane(workers=args.workers,
+                                                             max_queued=args.queue_size)})
+    application = GraphServer(args.rrd_root, args.cache_dir, max_size=args.cache_size * 1024 * 1024,
+                              timeout=args.timeout)
+    make_server(args.host, args.port, application, server_class=ThreadingWSGIServer).serve_forever()